@@ -1,9 +1,43 @@
-from flask import Flask, render_template, request, send_file
-import xml.etree.ElementTree as ET
-import src.convert as convert
+import contextlib
+import functools
+import hmac
+import os
+from flask import Flask, Response, jsonify, render_template, request, send_file, stream_with_context
+from src.io import bytes_to_chunks
+from src.admission import AdmissionController, Rejected
+from src.decompress import DecompressedTooLarge, upload_max_plain_bytes
+from src.backend import get_backend
+from src.kbo import get_registry
+from src.model import get_engine
+from src.batch import convert_document, validate_document
+from src.sniff import UnsupportedDocument
+from src.tenants import UnknownTenant, get_profile
+from src.validate import is_valid
+from src.cache import ConversionCache, DEFAULT_DISK_MAX_BYTES, DEFAULT_MAX_BYTES
+from src.metrics import REGISTRY
+from src.profiling import profile_call, profile_id
+from src.bulk import get_executor, iter_convert_bulk, iter_uploads, iter_zip_stream
+from src.jobs import JobQueue, start_worker_threads
 
 # Create the application.
 app = Flask(__name__)
+# Queue of the asynchronous conversion jobs, see src/jobs.py.
+job_queue = JobQueue()
+# Convert jobs in background threads of the web process, so jobs are converted wherever they are queued. Set
+# JOB_THREADS to 0 when separate `python -m src.jobs` workers share the filesystem of the queue.
+job_threads = int(os.environ.get('JOB_THREADS', 1))
+if job_threads:
+    start_worker_threads(job_queue.db_path, job_threads)
+# Converted documents by content, so resent invoices are answered without parsing.
+conversion_cache = ConversionCache(int(os.environ.get('CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+                                   os.environ.get('CACHE_DIR') or None,
+                                   int(os.environ.get('CACHE_DISK_MAX_BYTES', DEFAULT_DISK_MAX_BYTES)))
+# Size limit and conversion budget of the uploads of this worker, see src/admission.py.
+admission = AdmissionController()
+# Largest accepted decompressed upload, see src/decompress.py.
+max_plain_bytes = upload_max_plain_bytes()
+# Requests carrying this token in the X-Profile header are profiled, see src/profiling.py. Unset disables profiling.
+profile_token = os.environ.get('PROFILE_TOKEN') or None
 
 
 # Create a URL route in our application for "/"
@@ -25,20 +59,237 @@ def upload_file():
     Get multipart file from the form
     :return: converted file
     """
-    print(request.files)
-    # Get the file as xml from the request
-    file = request.files['file']
-    # Convert file to elementtree
-    xml = ET.fromstring(file.read())
-    # Convert the xml to peppol xml
-    converted_xml = convert.create_invoice_elementtree(xml, "0478693713")
-    # Convert converted xml to file
-    converted_file = ET.tostring(converted_xml)
-    # Write converted_file to an xml file
-    with open("converted.xml", "wb") as f:
-        f.write(converted_file)
+    tenant, profile = tenant_profile()
+    # Wait for a share of the conversion budget before the body is read, or answer 413/503 right away.
+    with admission.admit(limit_body()):
+        # Get the file as xml from the request
+        file = request.files['file']
+        return convert_upload(file, tenant, profile)
+
+
+def convert_upload(file, tenant, profile):
+    """
+    Convert an uploaded file
+    :param file: The uploaded file.
+    :param tenant: The tenant or None for the default profile.
+    :param profile: The TenantProfile of the tenant.
+    :return: converted file
+    """
+    # Convert the xml to peppol xml, or take it from the cache when this exact file was converted before. The backends
+    # order the namespace declarations of the root differently, so the backend and serializer are part of the version,
+    # like the rules of the tenant and the KBO dump the parties were enriched from. The model engine writes the xml
+    # itself, the same for every backend.
+    registry = get_registry()
+    engine = get_engine(profile=profile)
+    version = profile.version + '-' + ('model' if engine == 'model' else get_backend().name + '-ubl')
+    if registry is not None:
+        version += '-kbo' + registry.version
+    profiling = profile_token is not None and hmac.compare_digest(request.headers.get('X-Profile', '').encode('utf-8'),
+                                                                profile_token.encode('utf-8'))
+    try:
+        converter = functools.partial(convert_document, tenant=tenant, engine=engine, max_bytes=max_plain_bytes)
+        if profiling:
+            # Profile the conversion itself, never answer from the cache.
+            key = profile_id(request.headers.get('X-Request-ID'))
+            converted_xml = profile_call(key, None, converter, file.read(), profile.kbo_number)
+        else:
+            converted_xml = conversion_cache.get_or_convert(file.read(), profile.kbo_number, version, converter)
+    except SyntaxError as error:
+        # ElementTree.ParseError, raised for both xml backends.
+        return jsonify(error='invalid xml: %s' % error), 400
+    except UnsupportedDocument as error:
+        return jsonify(error=str(error)), 415
+    # Serialize the converted xml in memory, compressed when the client accepts it.
+    content_encoding = request.accept_encodings.best_match(['gzip', 'deflate', 'identity'], default='identity')
+    if content_encoding == 'identity':
+        content_encoding = None
+    converted_file = bytes_to_chunks(converted_xml, content_encoding)
     # Return the converted xml
-    return send_file('src/converted.xml', mimetype='text/xml', download_name='converted.xml', as_attachment=True)
+    response = xml_response(converted_file, content_encoding, 'converted.xml')
+    if profiling:
+        response.headers['X-Profile-ID'] = key
+    return response
+
+
+@app.route('/validate', methods=['POST'])
+def validate_file():
+    """
+    Convert a multipart file and check the result against the peppol rules
+    :return: whether the converted file is valid and the findings of the failed checks
+    """
+    tenant, profile = tenant_profile()
+    with admission.admit(limit_body()):
+        file = request.files['file']
+        try:
+            findings = validate_document(file.read(), profile.kbo_number, tenant=tenant, max_bytes=max_plain_bytes)
+        except SyntaxError as error:
+            # ElementTree.ParseError, raised for both xml backends.
+            return jsonify(error='invalid xml: %s' % error), 400
+        except UnsupportedDocument as error:
+            return jsonify(error=str(error)), 415
+    return jsonify(valid=is_valid(findings), findings=[finding._asdict() for finding in findings])
+
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    """
+    Get the counters of the conversion cache
+    :return: hits, disk hits, misses, evictions and size of the cache
+    """
+    return jsonify(conversion_cache.stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Get the conversion metrics of all workers
+    :return: metrics in the Prometheus text format
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/uploader/bulk', methods=['POST'])
+def upload_bulk():
+    """
+    Get many multipart files and/or zip archives from the form
+    :return: zip archive of the converted files with a manifest.json, streamed as files finish
+    """
+    tenant, profile = tenant_profile()
+    # The archive is converted while it streams out, so the share of the budget is held until the response is closed.
+    admitted = contextlib.ExitStack()
+    admitted.enter_context(admission.admit(limit_body()))
+    try:
+        files = request.files.getlist('file')
+        results = iter_convert_bulk(iter_uploads(files, max_plain_bytes), profile.kbo_number, get_executor(),
+                                    tenant=tenant, max_bytes=max_plain_bytes)
+        response = Response(stream_with_context(iter_zip_stream(results)), mimetype='application/zip')
+    except BaseException:
+        admitted.close()
+        raise
+    response.call_on_close(admitted.close)
+    response.headers['Content-Disposition'] = 'attachment; filename=converted.zip'
+    return response
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queue the conversion of a multipart file
+    :return: the id and status of the job
+    """
+    tenant, profile = tenant_profile()
+    # Jobs are converted later by the job workers, only the size is limited here.
+    limit_body()
+    file = request.files['file']
+    job_id = job_queue.submit(file.read(), profile.kbo_number, tenant)
+    response = jsonify(job_queue.status(job_id))
+    response.status_code = 202
+    response.headers['Location'] = '/jobs/' + job_id
+    return response
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Get the status of a conversion job
+    :return: the id and status of the job
+    """
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify(error='unknown job'), 404
+    return jsonify(status)
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """
+    Download the result of a finished conversion job
+    :return: converted file
+    """
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify(error='unknown job'), 404
+    if status['status'] != 'done':
+        return jsonify(status), 409
+    return send_file(job_queue.output_path(job_id), mimetype='text/xml', download_name='converted.xml',
+                     as_attachment=True)
+
+
+@app.errorhandler(UnknownTenant)
+def unknown_tenant(error):
+    """
+    Answer requests for a tenant without profile
+    :return: the error
+    """
+    return jsonify(error=str(error)), 404
+
+
+@app.errorhandler(Rejected)
+def rejected(error):
+    """
+    Answer uploads that were not admitted: 413 when too large, 503 with Retry-After when the worker is busy
+    :return: the error
+    """
+    REGISTRY.flush()
+    if error.reason == 'too_large':
+        return jsonify(error='upload larger than %d bytes' % admission.max_bytes), 413
+    response = jsonify(error='too many conversions in progress, retry later')
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+@app.errorhandler(DecompressedTooLarge)
+def decompressed_too_large(error):
+    """
+    Answer compressed uploads that decompress to more than MAX_PLAIN_BYTES
+    :return: the error
+    """
+    REGISTRY.inc('peppol_admission_rejections_total', reason='decompressed_too_large')
+    REGISTRY.flush()
+    return jsonify(error=str(error)), 413
+
+
+def limit_body():
+    """
+    Enforce the maximum upload size while the body streams in: a larger declared length is rejected before anything
+    is read, a body of unknown length (chunked) is cut off once it passes the maximum.
+    :return: The content length of the request, None when unknown.
+    :raise Rejected: When the declared length is too large.
+    """
+    size = request.content_length
+    admission.check_size(size)
+    if size is None:
+        request.environ['wsgi.input'] = admission.limit(request.environ['wsgi.input'])
+    return size
+
+
+def tenant_profile():
+    """
+    Get the profile of the tenant named in the X-Tenant header of the request, see src/tenants.py.
+    :return: Tuple (tenant or None for the default profile, TenantProfile).
+    :raise UnknownTenant: When the tenant has no profile.
+    """
+    tenant = request.headers.get('X-Tenant') or None
+    return tenant, get_profile(tenant)
+
+
+def xml_response(converted_file, content_encoding, download_name):
+    """
+    Stream serialized xml chunks as an attachment.
+    :param converted_file: The ChunkWriter holding the serialized xml.
+    :param content_encoding: The content encoding of the chunks or None.
+    :param download_name: The file name of the attachment.
+    :return: The response.
+    """
+    response = Response(iter(converted_file.chunks), mimetype='text/xml')
+    response.headers['Content-Length'] = str(converted_file.length)
+    response.headers['Content-Disposition'] = 'attachment; filename=' + download_name
+    response.vary.add('Accept-Encoding')
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    response.set_etag(converted_file.etag)
+    return response.make_conditional(request)
 
 
 # If we're running in stand alone mode, run the application
@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from src.backend import BACKENDS, get_backend
+from src.convert import create_invoice_elementtree
+from src.generate import generate_invoice
+from src.metrics import rule_timer
+from src.model import emit_invoice, extract_invoice, model_params, parse_invoice
+from src.serialize import serialize
+from src.tenants import get_profile
+from src.validate import compile_checks
+
+# Invoice shapes to benchmark, passed to generate_invoice.
+SHAPES = {
+    'full': {},
+    'minimal': {'supplier_tax_scheme': False, 'customer_tax_scheme': False, 'delivery': False, 'website_uri': False},
+}
+
+# Kbo number of the customer, None for the one of the default tenant profile.
+KBO_NUMBER = None
+
+
+def measure(function, prepare, repeat):
+    """
+    Time a function.
+    :param function: Function taking the prepared value.
+    :param prepare: Function returning a fresh input, not timed.
+    :param repeat: The number of runs.
+    :return: The median time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        value = prepare()
+        start = time.perf_counter()
+        function(value)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def peak_memory(function, prepare):
+    """
+    Measure the peak memory allocated by a function.
+    :param function: Function taking the prepared value.
+    :param prepare: Function returning a fresh input, not measured.
+    :return: The peak in bytes.
+    """
+    value = prepare()
+    tracemalloc.start()
+    try:
+        function(value)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure_rules(data, repeat, backend):
+    """
+    Time every conversion rule within create_invoice_elementtree.
+    :param data: The invoice xml in bytes.
+    :param repeat: The number of runs.
+    :param backend: The XML backend to parse with.
+    :return: Dict of 'rule:<name>' -> the median time in seconds spent in the rule per document.
+    """
+    runs = []
+    for _ in range(repeat):
+        invoice = backend.fromstring(data)
+        observe, totals = rule_timer()
+        create_invoice_elementtree(invoice, KBO_NUMBER, observe)
+        runs.append(totals)
+    rules = dict.fromkeys(rule for totals in runs for rule in totals)
+    return {'rule:' + rule: statistics.median(totals.get(rule, 0.0) for totals in runs) for rule in rules}
+
+
+def bench_case(data, repeat, backend):
+    """
+    Benchmark reading, the full conversion and every rule within it, serialization and validation of one invoice.
+    :param data: The invoice xml in bytes.
+    :param repeat: The number of runs per measurement.
+    :param backend: The XML backend to parse and serialize with.
+    :return: Dict of stage -> {'seconds', 'docs_per_sec', 'mb_per_sec'}, plus 'peak_bytes' and 'model_peak_bytes' for
+             the whole pipeline of both engines and 'output_bytes'.
+    """
+    results = {}
+    with tempfile.NamedTemporaryFile(suffix='.xml', delete=False) as f:
+        f.write(data)
+    try:
+        results['read_xml'] = measure(backend.parse, lambda: f.name, repeat)
+    finally:
+        os.remove(f.name)
+    results['create_invoice_elementtree'] = measure(lambda invoice: create_invoice_elementtree(
+        invoice, KBO_NUMBER), lambda: backend.fromstring(data), repeat)
+    results.update(measure_rules(data, repeat, backend))
+    converted = create_invoice_elementtree(backend.fromstring(data), KBO_NUMBER)
+    results['serialize'] = measure(backend.tostring, lambda: converted, repeat)
+    results['serialize_ubl'] = measure(serialize, lambda: converted, repeat)
+    results['validate'] = measure(compile_checks().validate, lambda: converted, repeat)
+    report = {name: {'seconds': seconds, 'docs_per_sec': 1 / seconds if seconds else 0.0,
+                     'mb_per_sec': len(data) / seconds / 1e6 if seconds else 0.0}
+              for name, seconds in results.items()}
+
+    def pipeline(value):
+        invoice = create_invoice_elementtree(backend.fromstring(value), KBO_NUMBER)
+        return serialize(invoice)
+    report['peak_bytes'] = peak_memory(pipeline, lambda: data)
+    report['output_bytes'] = len(serialize(converted))
+
+    # The model engine (src/model.py): reading a parsed tree, parsing and reading in one pass, writing the peppol xml.
+    params = model_params(get_profile(), KBO_NUMBER)
+    model = parse_invoice(data, params, backend=backend)
+    for name, seconds in (
+            ('model_extract', measure(lambda root: extract_invoice(root, params), lambda: backend.fromstring(data),
+                                      repeat)),
+            ('model_parse', measure(lambda value: parse_invoice(value, params, backend=backend), lambda: data, repeat)),
+            ('model_emit', measure(emit_invoice, lambda: model, repeat))):
+        report[name] = {'seconds': seconds, 'docs_per_sec': 1 / seconds if seconds else 0.0,
+                        'mb_per_sec': len(data) / seconds / 1e6 if seconds else 0.0}
+    report['model_peak_bytes'] = peak_memory(lambda value: emit_invoice(parse_invoice(value, params, backend=backend)),
+                                             lambda: data)
+    return report
+
+
+def run(line_counts, shapes, repeat, backends=('stdlib',)):
+    """
+    Run the benchmark for every shape, line count and XML backend.
+    :param line_counts: List of numbers of invoice lines.
+    :param shapes: List of names in SHAPES.
+    :param repeat: The number of runs per measurement.
+    :param backends: List of XML backend names, every backend converts the same input.
+    :return: Dict of case name -> case report, case names look like 'full-100-stdlib'.
+    """
+    report = {}
+    for shape in shapes:
+        for lines in line_counts:
+            data = generate_invoice(lines, **SHAPES[shape])
+            for backend in backends:
+                case = bench_case(data, repeat, get_backend(backend))
+                case['input_bytes'] = len(data)
+                report['%s-%d-%s' % (shape, lines, backend)] = case
+    return report
+
+
+def format_report(report):
+    """
+    Format a benchmark report as a table.
+    :param report: The report returned by run.
+    :return: The table as text.
+    """
+    lines = []
+    for case, stages in report.items():
+        lines.append('%s (%.1f KB -> %.1f KB, peak %.1f MB, model engine peak %.1f MB)' % (
+            case, stages['input_bytes'] / 1e3, stages['output_bytes'] / 1e3, stages['peak_bytes'] / 1e6,
+            stages['model_peak_bytes'] / 1e6))
+        for name, result in stages.items():
+            if isinstance(result, dict):
+                lines.append('  %-50s %10.3f ms %10.1f docs/s %8.2f MB/s' % (
+                    name, result['seconds'] * 1e3, result['docs_per_sec'], result['mb_per_sec']))
+    return '\n'.join(lines)
+
+
+def format_speedup(report, reference='stdlib'):
+    """
+    Format the speedup of every backend over a reference backend on the same input as a table.
+    :param report: The report returned by run.
+    :param reference: The name of the reference backend.
+    :return: The table as text, empty when only one backend ran.
+    """
+    lines = []
+    for case, stages in report.items():
+        base, backend = case.rsplit('-', 1)
+        reference_stages = report.get('%s-%s' % (base, reference))
+        if backend == reference or reference_stages is None:
+            continue
+        lines.append('%s: %s vs %s' % (base, backend, reference))
+        for name, result in stages.items():
+            if isinstance(result, dict) and result['seconds']:
+                lines.append('  %-50s %8.2fx' % (name, reference_stages[name]['seconds'] / result['seconds']))
+    return '\n'.join(lines)
+
+
+def compare(report, baseline, tolerance):
+    """
+    Compare a report with a saved baseline.
+    :param report: The report returned by run.
+    :param baseline: A previously saved report.
+    :param tolerance: Allowed relative slowdown (time) or growth (peak memory), e.g. 0.25 for 25%.
+    :return: List of regression messages.
+    """
+    regressions = []
+    for case, stages in report.items():
+        for name, result in stages.items():
+            previous = baseline.get(case, {}).get(name)
+            if previous is None:
+                continue
+            if isinstance(result, dict):
+                current, previous, unit = result['seconds'], previous['seconds'], 's'
+            elif name in ('peak_bytes', 'model_peak_bytes'):
+                current, unit = result, 'B'
+            else:
+                continue
+            if previous and current > previous * (1 + tolerance):
+                regressions.append('%s %s: %.6g%s -> %.6g%s (+%.0f%%)' % (
+                    case, name, previous, unit, current, unit, (current / previous - 1) * 100))
+    return regressions
+
+
+def main(argv=None):
+    """
+    Run the benchmark suite.
+    :param argv: The arguments, defaults to sys.argv.
+    :return: The exit code, 1 when a result regressed past the baseline.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the peppol converter on generated invoices.')
+    parser.add_argument('--lines', type=int, nargs='+', default=[1, 100, 1000], help='invoice line counts')
+    parser.add_argument('--shapes', nargs='+', default=list(SHAPES), choices=list(SHAPES), help='invoice shapes')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the median is reported')
+    parser.add_argument('--baseline', default=None, help='fail when results regress past this saved report')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    parser.add_argument('--save', default=None, help='save the report (json) to use as a baseline later')
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS),
+                        help='XML backends to compare on the same input')
+    args = parser.parse_args(argv)
+    report = run(args.lines, args.shapes, args.repeat, args.backends)
+    print(format_report(report))
+    speedup = format_speedup(report)
+    if speedup:
+        print(speedup)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,388 @@
+import argparse
+import http.client
+import json
+import os
+import queue
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from src.generate import generate_invoice
+
+# A gunicorn configuration to load test, see parse_config.
+ServerConfig = namedtuple('ServerConfig', 'workers threads worker_class')
+# One request: latency in seconds (from the scheduled start under a target rate), http status or None on a connection
+# error, and the number of uploaded bytes.
+Sample = namedtuple('Sample', 'latency status size')
+
+DEFAULT_CONFIG = 'workers=2,threads=1,worker_class=sync'
+# Seconds to wait for gunicorn to answer after starting it.
+START_TIMEOUT = 60
+# Seconds between two samples of the memory of the workers.
+RSS_INTERVAL = 0.5
+
+
+def parse_config(text):
+    """
+    Parse a server configuration.
+    :param text: Comma separated key=value pairs, e.g. 'workers=4,threads=2,worker_class=gthread', missing keys are
+                 taken from DEFAULT_CONFIG.
+    :return: The ServerConfig.
+    """
+    values = dict(pair.split('=', 1) for pair in DEFAULT_CONFIG.split(','))
+    for pair in filter(None, text.split(',')):
+        key, _, value = pair.partition('=')
+        if key not in ServerConfig._fields:
+            raise argparse.ArgumentTypeError('unknown setting %r, use %s' % (key, ', '.join(ServerConfig._fields)))
+        values[key] = value
+    return ServerConfig(int(values['workers']), int(values['threads']), values['worker_class'])
+
+
+def format_config(config):
+    """
+    :param config: The ServerConfig.
+    :return: Short name of the configuration, e.g. '4w x 2t gthread'.
+    """
+    return '%dw x %dt %s' % config
+
+
+def load_corpus(directory=None, lines=(1, 10, 100), invoices=8):
+    """
+    Load the invoices to upload.
+    :param directory: Directory of xml files to use instead of generated invoices.
+    :param lines: Invoice line counts of the generated invoices.
+    :param invoices: Number of generated invoices per line count.
+    :return: List of invoices in bytes.
+    """
+    if directory is not None:
+        corpus = []
+        for name in sorted(os.listdir(directory)):
+            if name.lower().endswith('.xml'):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    corpus.append(f.read())
+        return corpus
+    return [generate_invoice(count, seed=seed) for count in lines for seed in range(invoices)]
+
+
+def multipart_body(data, boundary):
+    """
+    Encode an invoice as the multipart form /uploader expects.
+    :param data: The invoice in bytes.
+    :param boundary: The multipart boundary.
+    :return: The request body in bytes.
+    """
+    return b''.join((b'--', boundary, b'\r\nContent-Disposition: form-data; name="file"; filename="invoice.xml"\r\n'
+                     b'Content-Type: text/xml\r\n\r\n', data, b'\r\n--', boundary, b'--\r\n'))
+
+
+def worker_pids(master_pid):
+    """
+    Find the worker processes of a gunicorn master through /proc.
+    :param master_pid: The pid of the master.
+    :return: List of pids, empty when /proc is not available.
+    """
+    pids = []
+    for name in os.listdir('/proc') if os.path.isdir('/proc') else ():
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                # The parent pid is the second field after the parenthesized command name.
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == master_pid:
+            pids.append(int(name))
+    return pids
+
+
+def rss_bytes(pid):
+    """
+    :param pid: A process id.
+    :return: The resident set size of the process in bytes, None when it is gone.
+    """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class Server:
+    """
+    The application under gunicorn in a child process, on a free local port.
+    """
+
+    def __init__(self, config, env=None):
+        """
+        :param config: The ServerConfig.
+        :param env: Extra environment variables of the server, e.g. {'XML_BACKEND': 'lxml'}.
+        """
+        self.config = config
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        # Keep the job database of the server out of the project.
+        self.directory = tempfile.TemporaryDirectory()
+        environment = dict(os.environ, JOB_DB=os.path.join(self.directory.name, 'jobs.sqlite3'), **(env or {}))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '__init__:app', '--bind', '127.0.0.1:%d' % self.port,
+             '--workers', str(config.workers), '--threads', str(config.threads),
+             '--worker-class', config.worker_class, '--timeout', '120', '--log-level', 'warning'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=environment)
+        self.wait_ready()
+
+    def wait_ready(self):
+        """
+        Wait until every worker answers requests.
+        """
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('gunicorn exited with code %d' % self.process.returncode)
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+                connection.request('GET', '/cache')
+                ready = connection.getresponse().status == 200
+                connection.close()
+            except OSError:
+                ready = False
+            if ready and len(worker_pids(self.process.pid)) >= self.config.workers:
+                return
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError('gunicorn did not answer within %d seconds' % START_TIMEOUT)
+
+    def stop(self):
+        """
+        Stop gunicorn and its workers.
+        """
+        self.process.terminate()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.directory.cleanup()
+
+
+class RssSampler(threading.Thread):
+    """
+    Samples the resident memory of the workers of a gunicorn master, keeping the peak per worker.
+    """
+
+    def __init__(self, master_pid):
+        """
+        :param master_pid: The pid of the gunicorn master.
+        """
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.peaks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for pid in worker_pids(self.master_pid):
+                rss = rss_bytes(pid)
+                if rss is not None:
+                    self.peaks[pid] = max(self.peaks.get(pid, 0), rss)
+            self.stopped.wait(RSS_INTERVAL)
+
+
+def run_load(host, port, corpus, duration, concurrency, rate=None, unique=True):
+    """
+    Upload invoices to /uploader for a while.
+    :param host: The host of the server.
+    :param port: The port of the server.
+    :param corpus: List of invoices in bytes, uploaded round robin.
+    :param duration: Seconds to keep sending requests.
+    :param concurrency: Number of client connections, the maximum number of requests in flight.
+    :param rate: Requests per second to start, None to send the next request as soon as a connection is free.
+    :param unique: Make every upload unique so the conversion cache of the server never answers it.
+    :return: Tuple (list of Sample, seconds the run took).
+    """
+    boundary = uuid.uuid4().hex.encode('ascii')
+    samples = []
+    counter = iter(range(sys.maxsize))
+    lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration
+    # Under a target rate the requests are scheduled up front and latency counts from the scheduled start, so a slow
+    # server is not hidden by requests that could not even be sent on time.
+    schedule = queue.Queue() if rate else None
+
+    def next_request():
+        with lock:
+            number = next(counter)
+        data = corpus[number % len(corpus)]
+        if unique:
+            # A comment after the root changes the hash of the upload but not its conversion.
+            data += b'<!-- load test %d -->' % number
+        return multipart_body(data, boundary), len(data)
+
+    def client():
+        connection = http.client.HTTPConnection(host, port, timeout=120)
+        while True:
+            if schedule is not None:
+                scheduled = schedule.get()
+                if scheduled is None:
+                    break
+                time.sleep(max(0.0, scheduled - time.perf_counter()))
+            else:
+                scheduled = time.perf_counter()
+                if scheduled >= deadline:
+                    break
+            body, size = next_request()
+            status = None
+            try:
+                connection.request('POST', '/uploader', body, {
+                    'Content-Type': 'multipart/form-data; boundary=' + boundary.decode('ascii')})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=120)
+            with lock:
+                samples.append(Sample(time.perf_counter() - scheduled, status, size))
+        connection.close()
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    if schedule is not None:
+        for number in range(int(duration * rate)):
+            schedule.put(start + number / rate)
+        for _ in threads:
+            schedule.put(None)
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+
+def summarize(samples, seconds):
+    """
+    Summarize the samples of a run.
+    :param samples: List of Sample.
+    :param seconds: The duration of the run.
+    :return: Dict with requests, errors, error_rate, requests_per_sec, mb_per_sec and p50/p95/p99 latency in ms.
+    """
+    latencies = sorted(sample.latency for sample in samples)
+    errors = sum(1 for sample in samples if sample.status != 200)
+    summary = {'requests': len(samples), 'errors': errors, 'error_rate': errors / len(samples) if samples else 0.0,
+               'requests_per_sec': len(samples) / seconds,
+               'mb_per_sec': sum(sample.size for sample in samples) / seconds / 1e6}
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+        summary.update(p50_ms=percentiles[49] * 1e3, p95_ms=percentiles[94] * 1e3, p99_ms=percentiles[98] * 1e3)
+    else:
+        summary.update(p50_ms=None, p95_ms=None, p99_ms=None)
+    return summary
+
+
+def run_config(config, corpus, duration, concurrency, rate=None, unique=True, warmup=2.0, env=None):
+    """
+    Load test the application under one gunicorn configuration.
+    :param config: The ServerConfig.
+    :param corpus: List of invoices in bytes.
+    :param duration: Seconds to measure.
+    :param concurrency: Number of client connections.
+    :param rate: Target requests per second or None for as fast as possible.
+    :param unique: Make every upload unique so the conversion cache never answers it.
+    :param warmup: Seconds of requests sent first and not measured.
+    :param env: Extra environment variables of the server.
+    :return: Dict with the configuration, the summary of the run and the peak memory of the workers.
+    """
+    server = Server(config, env)
+    try:
+        if warmup:
+            run_load('127.0.0.1', server.port, corpus, warmup, concurrency, None, unique)
+        sampler = RssSampler(server.process.pid)
+        sampler.start()
+        samples, seconds = run_load('127.0.0.1', server.port, corpus, duration, concurrency, rate, unique)
+        sampler.stopped.set()
+        sampler.join()
+    finally:
+        server.stop()
+    result = {'config': config._asdict(), 'concurrency': concurrency, 'rate': rate}
+    result.update(summarize(samples, seconds))
+    peaks = sorted(sampler.peaks.values())
+    result['worker_rss_mb'] = [peak / 1e6 for peak in peaks]
+    result['total_rss_mb'] = sum(peaks) / 1e6
+    return result
+
+
+def format_table(results):
+    """
+    Format the results of several configurations as a capacity planning table.
+    :param results: List of results returned by run_config.
+    :return: The table as text.
+    """
+    lines = ['%-22s %7s %8s %8s %8s %8s %8s %7s %12s %10s' % (
+        'config', 'clients', 'req/s', 'MB/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'RSS/worker', 'RSS total')]
+    for result in results:
+        config = ServerConfig(**result['config'])
+        rss = result['worker_rss_mb']
+        lines.append('%-22s %7d %8.1f %8.2f %8s %8s %8s %6.2f%% %9.1f MB %7.1f MB' % (
+            format_config(config), result['concurrency'], result['requests_per_sec'], result['mb_per_sec'],
+            format_ms(result['p50_ms']), format_ms(result['p95_ms']), format_ms(result['p99_ms']),
+            result['error_rate'] * 100, max(rss) if rss else 0.0, result['total_rss_mb']))
+    return '\n'.join(lines)
+
+
+def format_ms(value):
+    """
+    :param value: Milliseconds or None.
+    :return: The value with one decimal, '-' for None.
+    """
+    return '-' if value is None else '%.1f' % value
+
+
+def main(argv=None):
+    """
+    Load test /uploader under one or more gunicorn configurations.
+    :param argv: The arguments, defaults to sys.argv.
+    :return: The exit code.
+    """
+    parser = argparse.ArgumentParser(description='Load test the converter under gunicorn for capacity planning.')
+    parser.add_argument('--config', type=parse_config, action='append', default=None,
+                        help="gunicorn configuration, repeat to compare, e.g. 'workers=4,threads=2,worker_class=gthread'"
+                             " (default %s)" % DEFAULT_CONFIG)
+    parser.add_argument('--concurrency', type=int, default=8, help='number of client connections')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='target requests per second, default as fast as possible')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to measure per configuration')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds of requests before measuring')
+    parser.add_argument('--lines', type=int, nargs='+', default=[1, 10, 100], help='line counts of the corpus')
+    parser.add_argument('--corpus', default=None, help='directory of xml files to upload instead of generated ones')
+    parser.add_argument('--allow-cache', action='store_true',
+                        help='upload the corpus as is, so the conversion cache answers repeated files')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='environment variable of the server, e.g. XML_BACKEND=stdlib')
+    parser.add_argument('--save', default=None, help='save the results (json)')
+    args = parser.parse_args(argv)
+    corpus = load_corpus(args.corpus, args.lines)
+    env = dict(pair.split('=', 1) for pair in args.env)
+    results = []
+    for config in args.config or [parse_config('')]:
+        print('Load testing %s ...' % format_config(config), file=sys.stderr)
+        results.append(run_config(config, corpus, args.duration, args.concurrency, args.rate,
+                                  not args.allow_cache, args.warmup, env))
+    print(format_table(results))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(result['errors'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,24 +1,72 @@
+import argparse
+
 from src.io import *
 from src.convert import *
+from src.batch import run_batch, format_summary
+from src.model import get_engine
+from src.tenants import get_profile
 
 
-def convert_xml(file_name, kbo_number):
+def convert_xml(file_name, kbo_number, output_file_name=None):
     """
     Reads, converts and writes an XML file to a XML file that adheres peppol rules.
+    :param file_name: The path of the invoice xml.
+    :param kbo_number: The kbo number of the customer.
+    :param output_file_name: The path to write to, defaults to overwriting file_name.
     """
     xml = read_xml(file_name)
     converted = convert_xml_to_peppol(xml, kbo_number)
-    write_xml(xml, file_name)
+    write_xml(output_file_name or file_name, converted)
 
 
 def convert_xml_to_peppol(xml, kbo_number):
     """
     Converts an XML file to a XML file that adheres peppol rules.
     """
-    return xml
+    return create_invoice_elementtree(xml, kbo_number)
+
+
+def parse_args(argv=None):
+    """
+    Parse the command line arguments of the batch converter.
+    :param argv: The arguments, defaults to sys.argv.
+    :return: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description='Convert UBL 2.1 invoices to peppol in batch.')
+    parser.add_argument('inputs', nargs='+', help='xml files, directories, glob patterns or zip archives')
+    parser.add_argument('-o', '--output', required=True, help='output directory, or a .zip file')
+    parser.add_argument('--kbo', default=None, help='kbo number of the customer, defaults to the one of the tenant')
+    parser.add_argument('--tenant', default=None,
+                        help='convert with the profile tenants/TENANT.json (see TENANT_DIR), defaults to default.json')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=8, help='files handed to a worker at a time')
+    parser.add_argument('--stream', action='store_true', help='use the streaming engine for plain files')
+    parser.add_argument('--report', default=None, help='write the per-file failure report (json) here')
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help='save a cpu (cProfile) and memory (tracemalloc) profile of every conversion here')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Run the batch converter.
+    :param argv: The arguments, defaults to sys.argv.
+    :return: The exit code.
+    """
+    args = parse_args(argv)
+    # Fail once up front instead of for every file when the profile is missing or invalid, or the CONVERT_ENGINE
+    # environment variable names an unknown engine.
+    try:
+        get_profile(args.tenant)
+        get_engine()
+    except ValueError as error:
+        print(error)
+        return 2
+    summary = run_batch(args.inputs, args.output, args.kbo, workers=args.workers, chunksize=args.chunksize,
+                        stream=args.stream, report=args.report, profile_dir=args.profile, tenant=args.tenant)
+    print(format_summary(summary))
+    return 1 if summary['failed'] else 0
 
 
-xml = read_xml("UBL-Invoice-2.1 (11).xml")
-create_invoice_elementtree(xml, "0478693713")
-# Write the XML to a file
-write_xml("test.xml",xml)
\ No newline at end of file
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,182 @@
+import collections
+import contextlib
+import os
+import threading
+import time
+
+from src.metrics import REGISTRY
+
+# Largest accepted upload body.
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+# Bytes of uploads converted at the same time by one worker process, a conversion holds a multiple of its input.
+DEFAULT_BUDGET_BYTES = 64 * 1024 * 1024
+# Smallest share of the budget an upload takes, so the number of small conversions at a time is bounded as well.
+DEFAULT_MIN_WEIGHT = 1024 * 1024
+# Uploads waiting for a share of the budget at most, more are rejected right away.
+DEFAULT_MAX_QUEUE = 16
+# Seconds an upload waits for a share of the budget at most.
+DEFAULT_MAX_WAIT = 10.0
+# Seconds a rejected client is asked to wait before retrying.
+DEFAULT_RETRY_AFTER = 5
+
+
+class Rejected(Exception):
+    """
+    An upload was not admitted. Not a ValueError, so the form parser does not swallow it while reading the body.
+    """
+
+    def __init__(self, reason, retry_after=None):
+        """
+        :param reason: 'too_large', 'queue_full' or 'timeout'.
+        :param retry_after: Seconds the client should wait before retrying, None when retrying does not help.
+        """
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class LimitedInput:
+    """
+    Wrapper of a request body of unknown length (chunked transfer encoding) that is cut off once it passes the
+    maximum size, instead of being read to the end first.
+    """
+
+    def __init__(self, stream, limit, reject):
+        """
+        :param stream: The wsgi input stream.
+        :param limit: The maximum number of bytes.
+        :param reject: Function called without arguments once the limit is passed, raises the rejection.
+        """
+        self._stream = stream
+        self._limit = limit
+        self._reject = reject
+        self._read = 0
+
+    def _count(self, data):
+        self._read += len(data)
+        if self._read > self._limit:
+            self._reject()
+        return data
+
+    def read(self, size=-1):
+        return self._count(self._stream.read(size))
+
+    def readline(self, size=-1):
+        return self._count(self._stream.readline(size))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+class AdmissionController:
+    """
+    Admission control of the conversions of one worker process: uploads take a share of a budget of bytes weighted by
+    their size, wait for it in a bounded first-come first-served queue and are rejected when the queue is full or
+    they waited too long, so a burst of (large) uploads is answered quickly instead of slowing down every request or
+    running out of memory.
+    """
+
+    def __init__(self, max_bytes=None, budget=None, min_weight=None, max_queue=None, max_wait=None, retry_after=None):
+        """
+        :param max_bytes: Largest accepted upload, defaults to the MAX_UPLOAD_BYTES environment variable.
+        :param budget: Bytes converted at a time, defaults to the ADMISSION_BYTES environment variable.
+        :param min_weight: Smallest share of an upload, defaults to the ADMISSION_MIN_BYTES environment variable.
+        :param max_queue: Uploads waiting at most, defaults to the ADMISSION_QUEUE environment variable.
+        :param max_wait: Seconds an upload waits at most, defaults to the ADMISSION_WAIT environment variable.
+        :param retry_after: Seconds a rejected client should wait, defaults to the ADMISSION_RETRY_AFTER environment
+                            variable.
+        """
+        environ = os.environ
+        self.max_bytes = max_bytes or int(environ.get('MAX_UPLOAD_BYTES', 0)) or DEFAULT_MAX_BYTES
+        self.budget = budget or int(environ.get('ADMISSION_BYTES', 0)) or DEFAULT_BUDGET_BYTES
+        self.min_weight = min_weight or int(environ.get('ADMISSION_MIN_BYTES', 0)) or DEFAULT_MIN_WEIGHT
+        self.max_queue = max_queue if max_queue is not None else int(environ.get('ADMISSION_QUEUE', DEFAULT_MAX_QUEUE))
+        self.max_wait = max_wait or float(environ.get('ADMISSION_WAIT', 0)) or DEFAULT_MAX_WAIT
+        self.retry_after = retry_after or int(environ.get('ADMISSION_RETRY_AFTER', 0)) or DEFAULT_RETRY_AFTER
+        self._condition = threading.Condition()
+        self._available = self.budget
+        # Tickets of the waiting uploads, in order of arrival.
+        self._waiting = collections.deque()
+
+    def reject(self, reason):
+        """
+        Count and raise a rejection.
+        :param reason: 'too_large', 'queue_full' or 'timeout'.
+        :raise Rejected: Always.
+        """
+        REGISTRY.inc('peppol_admission_rejections_total', reason=reason)
+        raise Rejected(reason, None if reason == 'too_large' else self.retry_after)
+
+    def check_size(self, size):
+        """
+        Reject an upload that declares a body larger than max_bytes, before it is read.
+        :param size: The content length of the upload, None when unknown.
+        :raise Rejected: When the upload is too large.
+        """
+        if size is not None and size > self.max_bytes:
+            self.reject('too_large')
+
+    def limit(self, stream):
+        """
+        Cut off a body of unknown length once it passes max_bytes.
+        :param stream: The input stream.
+        :return: The LimitedInput.
+        """
+        return LimitedInput(stream, self.max_bytes, lambda: self.reject('too_large'))
+
+    def weight(self, size):
+        """
+        :param size: The content length of an upload, None when unknown.
+        :return: The share of the budget the upload takes, the whole budget at most so any upload fits on its own.
+        """
+        return min(max(self.max_bytes if size is None else size, self.min_weight), self.budget)
+
+    @contextlib.contextmanager
+    def admit(self, size):
+        """
+        Hold a share of the budget while converting an upload, waiting in the queue while the budget is used up.
+        :param size: The content length of the upload, None when unknown.
+        :raise Rejected: When the upload is too large, the queue is full or it waited max_wait seconds.
+        """
+        self.check_size(size)
+        weight = self.weight(size)
+        with self._condition:
+            if self._waiting or self._available < weight:
+                self._wait(weight)
+            self._available -= weight
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._available += weight
+                self._condition.notify_all()
+
+    def _wait(self, weight):
+        """
+        Wait until an upload is first in the queue and its share is available, called holding the condition.
+        :param weight: The share of the upload.
+        :raise Rejected: When the queue is full or the upload waited max_wait seconds.
+        """
+        if len(self._waiting) >= self.max_queue:
+            self.reject('queue_full')
+        ticket = object()
+        self._waiting.append(ticket)
+        REGISTRY.inc('peppol_admission_queued_total')
+        start = time.monotonic()
+        outcome = 'admitted'
+        try:
+            # First come, first served: a large upload is not passed by a stream of small ones.
+            while self._waiting[0] is not ticket or self._available < weight:
+                remaining = start + self.max_wait - time.monotonic()
+                if remaining <= 0:
+                    outcome = 'timeout'
+                    break
+                self._condition.wait(remaining)
+        finally:
+            self._waiting.remove(ticket)
+            # The next upload may be first now.
+            self._condition.notify_all()
+            REGISTRY.inc('peppol_admission_dequeued_total', outcome=outcome)
+            REGISTRY.observe('peppol_admission_wait_seconds', time.monotonic() - start)
+        if outcome == 'timeout':
+            self.reject('timeout')
@@ -0,0 +1,187 @@
+import functools
+import os
+import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+class StdlibBackend:
+    """
+    XML backend on top of xml.etree.ElementTree.
+    """
+    name = 'stdlib'
+
+    def fromstring(self, data):
+        """
+        Parse a document.
+        :param data: The xml in bytes.
+        :return: The root element.
+        """
+        return ET.fromstring(data)
+
+    def parse(self, source):
+        """
+        Parse a document from a file.
+        :param source: A file path or a binary file object.
+        :return: The root element.
+        """
+        return ET.parse(source).getroot()
+
+    def tostring(self, element, xml_declaration=True):
+        """
+        Serialize an element.
+        :param element: The element.
+        :param xml_declaration: Start with an xml declaration.
+        :return: The utf-8 encoded xml.
+        """
+        return ET.tostring(element, encoding='utf-8', xml_declaration=xml_declaration)
+
+    def write(self, element, target, xml_declaration=True):
+        """
+        Serialize an element to a file.
+        :param element: The element.
+        :param target: A file path or a binary file object.
+        :param xml_declaration: Start with an xml declaration.
+        """
+        ET.ElementTree(element).write(target, xml_declaration=xml_declaration, encoding='utf-8')
+
+    def pull_parser(self):
+        """
+        :return: An incremental parser reporting 'start' and 'end' events.
+        """
+        return ET.XMLPullParser(events=('start', 'end'))
+
+    def shallow_copy(self, element):
+        """
+        Create an empty element with the tag, attributes and namespace declarations of another one.
+        :param element: The element to copy.
+        :return: The new element.
+        """
+        copy = element.makeelement(element.tag, dict(element.attrib))
+        copy.text = element.text
+        return copy
+
+    def findall(self, element, path):
+        """
+        Find all elements at an ElementPath.
+        :param element: The element to search in.
+        :param path: The ElementPath, e.g. '{ns}InvoiceLine'.
+        :return: List of elements.
+        """
+        return element.findall(path)
+
+
+class LxmlBackend(StdlibBackend):
+    """
+    XML backend on top of lxml, parsing and serializing in C and with compiled lookups.
+    """
+    name = 'lxml'
+
+    def __init__(self):
+        # Never resolve entities or fetch anything from the network while parsing uploads. libxml2 keeps its limits on
+        # the depth and the length of a single text node or name (no huge_tree), large documents are not affected.
+        self.parser = lxml_etree.XMLParser(resolve_entities=False, no_network=True)
+
+    def fromstring(self, data):
+        try:
+            return lxml_etree.fromstring(data, self.parser)
+        except lxml_etree.XMLSyntaxError as error:
+            raise parse_error(error) from None
+
+    def parse(self, source):
+        try:
+            return lxml_etree.parse(source, self.parser).getroot()
+        except lxml_etree.XMLSyntaxError as error:
+            raise parse_error(error) from None
+
+    def tostring(self, element, xml_declaration=True):
+        return lxml_etree.tostring(element, encoding='utf-8', xml_declaration=xml_declaration)
+
+    def write(self, element, target, xml_declaration=True):
+        lxml_etree.ElementTree(element).write(target, xml_declaration=xml_declaration, encoding='utf-8')
+
+    def pull_parser(self):
+        return LxmlPullParser(events=('start', 'end'), resolve_entities=False, no_network=True)
+
+    def shallow_copy(self, element):
+        copy = element.makeelement(element.tag, dict(element.attrib), nsmap=element.nsmap)
+        copy.text = element.text
+        return copy
+
+    def findall(self, element, path):
+        return compiled_path(path)(element)
+
+
+if lxml_etree is not None:
+    class LxmlPullParser(lxml_etree.XMLPullParser):
+        """
+        lxml pull parser raising the same errors as the stdlib one.
+        """
+
+        def feed(self, data):
+            try:
+                super().feed(data)
+            except lxml_etree.XMLSyntaxError as error:
+                raise parse_error(error) from None
+
+        def close(self):
+            try:
+                return super().close()
+            except lxml_etree.XMLSyntaxError as error:
+                raise parse_error(error) from None
+
+
+def parse_error(error):
+    """
+    Turn an lxml syntax error into the stdlib ParseError, so callers handle one exception type for both backends and
+    the error can be pickled back from worker processes.
+    :param error: The lxml XMLSyntaxError.
+    :return: The ParseError.
+    """
+    converted = ET.ParseError(str(error))
+    converted.code = error.code
+    converted.position = error.position
+    return converted
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_path(path):
+    """
+    Compile an ElementPath into an lxml path, cached per path.
+    :param path: The ElementPath.
+    :return: The compiled path, call it with an element.
+    """
+    return lxml_etree.ETXPath(path)
+
+
+BACKENDS = {'stdlib': StdlibBackend}
+if lxml_etree is not None:
+    BACKENDS['lxml'] = LxmlBackend
+
+
+def backend_of(element):
+    """
+    Get the XML backend an element belongs to.
+    :param element: The element.
+    :return: The backend.
+    """
+    if lxml_etree is not None and isinstance(element, lxml_etree._Element):
+        return get_backend('lxml')
+    return get_backend('stdlib')
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(name=None):
+    """
+    Get an XML backend.
+    :param name: 'lxml', 'stdlib' or None for the XML_BACKEND environment variable, falling back to lxml when it is
+                 installed and the stdlib otherwise.
+    :return: The backend.
+    """
+    name = name or os.environ.get('XML_BACKEND') or ('lxml' if 'lxml' in BACKENDS else 'stdlib')
+    if name not in BACKENDS:
+        raise ValueError('XML backend %r is not available, choose from %s' % (name, ', '.join(BACKENDS)))
+    return BACKENDS[name]()
@@ -0,0 +1,367 @@
+import glob
+import json
+import multiprocessing
+import ntpath
+import os
+import posixpath
+import shutil
+import time
+import zipfile
+
+from src.backend import get_backend
+from src.convert import CAC, create_invoice_elementtree
+from src.decompress import XML_SUFFIXES, open_plain, parse_plain, read_plain
+from src.metrics import REGISTRY, rule_timer
+from src.model import Unmodelled, emit_invoice, get_engine, model_params, parse_invoice
+from src.profiling import profile_call
+from src.serialize import serialize
+from src.sniff import COMPLIANT, SNIFF_BYTES, UnsupportedDocument, sniff_document
+from src.stream import CHUNK_SIZE, convert_stream
+from src.tenants import get_profile
+from src.validate import compile_checks
+
+# Zip archives opened by the current worker process, keyed by path.
+_open_archives = {}
+
+
+def collect_inputs(paths):
+    """
+    Expand directories, glob patterns and zip archives into conversion tasks.
+    :param paths: List of file paths, directories, glob patterns or zip archives.
+    :return: Generator of (archive, name) tuples, archive is None for plain files.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for file_name in sorted(files):
+                    if file_name.lower().endswith(XML_SUFFIXES):
+                        yield None, os.path.join(root, file_name)
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                for member in archive.namelist():
+                    if member.lower().endswith(XML_SUFFIXES):
+                        yield path, member
+        elif os.path.isfile(path):
+            yield None, path
+        else:
+            for match in sorted(glob.glob(path, recursive=True)):
+                yield from collect_inputs([match])
+
+
+def output_name(archive, name, used):
+    """
+    Get a unique name of the converted file for a task.
+    :param archive: The zip archive of the task or None.
+    :param name: The file path or archive member of the task.
+    :param used: Set of the output names given out so far, updated in place.
+    :return: The relative output name.
+    """
+    if archive is None:
+        output = os.path.basename(name)
+    else:
+        # Members keep their folders but never leave the output, drop drives, absolute paths and parent references.
+        member = posixpath.normpath(ntpath.splitdrive(name.replace('\\', '/'))[1])
+        output = '/'.join(part for part in member.split('/') if part not in ('', '.', '..'))
+        if not output:
+            output = 'document.xml'
+    # The converted document is written as plain xml.
+    if output.lower().endswith(XML_SUFFIXES[1:]):
+        output = output[:output.lower().rindex('.xml') + 4]
+    base, extension = os.path.splitext(output)
+    counter = 1
+    while output in used:
+        counter += 1
+        output = '%s-%d%s' % (base, counter, extension)
+    used.add(output)
+    return output
+
+
+def read_task(archive, name):
+    """
+    Read the bytes of a task.
+    :param archive: The zip archive of the task or None.
+    :param name: The file path or archive member of the task.
+    :return: The bytes of the input file.
+    """
+    if archive is None:
+        with open(name, 'rb') as f:
+            return f.read()
+    if archive not in _open_archives:
+        _open_archives[archive] = zipfile.ZipFile(archive)
+    return _open_archives[archive].read(name)
+
+
+def sniff(data, backend=None):
+    """
+    Classify the bytes of a document before converting it, recording the stage metrics.
+    :param data: The document in bytes, may be compressed, only its first SNIFF_BYTES are read (decompressed).
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :return: COMPLIANT or CONVERTIBLE, see sniff_document.
+    :raise UnsupportedDocument: When the document is no UBL invoice.
+    """
+    try:
+        with REGISTRY.time('peppol_stage_seconds', stage='sniff'):
+            kind = sniff_document(read_plain(data, SNIFF_BYTES), backend)
+    except UnsupportedDocument:
+        REGISTRY.inc('peppol_documents_total', kind='unsupported')
+        REGISTRY.inc('peppol_conversion_errors_total', stage='sniff')
+        raise
+    REGISTRY.inc('peppol_documents_total', kind=kind)
+    return kind
+
+
+def convert_tree(data, kbo_number, backend=None, transform=True, tenant=None, max_bytes=None):
+    """
+    Parse the bytes of an invoice xml and convert the tree to peppol, recording the stage metrics.
+    :param data: The invoice xml in bytes, may be compressed with gzip or zstd or wrapped in a zip archive.
+    :param kbo_number: The kbo number of the customer, None for the one of the tenant profile.
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :param transform: False to only parse, e.g. a document that is compliant already.
+    :param tenant: The tenant whose profile (src/tenants.py) to convert with, None for the default profile.
+    :param max_bytes: Largest accepted decompressed document, see src/decompress.py.
+    :return: The converted root element.
+    """
+    backend = backend or get_backend()
+    REGISTRY.observe('peppol_input_bytes', len(data))
+    stage = 'parse'
+    try:
+        with REGISTRY.time('peppol_stage_seconds', stage=stage):
+            invoice = parse_plain(data, backend, max_bytes)
+        REGISTRY.observe('peppol_invoice_lines', len(invoice.findall(CAC + 'InvoiceLine')))
+        if not transform:
+            return invoice
+        stage = 'transform'
+        observe, rule_seconds = rule_timer()
+        with REGISTRY.time('peppol_stage_seconds', stage=stage):
+            invoice = create_invoice_elementtree(invoice, kbo_number, observe, tenant)
+        for rule, seconds in rule_seconds.items():
+            REGISTRY.observe('peppol_rule_seconds', seconds, rule=rule)
+    except Exception:
+        REGISTRY.inc('peppol_conversion_errors_total', stage=stage)
+        raise
+    return invoice
+
+
+def convert_model(data, kbo_number, backend=None, profile=None, max_bytes=None):
+    """
+    Convert the bytes of an invoice xml to the bytes of a peppol xml with the model engine (src/model.py), recording
+    the stage metrics. Parsing and reading the model are one pass, so there is no transform stage.
+    :param data: The invoice xml in bytes, may be compressed, see src/decompress.py.
+    :param kbo_number: The kbo number of the customer, None for the one of the tenant profile.
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :param profile: The TenantProfile to convert with, defaults to the default profile.
+    :param max_bytes: Largest accepted decompressed document, see src/decompress.py.
+    :return: The converted xml in bytes.
+    :raise Unmodelled: When the document holds something the model does not read.
+    """
+    profile = profile or get_profile()
+    stage = 'parse'
+    try:
+        with REGISTRY.time('peppol_stage_seconds', stage=stage):
+            invoice = parse_invoice(data, model_params(profile, kbo_number), backend=backend, max_bytes=max_bytes)
+        REGISTRY.observe('peppol_input_bytes', len(data))
+        REGISTRY.observe('peppol_invoice_lines', len(invoice.lines))
+        stage = 'serialize'
+        with REGISTRY.time('peppol_stage_seconds', stage=stage):
+            return emit_invoice(invoice)
+    except Unmodelled:
+        # Not a failure, convert_document converts the document with the rules instead.
+        raise
+    except Exception:
+        REGISTRY.inc('peppol_conversion_errors_total', stage=stage)
+        raise
+
+
+def convert_document(data, kbo_number, backend=None, tenant=None, engine=None, max_bytes=None):
+    """
+    Convert the bytes of an invoice xml to the bytes of a peppol xml. Documents that are peppol already are passed
+    through as they are, decompressed. Documents the model engine cannot read completely are converted by the rules.
+    :param data: The invoice xml in bytes, may be compressed, see src/decompress.py.
+    :param kbo_number: The kbo number of the customer, None for the one of the tenant profile.
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :param tenant: The tenant whose profile (src/tenants.py) to convert with, None for the default profile.
+    :param engine: 'rules' or 'model', defaults to the CONVERT_ENGINE environment variable, see src/model.py.
+    :param max_bytes: Largest accepted decompressed document, see src/decompress.py. Pass upload_max_plain_bytes() for
+        uploads.
+    :return: The converted xml in bytes.
+    :raise UnsupportedDocument: When the document is no UBL invoice.
+    """
+    try:
+        if sniff(data, backend) == COMPLIANT:
+            return read_plain(data, max_bytes=max_bytes)
+        profile = get_profile(tenant)
+        converted = None
+        if get_engine(engine, profile) == 'model':
+            try:
+                converted = convert_model(data, kbo_number, backend, profile, max_bytes)
+            except Unmodelled as error:
+                REGISTRY.inc('peppol_model_fallbacks_total', element=error.name)
+        if converted is None:
+            invoice = convert_tree(data, kbo_number, backend, tenant=tenant, max_bytes=max_bytes)
+            try:
+                with REGISTRY.time('peppol_stage_seconds', stage='serialize'):
+                    converted = serialize(invoice)
+            except Exception:
+                REGISTRY.inc('peppol_conversion_errors_total', stage='serialize')
+                raise
+        REGISTRY.inc('peppol_conversions_total')
+    finally:
+        REGISTRY.flush()
+    return converted
+
+
+def validate_document(data, kbo_number, backend=None, tenant=None, max_bytes=None):
+    """
+    Convert the bytes of an invoice xml and validate the result against the peppol checks of src/validate.py.
+    Documents that are peppol already are validated as they are.
+    :param data: The invoice xml in bytes, may be compressed, see src/decompress.py.
+    :param kbo_number: The kbo number of the customer, None for the one of the tenant profile.
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :param tenant: The tenant whose profile (src/tenants.py) to convert with, None for the default profile.
+    :param max_bytes: Largest accepted decompressed document, see src/decompress.py.
+    :return: List of Finding.
+    :raise UnsupportedDocument: When the document is no UBL invoice.
+    """
+    try:
+        transform = sniff(data, backend) != COMPLIANT
+        invoice = convert_tree(data, kbo_number, backend, transform, tenant, max_bytes)
+        with REGISTRY.time('peppol_stage_seconds', stage='validate'):
+            findings = compile_checks().validate(invoice)
+        for finding in findings:
+            REGISTRY.inc('peppol_validation_findings_total', check=finding.id, flag=finding.flag)
+    finally:
+        REGISTRY.flush()
+    return findings
+
+
+def destination_path(output_dir, output):
+    """
+    Get the path of a converted file inside the output directory.
+    :param output_dir: The output directory.
+    :param output: The relative output name.
+    :return: The destination path.
+    :raises ValueError: When the path resolves outside of output_dir, through a symbolic link for example.
+    """
+    destination = os.path.join(output_dir, output)
+    root = os.path.realpath(output_dir)
+    if os.path.commonpath([root, os.path.realpath(destination)]) != root:
+        raise ValueError('Output %s is outside of %s' % (output, output_dir))
+    return destination
+
+
+def convert_task(task):
+    """
+    Convert a single task inside a worker process.
+    :param task: Tuple (archive, name, output name, kbo_number, tenant, output_dir, stream, profile_dir).
+    :return: Dict with the name, sizes, the converted bytes when not written to output_dir and the error if any.
+    """
+    archive, name, output, kbo_number, tenant, output_dir, stream, profile_dir = task
+    result = {'archive': archive, 'name': name, 'output': output,
+              'input_bytes': 0, 'output_bytes': 0, 'data': None, 'error': None}
+    try:
+        if output_dir is not None and stream and archive is None:
+            # Stream files that are no archive members straight from disk to disk, decompressing on the way.
+            result['input_bytes'] = os.path.getsize(name)
+            destination = destination_path(output_dir, result['output'])
+            if sniff(read_plain(name, SNIFF_BYTES)) == COMPLIANT:
+                with open_plain(name) as plain, open(destination, 'wb') as f:
+                    shutil.copyfileobj(plain, f)
+                result['output_bytes'] = os.path.getsize(destination)
+            else:
+                result['output_bytes'] = profiled(profile_dir, output, convert_stream, name, destination, kbo_number,
+                                                    CHUNK_SIZE, None, tenant)
+            return result
+        data = read_task(archive, name)
+        result['input_bytes'] = len(data)
+        converted = profiled(profile_dir, output, convert_document, data, kbo_number, None, tenant)
+        result['output_bytes'] = len(converted)
+        if output_dir is None:
+            result['data'] = converted
+        else:
+            destination = destination_path(output_dir, result['output'])
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, 'wb') as f:
+                f.write(converted)
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    return result
+
+
+def profiled(profile_dir, key, function, *args):
+    """
+    Call a function, under the profiler when profiling is on.
+    :param profile_dir: Directory to save the profile in, None to call the function as is.
+    :param key: Id of the profile, e.g. the output name.
+    :param function: The function.
+    :param args: Arguments of the function.
+    :return: The result of the function.
+    """
+    if profile_dir is None:
+        return function(*args)
+    return profile_call(key, profile_dir, function, *args)
+
+
+def run_batch(paths, output, kbo_number, workers=None, chunksize=8, stream=False, report=None, profile_dir=None,
+              tenant=None):
+    """
+    Convert many invoice xml files on a process pool.
+    :param paths: List of file paths, directories, glob patterns or zip archives.
+    :param output: Output directory, or a path ending in .zip to write a zip archive.
+    :param kbo_number: The kbo number of the customer, None for the one of the tenant profile.
+    :param workers: Number of worker processes, defaults to the number of cpus.
+    :param chunksize: Number of files handed to a worker at a time.
+    :param stream: Use the streaming engine for plain files written to a directory.
+    :param report: Optional path to write the per-file failure report to (json).
+    :param profile_dir: Optional directory to save a cpu and memory profile of every conversion in, see
+                        src/profiling.py.
+    :param tenant: The tenant whose profile (src/tenants.py) to convert with, None for the default profile.
+    :return: Dict with the summary of the batch.
+    """
+    to_zip = output.lower().endswith('.zip')
+    output_dir = None if to_zip else output
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    used = set()
+    tasks = ((archive, name, output_name(archive, name, used), kbo_number, tenant, output_dir, stream, profile_dir)
+             for archive, name in collect_inputs(paths))
+    summary = {'files': 0, 'failed': 0, 'input_bytes': 0, 'output_bytes': 0, 'failures': []}
+    start = time.perf_counter()
+    archive_out = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) if to_zip else None
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            # Results come back as they finish, write them out right away.
+            for result in pool.imap_unordered(convert_task, tasks, chunksize):
+                summary['files'] += 1
+                summary['input_bytes'] += result['input_bytes']
+                if result['error'] is not None:
+                    summary['failed'] += 1
+                    summary['failures'].append({'archive': result['archive'], 'name': result['name'],
+                                                'error': result['error']})
+                    continue
+                summary['output_bytes'] += result['output_bytes']
+                if archive_out is not None:
+                    archive_out.writestr(result['output'], result['data'])
+    finally:
+        if archive_out is not None:
+            archive_out.close()
+    summary['seconds'] = time.perf_counter() - start
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump(summary['failures'], f, indent=2)
+    return summary
+
+
+def format_summary(summary):
+    """
+    Format the summary of a batch.
+    :param summary: The summary returned by run_batch.
+    :return: The summary as text.
+    """
+    seconds = summary['seconds'] or 1e-9
+    lines = ['Converted %d files (%d failed) in %.2fs: %.1f files/sec, %.2f MB/sec' % (
+        summary['files'] - summary['failed'], summary['failed'], summary['seconds'],
+        summary['files'] / seconds, summary['input_bytes'] / seconds / 1e6)]
+    for failure in summary['failures']:
+        name = failure['name'] if failure['archive'] is None else failure['archive'] + ':' + failure['name']
+        lines.append('  FAILED %s: %s' % (name, failure['error']))
+    return '\n'.join(lines)
@@ -0,0 +1,156 @@
+import concurrent.futures
+import json
+import os
+import zipfile
+
+from src.batch import convert_document, output_name
+from src.decompress import XML_SUFFIXES, check_member_size, read_member, upload_max_plain_bytes
+
+# Process pool shared by all bulk requests of this (gunicorn) worker, created on first use.
+_executor = None
+
+
+def get_executor(workers=None):
+    """
+    Get the process pool used for bulk conversions.
+    :param workers: Number of worker processes, defaults to the BULK_WORKERS environment variable or the number of cpus.
+    :return: The executor.
+    """
+    global _executor
+    if _executor is None:
+        workers = workers or int(os.environ.get('BULK_WORKERS', 0)) or None
+        _executor = concurrent.futures.ProcessPoolExecutor(workers)
+    return _executor
+
+
+def xml_members(archive):
+    """
+    Get the (compressed) xml documents of an uploaded zip archive.
+    :param archive: The ZipFile.
+    :return: List of ZipInfo.
+    """
+    return [info for info in archive.infolist() if info.filename.lower().endswith(XML_SUFFIXES)]
+
+
+def iter_uploads(files, max_bytes=None):
+    """
+    Expand uploaded files and zip archives into (name, bytes) pairs, read one at a time. The sizes the archive members
+    declare are checked before anything is converted, so a zip bomb is answered with an error instead of a broken
+    stream, and members are read through a limit in case they declare less than they hold.
+    :param files: List of werkzeug FileStorage objects.
+    :param max_bytes: Largest accepted decompressed member, defaults to upload_max_plain_bytes (src/decompress.py).
+    :return: Iterator of (name, bytes) tuples.
+    :raise DecompressedTooLarge: When an archive member declares more than the limit.
+    """
+    max_bytes = max_bytes or upload_max_plain_bytes()
+    for storage in files:
+        if zipfile.is_zipfile(storage.stream):
+            storage.stream.seek(0)
+            with zipfile.ZipFile(storage.stream) as archive:
+                for info in xml_members(archive):
+                    check_member_size(info, max_bytes)
+    return _iter_uploads(files, max_bytes)
+
+
+def _iter_uploads(files, max_bytes):
+    """
+    Read the uploads checked by iter_uploads.
+    :param files: List of werkzeug FileStorage objects.
+    :param max_bytes: Largest accepted decompressed member.
+    :return: Generator of (name, bytes) tuples.
+    """
+    for storage in files:
+        stream = storage.stream
+        if zipfile.is_zipfile(stream):
+            stream.seek(0)
+            with zipfile.ZipFile(stream) as archive:
+                for info in xml_members(archive):
+                    yield info.filename, read_member(archive, info, max_bytes)
+        else:
+            stream.seek(0)
+            yield storage.filename or 'invoice.xml', stream.read()
+
+
+def iter_convert_bulk(uploads, kbo_number, executor, max_pending=None, tenant=None, max_bytes=None):
+    """
+    Convert uploads on a pool, yielding results as they finish with a bounded number in flight.
+    :param uploads: Iterable of (name, bytes) tuples.
+    :param kbo_number: The kbo number of the customer.
+    :param executor: The executor to convert on.
+    :param max_pending: Maximum number of conversions submitted at a time, defaults to twice the pool size.
+    :param tenant: The tenant whose profile (src/tenants.py) to convert with, None for the default profile.
+    :param max_bytes: Largest accepted decompressed document, defaults to upload_max_plain_bytes (src/decompress.py).
+    :return: Generator of (name, converted bytes or None, manifest entry) tuples.
+    """
+    max_bytes = max_bytes or upload_max_plain_bytes()
+    max_pending = max_pending or 2 * (getattr(executor, '_max_workers', None) or os.cpu_count() or 1)
+    used = set()
+    pending = {}
+    uploads = iter(uploads)
+    exhausted = False
+    while pending or not exhausted:
+        # Top up the pool.
+        while not exhausted and len(pending) < max_pending:
+            try:
+                name, data = next(uploads)
+            except StopIteration:
+                exhausted = True
+                break
+            entry = {'name': name, 'output': output_name(None, name, used), 'input_bytes': len(data)}
+            pending[executor.submit(convert_document, data, kbo_number, None, tenant, None, max_bytes)] = entry
+        if not pending:
+            break
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            entry = pending.pop(future)
+            try:
+                converted = future.result()
+            except Exception as e:
+                entry.update(status='failed', error='%s: %s' % (type(e).__name__, e))
+                yield entry['output'], None, entry
+                continue
+            entry.update(status='converted', output_bytes=len(converted))
+            yield entry['output'], converted, entry
+
+
+class _ZipBuffer:
+    """
+    Write-only, unseekable file object that hands everything written to it back as chunks.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """
+        Take the chunks written since the last drain.
+        :return: The bytes.
+        """
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip_stream(results):
+    """
+    Stream a zip archive of converted documents, followed by a manifest.json with the status per file.
+    :param results: Iterable of (name, converted bytes or None, manifest entry) tuples.
+    :return: Generator of byte chunks of the zip archive.
+    """
+    buffer = _ZipBuffer()
+    manifest = []
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, converted, entry in results:
+            manifest.append(entry)
+            if converted is not None:
+                archive.writestr(name, converted)
+                yield buffer.drain()
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+    yield buffer.drain()
@@ -0,0 +1,209 @@
+import contextlib
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Maximum total size of the documents in the on-disk tier.
+DEFAULT_DISK_MAX_BYTES = 1024 * 1024 * 1024
+# Share of the on-disk limit a process writes before it checks the size of the directory again.
+DISK_PRUNE_FRACTION = 1 / 16
+# Share of the on-disk limit the directory is pruned down to, so pruning does not run again right away.
+DISK_PRUNE_TARGET = 0.9
+# Seconds after which a temporary file is considered left behind by a crashed process.
+STALE_TEMPORARY_SECONDS = 3600
+
+
+class ConversionCache:
+    """
+    Content-addressed cache of converted documents, keyed by the hash of the input bytes, the kbo number and the
+    rule set version. Holds a bounded in-memory LRU (by bytes) in front of an optional directory shared by all
+    processes, which is kept under its own limit by removing the least recently used files (by modification time).
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, directory=None, disk_max_bytes=DEFAULT_DISK_MAX_BYTES):
+        """
+        :param max_bytes: Maximum total size of the converted documents kept in memory.
+        :param directory: Optional directory of the on-disk tier.
+        :param disk_max_bytes: Maximum total size of the converted documents kept in the directory.
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+        # Bytes this process wrote to the directory since it last checked its size.
+        self._disk_written = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.prune_disk()
+
+    @staticmethod
+    def key(data, kbo_number, version):
+        """
+        Compute the cache key of a conversion.
+        :param data: The input bytes.
+        :param kbo_number: The kbo number of the customer.
+        :param version: The version of the rule set.
+        :return: The hex digest.
+        """
+        digest = hashlib.sha256(data)
+        digest.update(b'\0' + kbo_number.encode('utf-8') + b'\0' + version.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        """
+        :param key: The cache key.
+        :return: The path of the key in the on-disk tier.
+        """
+        return os.path.join(self.directory, key[:2], key + '.xml')
+
+    def get(self, key):
+        """
+        Look up a converted document.
+        :param key: The cache key.
+        :return: The converted bytes or None.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return value
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    value = f.read()
+                # Mark the file as recently used, pruning removes the least recently used files first.
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            else:
+                with self._lock:
+                    self.counters['disk_hits'] += 1
+                self._remember(key, value)
+                return value
+        with self._lock:
+            self.counters['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Store a converted document.
+        :param key: The cache key.
+        :param value: The converted bytes.
+        """
+        self._remember(key, value)
+        if self.directory is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so other processes never read a partial document, unique per writer since
+            # the threads of a process may store the same key. The .tmp suffix lets prune_disk skip it until it is stale.
+            fd, temporary_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(path) + '.',
+                                                  dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(value)
+                os.replace(temporary_path, path)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temporary_path)
+                raise
+            with self._lock:
+                self._disk_written += len(value)
+                prune = self._disk_written >= self.disk_max_bytes * DISK_PRUNE_FRACTION
+                if prune:
+                    self._disk_written = 0
+            if prune:
+                self.prune_disk()
+
+    def prune_disk(self):
+        """
+        Remove the least recently used files of the on-disk tier while it is larger than disk_max_bytes, down to
+        DISK_PRUNE_TARGET of it, and the temporary files left behind by crashed processes. Processes may prune at the
+        same time, a file removed by another one is skipped.
+        :return: The number of removed documents.
+        """
+        files = []
+        total = 0
+        stale = time.time() - STALE_TEMPORARY_SECONDS
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                    if entry.name.endswith('.tmp'):
+                        if stat.st_mtime < stale:
+                            os.remove(entry.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.disk_max_bytes:
+            return 0
+        removed = 0
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_max_bytes * DISK_PRUNE_TARGET:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            else:
+                removed += 1
+            total -= size
+        with self._lock:
+            self.counters['disk_evictions'] += removed
+        return removed
+
+    def _remember(self, key, value):
+        """
+        Store a converted document in the in-memory LRU, evicting the least recently used ones.
+        :param key: The cache key.
+        :param value: The converted bytes.
+        """
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous)
+            self._entries[key] = value
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.counters['evictions'] += 1
+
+    def get_or_convert(self, data, kbo_number, version, convert):
+        """
+        Get a converted document from the cache, converting and storing it on a miss.
+        :param data: The input bytes.
+        :param kbo_number: The kbo number of the customer.
+        :param version: The version of the rule set.
+        :param convert: Function (data, kbo_number) -> converted bytes.
+        :return: The converted bytes.
+        """
+        key = self.key(data, kbo_number, version)
+        value = self.get(key)
+        if value is None:
+            value = convert(data, kbo_number)
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        """
+        :return: Dict with the counters, the number of entries and the bytes held in memory.
+            disk_evictions only counts the files removed by this process.
+        """
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
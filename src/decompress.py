@@ -0,0 +1,243 @@
+import contextlib
+import gzip
+import io
+import os
+import zipfile
+
+from src.admission import DEFAULT_MAX_BYTES
+from src.backend import get_backend
+from src.sniff import UnsupportedDocument
+
+try:
+    # Python 3.14+.
+    from compression import zstd
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Magic bytes at the start of a compressed document.
+MAGIC_BYTES = {
+    b'\x1f\x8b': 'gzip',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+    b'PK\x03\x04': 'zip',
+}
+MAGIC_LENGTH = max(len(magic) for magic in MAGIC_BYTES)
+# Largest accepted decompressed upload, a few kilobytes of gzip can hold gigabytes of xml. The same as the largest
+# plain upload, so admission control, which weighs uploads by their size, also bounds the memory of compressed ones.
+# Local files, e.g. converted in batch, are not limited unless MAX_PLAIN_BYTES is set.
+DEFAULT_MAX_PLAIN_BYTES = DEFAULT_MAX_BYTES
+# File name suffixes of (compressed) xml documents in directories converted in batch.
+XML_SUFFIXES = ('.xml', '.xml.gz', '.xml.zst')
+
+
+class UnsupportedCompression(UnsupportedDocument):
+    """
+    The document is compressed in a way that cannot be read, e.g. zstd without a zstd module or a zip archive that
+    does not hold exactly one xml file.
+    """
+
+
+class DecompressedTooLarge(ValueError):
+    """
+    The decompressed document is larger than MAX_PLAIN_BYTES.
+    """
+
+
+def compression_of(prefix):
+    """
+    Detect the compression of a document from its magic bytes.
+    :param prefix: The first bytes of the document, at least MAGIC_LENGTH.
+    :return: 'gzip', 'zstd', 'zip' or None for plain xml.
+    """
+    for magic, compression in MAGIC_BYTES.items():
+        if prefix[:len(magic)] == magic:
+            return compression
+    return None
+
+
+class _Prefixed(io.RawIOBase):
+    """
+    Unseekable binary stream of which the first bytes were read already to detect the compression.
+    """
+
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._prefix:
+            size = min(len(buffer), len(self._prefix))
+            buffer[:size] = self._prefix[:size]
+            self._prefix = self._prefix[size:]
+            return size
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class _Limited(io.RawIOBase):
+    """
+    Decompressed stream that raises DecompressedTooLarge once more than the limit, if any, was read from it.
+    """
+
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self._limit = limit
+        self._read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        self._read += len(data)
+        if self._limit is not None and self._read > self._limit:
+            raise DecompressedTooLarge('decompressed document larger than %d bytes' % self._limit)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def max_plain_bytes(max_bytes=None):
+    """
+    Get the largest accepted decompressed document.
+    :param max_bytes: The limit asked for, None for the default.
+    :return: max_bytes, else the MAX_PLAIN_BYTES environment variable or else None for no limit.
+    """
+    return max_bytes or int(os.environ.get('MAX_PLAIN_BYTES', 0)) or None
+
+
+def upload_max_plain_bytes():
+    """
+    Get the largest accepted decompressed upload, the limit of documents received over http.
+    :return: The MAX_PLAIN_BYTES environment variable, else MAX_UPLOAD_BYTES or else DEFAULT_MAX_PLAIN_BYTES.
+    """
+    return (int(os.environ.get('MAX_PLAIN_BYTES', 0)) or int(os.environ.get('MAX_UPLOAD_BYTES', 0))
+            or DEFAULT_MAX_PLAIN_BYTES)
+
+
+def check_member_size(info, max_bytes=None):
+    """
+    Check the size a zip archive member declares before it is decompressed.
+    :param info: The ZipInfo of the member.
+    :param max_bytes: Largest accepted decompressed member, see max_plain_bytes.
+    :raise DecompressedTooLarge: When the member declares more than the limit.
+    """
+    max_bytes = max_plain_bytes(max_bytes)
+    if max_bytes is not None and info.file_size > max_bytes:
+        raise DecompressedTooLarge('%s decompresses to more than %d bytes' % (info.filename, max_bytes))
+
+
+def read_member(archive, info, max_bytes=None):
+    """
+    Read a member of a zip archive, decompressing no more than the limit whatever size the member declares.
+    :param archive: The ZipFile.
+    :param info: The ZipInfo or name of the member.
+    :param max_bytes: Largest accepted decompressed member, see max_plain_bytes.
+    :return: The member in bytes, as stored, so it may be compressed itself.
+    :raise DecompressedTooLarge: When the member is larger than the limit.
+    """
+    max_bytes = max_plain_bytes(max_bytes)
+    with archive.open(info) as member:
+        return io.BufferedReader(_Limited(member, max_bytes)).read()
+
+
+def zip_member(archive):
+    """
+    Get the xml document of a zip archive wrapping a single document.
+    :param archive: The ZipFile.
+    :return: The name of the member.
+    :raise UnsupportedCompression: When the archive does not hold exactly one xml file.
+    """
+    members = [member for member in archive.namelist() if member.lower().endswith('.xml')]
+    if len(members) != 1:
+        raise UnsupportedCompression('zip archives must hold exactly one xml file, not %d' % len(members))
+    return members[0]
+
+
+def open_zstd(stream):
+    """
+    :param stream: Binary stream of zstd compressed data.
+    :return: Binary stream of the decompressed data.
+    :raise UnsupportedCompression: When neither compression.zstd nor zstandard is installed.
+    """
+    if zstd is not None:
+        return zstd.ZstdFile(stream)
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    raise UnsupportedCompression('zstd compressed documents need the zstandard package (pip install zstandard)')
+
+
+@contextlib.contextmanager
+def open_plain(source, max_bytes=None):
+    """
+    Open a document that may be compressed with gzip or zstd or wrapped in a zip archive as a stream of the plain
+    xml, decompressed while it is read so the plain document is never held in memory as a whole.
+    :param source: The document in bytes, a file path or a binary file object.
+    :param max_bytes: Largest accepted decompressed document, defaults to the MAX_PLAIN_BYTES environment variable or
+        else no limit. Uploads are limited to upload_max_plain_bytes by the callers.
+    :return: Context manager of a binary file object of the plain xml.
+    :raise UnsupportedCompression: When the compression cannot be read.
+    """
+    with contextlib.ExitStack() as stack:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            stream = io.BytesIO(source)
+        elif isinstance(source, str) or hasattr(source, '__fspath__'):
+            stream = stack.enter_context(open(source, 'rb'))
+        else:
+            stream = source
+        prefix = stream.read(MAGIC_LENGTH)
+        if stream.seekable():
+            stream.seek(-len(prefix), io.SEEK_CUR)
+        else:
+            stream = io.BufferedReader(_Prefixed(prefix, stream))
+        compression = compression_of(prefix)
+        if compression is None:
+            yield stream
+            return
+        if compression == 'gzip':
+            plain = gzip.GzipFile(fileobj=stream, mode='rb')
+        elif compression == 'zstd':
+            plain = open_zstd(stream)
+        else:
+            if not stream.seekable():
+                # The directory of a zip archive is at its end, only the compressed archive is held in memory.
+                stream = io.BytesIO(stream.read())
+            archive = stack.enter_context(zipfile.ZipFile(stream))
+            plain = archive.open(zip_member(archive))
+        stack.enter_context(plain)
+        yield io.BufferedReader(_Limited(plain, max_plain_bytes(max_bytes)))
+
+
+def read_plain(source, size=-1, max_bytes=None):
+    """
+    Read (the start of) the plain xml of a document that may be compressed, see open_plain.
+    :param source: The document in bytes, a file path or a binary file object.
+    :param size: The number of bytes to read, -1 for all.
+    :param max_bytes: Largest accepted decompressed document, see open_plain.
+    :return: The plain xml in bytes.
+    """
+    if isinstance(source, (bytes, bytearray)) and compression_of(source) is None:
+        return source if size < 0 else source[:size]
+    with open_plain(source, max_bytes) as plain:
+        return plain.read(size)
+
+
+def parse_plain(source, backend=None, max_bytes=None):
+    """
+    Parse a document that may be compressed. The parser reads the decompressed xml in blocks as it goes.
+    :param source: The document in bytes, a file path or a binary file object.
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :param max_bytes: Largest accepted decompressed document, see open_plain.
+    :return: The root element.
+    """
+    backend = backend or get_backend()
+    if isinstance(source, (bytes, bytearray)) and compression_of(source) is None:
+        return backend.fromstring(source)
+    with open_plain(source, max_bytes) as plain:
+        return backend.parse(plain)
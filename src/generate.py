@@ -0,0 +1,184 @@
+import random
+from xml.sax.saxutils import escape
+
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<Invoice xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2" xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2" xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">
+  <cbc:UBLVersionID>2.1</cbc:UBLVersionID>
+  <cbc:ID>{invoice_id}</cbc:ID>
+  <cbc:IssueDate>2022-05-{day:02d}</cbc:IssueDate>
+  <cbc:InvoiceTypeCode>380</cbc:InvoiceTypeCode>
+  <cbc:Note>{note}</cbc:Note>
+  <cbc:DocumentCurrencyCode>EUR</cbc:DocumentCurrencyCode>
+'''
+
+PARTY = '''  <cac:{role}>
+    <cac:Party>
+{website_uri}      <cac:PartyName><cbc:Name>{name}</cbc:Name></cac:PartyName>
+      <cac:PostalAddress>
+        <cbc:StreetName>{street}</cbc:StreetName>
+        <cbc:CityName>{city}</cbc:CityName>
+        <cbc:PostalZone>{zone}</cbc:PostalZone>
+        <cac:Country><cbc:IdentificationCode>BE</cbc:IdentificationCode></cac:Country>
+      </cac:PostalAddress>
+{tax_scheme}{legal_entity}      <cac:Contact><cbc:ElectronicMail>{email}</cbc:ElectronicMail></cac:Contact>
+    </cac:Party>
+  </cac:{role}>
+'''
+
+WEBSITE_URI = '''      <cbc:WebsiteURI>https://www.{domain}</cbc:WebsiteURI>
+'''
+
+PARTY_TAX_SCHEME = '''      <cac:PartyTaxScheme>
+        <cbc:RegistrationName>{name}</cbc:RegistrationName>
+        <cbc:CompanyID>BE{kbo}</cbc:CompanyID>
+        <cac:TaxScheme><cbc:ID schemeID="UN/ECE 5153" schemeAgencyID="6">VAT</cbc:ID></cac:TaxScheme>
+      </cac:PartyTaxScheme>
+'''
+
+PARTY_LEGAL_ENTITY = '''      <cac:PartyLegalEntity>
+        <cbc:RegistrationName>{name}</cbc:RegistrationName>
+        <cac:RegistrationAddress><cac:Country><cbc:IdentificationCode>BE</cbc:IdentificationCode></cac:Country></cac:RegistrationAddress>
+      </cac:PartyLegalEntity>
+'''
+
+DELIVERY = '''  <cac:Delivery>
+    <cbc:ActualDeliveryDate>2022-05-{day:02d}</cbc:ActualDeliveryDate>
+    <cac:DeliveryLocation><cac:Address><cbc:StreetName>{street}</cbc:StreetName><cac:Country><cbc:IdentificationCode>BE</cbc:IdentificationCode></cac:Country></cac:Address></cac:DeliveryLocation>
+    <cac:DeliveryParty><cac:PartyName><cbc:Name>{name}</cbc:Name></cac:PartyName><cac:PostalAddress><cbc:StreetName>{street}</cbc:StreetName><cac:Country><cbc:IdentificationCode>BE</cbc:IdentificationCode></cac:Country></cac:PostalAddress></cac:DeliveryParty>
+  </cac:Delivery>
+'''
+
+TOTALS = '''  <cac:PaymentMeans>
+    <cbc:PaymentMeansCode>30</cbc:PaymentMeansCode>
+    <cbc:PaymentID>{invoice_id}</cbc:PaymentID>
+    <cac:PayeeFinancialAccount>
+      <cbc:ID schemeName="IBAN">BE71096123456769</cbc:ID>
+      <cac:FinancialInstitutionBranch><cac:FinancialInstitution><cbc:ID schemeName="BIC">GKCCBEBB</cbc:ID></cac:FinancialInstitution></cac:FinancialInstitutionBranch>
+    </cac:PayeeFinancialAccount>
+  </cac:PaymentMeans>
+  <cac:TaxTotal>
+    <cbc:TaxAmount currencyID="EUR">{tax:.2f}</cbc:TaxAmount>
+    <cac:TaxSubtotal>
+      <cbc:TaxableAmount currencyID="EUR">{net:.2f}</cbc:TaxableAmount>
+      <cbc:TaxAmount currencyID="EUR">{tax:.2f}</cbc:TaxAmount>
+      <cbc:Percent>21</cbc:Percent>
+      <cac:TaxCategory>
+        <cbc:ID schemeID="UN/ECE 5305" schemeAgencyID="6">S</cbc:ID>
+        <cbc:Percent>21</cbc:Percent>
+        <cac:TaxScheme><cbc:ID schemeID="UN/ECE 5153" schemeAgencyID="6">VAT</cbc:ID></cac:TaxScheme>
+      </cac:TaxCategory>
+    </cac:TaxSubtotal>
+  </cac:TaxTotal>
+  <cac:LegalMonetaryTotal>
+    <cbc:LineExtensionAmount currencyID="EUR">{net:.2f}</cbc:LineExtensionAmount>
+    <cbc:TaxExclusiveAmount currencyID="EUR">{net:.2f}</cbc:TaxExclusiveAmount>
+    <cbc:TaxInclusiveAmount currencyID="EUR">{gross:.2f}</cbc:TaxInclusiveAmount>
+    <cbc:PayableAmount currencyID="EUR">{gross:.2f}</cbc:PayableAmount>
+  </cac:LegalMonetaryTotal>
+'''
+
+LINE = '''  <cac:InvoiceLine>
+    <cbc:ID>{line_id}</cbc:ID>
+    <cbc:InvoicedQuantity>{quantity}</cbc:InvoicedQuantity>
+    <cbc:LineExtensionAmount currencyID="EUR">{net:.2f}</cbc:LineExtensionAmount>
+    <cac:TaxTotal>
+      <cbc:TaxAmount currencyID="EUR">{tax:.2f}</cbc:TaxAmount>
+      <cac:TaxSubtotal>
+        <cbc:TaxableAmount currencyID="EUR">{net:.2f}</cbc:TaxableAmount>
+        <cbc:TaxAmount currencyID="EUR">{tax:.2f}</cbc:TaxAmount>
+        <cac:TaxCategory>
+          <cbc:ID schemeID="UN/ECE 5305" schemeAgencyID="6">S</cbc:ID>
+          <cbc:Percent>21</cbc:Percent>
+          <cac:TaxScheme><cbc:ID schemeID="UN/ECE 5153" schemeAgencyID="6">VAT</cbc:ID></cac:TaxScheme>
+        </cac:TaxCategory>
+      </cac:TaxSubtotal>
+    </cac:TaxTotal>
+    <cac:Item>
+      <cbc:Description>{description}</cbc:Description>
+      <cbc:Name>{item}</cbc:Name>
+      <cac:SellersItemIdentification><cbc:ID>{sku}</cbc:ID></cac:SellersItemIdentification>
+    </cac:Item>
+    <cac:Price><cbc:PriceAmount currencyID="EUR">{price:.2f}</cbc:PriceAmount><cbc:BaseQuantity>1</cbc:BaseQuantity></cac:Price>
+  </cac:InvoiceLine>
+'''
+
+WORDS = ('boek', 'schrift', 'pen', 'map', 'atlas', 'roman', 'strip', 'agenda', 'kalender', 'woordenboek')
+CITIES = ('Gent', 'Antwerpen', 'Brussel', 'Leuven', 'Brugge', 'Hasselt')
+
+
+def party(rng, role, tax_scheme, website_uri, legal_entity):
+    """
+    Generate an AccountingSupplierParty or AccountingCustomerParty block.
+    :param rng: The random generator.
+    :param role: 'AccountingSupplierParty' or 'AccountingCustomerParty'.
+    :param tax_scheme: Include a PartyTaxScheme.
+    :param website_uri: Include a WebsiteURI.
+    :param legal_entity: Include a PartyLegalEntity.
+    :return: The xml text.
+    """
+    name = '%s %s' % (rng.choice(WORDS).capitalize(), rng.choice(('BV', 'NV', 'BVBA', 'CV')))
+    domain = name.split()[0].lower() + '.be'
+    values = {'role': role, 'name': name, 'street': '%s %d' % (rng.choice(WORDS).capitalize() + 'straat',
+                                                              rng.randint(1, 200)),
+              'city': rng.choice(CITIES), 'zone': rng.randint(1000, 9999), 'email': 'info@' + domain,
+              'kbo': '%010d' % rng.randint(0, 9999999999), 'domain': domain}
+    values['website_uri'] = WEBSITE_URI.format(**values) if website_uri else ''
+    values['tax_scheme'] = PARTY_TAX_SCHEME.format(**values) if tax_scheme else ''
+    values['legal_entity'] = PARTY_LEGAL_ENTITY.format(**values) if legal_entity else ''
+    return PARTY.format(**values)
+
+
+def generate_invoice(lines=10, supplier_tax_scheme=True, customer_tax_scheme=True, delivery=True, website_uri=True,
+                     description_size=40, note_size=0, seed=0):
+    """
+    Generate a realistic UBL 2.1 invoice as exported by the ERP.
+    :param lines: The number of invoice lines.
+    :param supplier_tax_scheme: Give the supplier party a PartyTaxScheme.
+    :param customer_tax_scheme: Give the customer party a PartyTaxScheme.
+    :param delivery: Include a Delivery block.
+    :param website_uri: Give the supplier party a WebsiteURI.
+    :param description_size: Approximate number of characters of every item description.
+    :param note_size: Approximate number of characters of the invoice note.
+    :param seed: Seed of the random generator, the same arguments and seed give the same invoice.
+    :return: The invoice xml in bytes.
+    """
+    rng = random.Random(seed)
+    invoice_id = 'INV-%06d' % rng.randint(0, 999999)
+    day = rng.randint(1, 28)
+    parts = [HEADER.format(invoice_id=invoice_id, day=day, note=escape(words(rng, note_size)))]
+    parts.append(party(rng, 'AccountingSupplierParty', supplier_tax_scheme, website_uri, True))
+    parts.append(party(rng, 'AccountingCustomerParty', customer_tax_scheme, False, False))
+    if delivery:
+        parts.append(DELIVERY.format(day=day, street='Magazijnweg %d' % rng.randint(1, 50),
+                                     name='Magazijn ' + rng.choice(CITIES)))
+    line_parts = []
+    total = 0.0
+    for line_id in range(1, lines + 1):
+        quantity = rng.randint(1, 20)
+        price = rng.randint(100, 10000) / 100
+        net = quantity * price
+        total += net
+        item = rng.choice(WORDS)
+        line_parts.append(LINE.format(line_id=line_id, quantity=quantity, net=net, tax=net * 0.21, price=price,
+                                      item=item, sku='SKU-%05d' % rng.randint(0, 99999),
+                                      description=escape(words(rng, description_size))))
+    parts.append(TOTALS.format(invoice_id=invoice_id, net=total, tax=total * 0.21, gross=total * 1.21))
+    parts.extend(line_parts)
+    parts.append('</Invoice>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def words(rng, size):
+    """
+    Generate filler text.
+    :param rng: The random generator.
+    :param size: Approximate number of characters.
+    :return: The text.
+    """
+    text = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        text.append(word)
+        length += len(word) + 1
+    return ' '.join(text)
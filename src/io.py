@@ -1,13 +1,20 @@
-import xml.etree.ElementTree as ET
+import hashlib
+import zlib
+
+from src.decompress import parse_plain
+from src.serialize import write
+
+CHUNK_SIZE = 64 * 1024
+# zlib window bits per http content encoding.
+CONTENT_ENCODING_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
 
 
 def read_xml(file_path):
     """
     Reads an nested XML file and returns a dictionary with the data.
+    The file may be compressed with gzip or zstd or wrapped in a zip archive, see src/decompress.py.
     """
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    return root
+    return parse_plain(file_path)
 
 
 def write_xml(file_path, data):
@@ -16,9 +23,7 @@ def write_xml(file_path, data):
     :param file_path: The path to the file.
     :param data: The elementTree to write.
     """
-    tree = ET.ElementTree(data)
-    tree.write(file_path, xml_declaration=True, encoding="utf-8")
-    print("Wrote XML file to: " + file_path)
+    write(data, file_path)
 
 
 def print_xml_children(element):
@@ -28,3 +33,101 @@ def print_xml_children(element):
     """
     for child in element:
         print(child.tag, child.attrib)
+
+
+class ChunkWriter:
+    """
+    Binary file-like object that collects everything written to it in memory as fixed size chunks,
+    optionally compressed with a http content encoding, while keeping track of the length and hash.
+    """
+
+    def __init__(self, content_encoding=None, chunk_size=CHUNK_SIZE):
+        """
+        :param content_encoding: None, 'gzip' or 'deflate'.
+        :param chunk_size: The size of the collected chunks.
+        """
+        self.chunks = []
+        self.length = 0
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._hash = hashlib.sha1()
+        self._compressor = None
+        if content_encoding is not None:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, CONTENT_ENCODING_WBITS[content_encoding])
+
+    def write(self, data):
+        """
+        Write bytes.
+        :param data: The bytes to write.
+        :return: The number of bytes written.
+        """
+        if self._compressor is not None:
+            self._append(self._compressor.compress(data))
+        else:
+            self._append(data)
+        return len(data)
+
+    def _append(self, data):
+        """
+        Append (compressed) bytes to the buffer and move full chunks out of it.
+        :param data: The bytes to append.
+        """
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            self._emit(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+
+    def _emit(self, chunk):
+        """
+        Store a finished chunk.
+        :param chunk: The chunk.
+        """
+        self.chunks.append(chunk)
+        self.length += len(chunk)
+        self._hash.update(chunk)
+
+    def close(self):
+        """
+        Flush the compressor and the last partial chunk.
+        """
+        if self._compressor is not None:
+            self._append(self._compressor.flush())
+            self._compressor = None
+        if self._buffer:
+            self._emit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    @property
+    def etag(self):
+        """
+        The hash of everything written, usable as http etag.
+        """
+        return self._hash.hexdigest()
+
+
+def bytes_to_chunks(data, content_encoding=None, chunk_size=CHUNK_SIZE):
+    """
+    Split (and optionally compress) serialized xml into chunks.
+    :param data: The serialized xml in bytes.
+    :param content_encoding: None, 'gzip' or 'deflate'.
+    :param chunk_size: The size of the chunks.
+    :return: The closed ChunkWriter holding the chunks, length and etag.
+    """
+    writer = ChunkWriter(content_encoding, chunk_size)
+    writer.write(data)
+    writer.close()
+    return writer
+
+
+def serialize_xml_chunks(data, content_encoding=None, chunk_size=CHUNK_SIZE):
+    """
+    Serialize an elementtree in memory into chunks.
+    :param data: The elementTree to serialize.
+    :param content_encoding: None, 'gzip' or 'deflate'.
+    :param chunk_size: The size of the chunks.
+    :return: The closed ChunkWriter holding the chunks, length and etag.
+    """
+    writer = ChunkWriter(content_encoding, chunk_size)
+    write(data, writer)
+    writer.close()
+    return writer
@@ -0,0 +1,296 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+
+from src.batch import convert_document
+from src.decompress import upload_max_plain_bytes
+
+DEFAULT_DB_PATH = os.path.join('jobs', 'jobs.sqlite3')
+# Seconds a claimed job stays reserved for its worker, after that another worker may take it over.
+LEASE_SECONDS = 300
+POLL_SECONDS = 0.5
+# A job whose worker lost the lease this many times (e.g. it crashes the worker) is marked failed instead of retried.
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds finished jobs and their files are kept before they are removed.
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 3600
+# Seconds between two removals of expired jobs by a worker.
+EXPIRE_INTERVAL_SECONDS = 600
+
+
+class JobQueue:
+    """
+    Durable conversion job queue in a local SQLite database, job inputs and results are spooled next to it.
+    Every method opens its own connection, so one queue can be shared by threads and processes.
+    """
+
+    def __init__(self, db_path=None, max_attempts=None, retention_seconds=None):
+        """
+        :param db_path: Path of the database, defaults to the JOB_DB environment variable or jobs/jobs.sqlite3.
+        :param max_attempts: Times a job is claimed before it is failed, defaults to JOB_MAX_ATTEMPTS or 3.
+        :param retention_seconds: Seconds finished jobs are kept, defaults to JOB_RETENTION_SECONDS or 7 days.
+        """
+        self.db_path = db_path or os.environ.get('JOB_DB') or DEFAULT_DB_PATH
+        self.max_attempts = max_attempts or int(os.environ.get('JOB_MAX_ATTEMPTS', 0)) or DEFAULT_MAX_ATTEMPTS
+        self.retention_seconds = (retention_seconds or int(os.environ.get('JOB_RETENTION_SECONDS', 0))
+                                  or DEFAULT_RETENTION_SECONDS)
+        self.spool_dir = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' id TEXT PRIMARY KEY,'
+                ' status TEXT NOT NULL,'
+                ' kbo_number TEXT NOT NULL,'
+                ' tenant TEXT,'
+                ' created REAL NOT NULL,'
+                ' updated REAL NOT NULL,'
+                ' lease_until REAL,'
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' error TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created)')
+            # Queues created before tenant profiles existed.
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(jobs)')]
+            if 'tenant' not in columns:
+                connection.execute('ALTER TABLE jobs ADD COLUMN tenant TEXT')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """
+        Open a connection to the database in autocommit mode, closed on exit.
+        :return: The connection.
+        """
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def input_path(self, job_id):
+        """
+        :param job_id: The id of the job.
+        :return: The path of the spooled input of the job.
+        """
+        return os.path.join(self.spool_dir, job_id + '.xml')
+
+    def output_path(self, job_id):
+        """
+        :param job_id: The id of the job.
+        :return: The path of the converted result of the job.
+        """
+        return os.path.join(self.spool_dir, job_id + '.converted.xml')
+
+    def submit(self, data, kbo_number, tenant=None):
+        """
+        Spool an invoice and queue its conversion.
+        :param data: The invoice xml in bytes.
+        :param kbo_number: The kbo number of the customer.
+        :param tenant: The tenant whose profile (src/tenants.py) to convert with, None for the default profile.
+        :return: The id of the job.
+        """
+        job_id = uuid.uuid4().hex
+        with open(self.input_path(job_id), 'wb') as f:
+            f.write(data)
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('INSERT INTO jobs (id, status, kbo_number, tenant, created, updated)'
+                               ' VALUES (?, ?, ?, ?, ?, ?)', (job_id, 'queued', kbo_number, tenant, now, now))
+        return job_id
+
+    def claim(self):
+        """
+        Reserve the oldest queued job, or a running job whose worker lost its lease.
+        Jobs that lost their lease max_attempts times are marked failed instead.
+        :return: Tuple (job id, kbo number, tenant, attempt) or None when there is nothing to do. The attempt is the
+            lease of the worker, pass it to complete and fail.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            # Take the write lock up front so two workers never claim the same job.
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, updated = ?, lease_until = NULL"
+                    " WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                    ('lease expired after %d attempts' % self.max_attempts, now, now, self.max_attempts))
+                row = connection.execute(
+                    "SELECT id, kbo_number, tenant, attempts + 1 FROM jobs WHERE status = 'queued'"
+                    " OR (status = 'running' AND lease_until < ?) ORDER BY created LIMIT 1", (now,)).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE jobs SET status = 'running', updated = ?, lease_until = ?, attempts = attempts + 1"
+                        " WHERE id = ?", (now, now + LEASE_SECONDS, row[0]))
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        return row
+
+    def _finish(self, job_id, attempt, status, error=None, result_path=None):
+        """
+        Store the final status of a job, unless the worker lost its lease and another worker claimed the job since.
+        :param job_id: The id of the job.
+        :param attempt: The attempt returned by claim.
+        :param status: 'done' or 'failed'.
+        :param error: The error message of a failed job.
+        :param result_path: Temporary file moved to the output path of the job while the lease is checked.
+        :return: True when the status was stored, False when the lease was lost.
+        """
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                owned = connection.execute(
+                    "UPDATE jobs SET status = ?, error = ?, updated = ?, lease_until = NULL"
+                    " WHERE id = ? AND status = 'running' AND attempts = ?",
+                    (status, error, time.time(), job_id, attempt)).rowcount == 1
+                if owned and result_path is not None:
+                    os.replace(result_path, self.output_path(job_id))
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        return owned
+
+    def complete(self, job_id, attempt, converted):
+        """
+        Store the result of a job.
+        :param job_id: The id of the job.
+        :param attempt: The attempt returned by claim.
+        :param converted: The converted xml in bytes.
+        :return: True when the result was stored, False when the lease was lost and the result discarded.
+        """
+        # Write to a temporary file first so a result is never seen half written.
+        temporary_path = '%s.%d.tmp' % (self.output_path(job_id), attempt)
+        with open(temporary_path, 'wb') as f:
+            f.write(converted)
+        if not self._finish(job_id, attempt, 'done', result_path=temporary_path):
+            os.remove(temporary_path)
+            return False
+        os.remove(self.input_path(job_id))
+        return True
+
+    def fail(self, job_id, attempt, error):
+        """
+        Mark a job as failed.
+        :param job_id: The id of the job.
+        :param attempt: The attempt returned by claim.
+        :param error: The error message.
+        :return: True when the status was stored, False when the lease was lost.
+        """
+        return self._finish(job_id, attempt, 'failed', error)
+
+    def expire(self):
+        """
+        Remove the jobs that finished more than retention_seconds ago, with their spooled input and result.
+        :return: Number of removed jobs.
+        """
+        cutoff = time.time() - self.retention_seconds
+        with self._connect() as connection:
+            job_ids = [row[0] for row in connection.execute(
+                "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (cutoff,))]
+            for job_id in job_ids:
+                for path in (self.input_path(job_id), self.output_path(job_id)):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                connection.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        return len(job_ids)
+
+    def status(self, job_id):
+        """
+        Get the status of a job.
+        :param job_id: The id of the job.
+        :return: Dict with id, status, created, updated, attempts and error, or None for an unknown job.
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT id, status, created, updated, attempts, error FROM jobs WHERE id = ?',
+                                     (job_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('id', 'status', 'created', 'updated', 'attempts', 'error'), row))
+
+    def run_one(self):
+        """
+        Claim and convert a single job.
+        :return: True when a job was processed, False when the queue was empty.
+        """
+        claimed = self.claim()
+        if claimed is None:
+            return False
+        job_id, kbo_number, tenant, attempt = claimed
+        try:
+            with open(self.input_path(job_id), 'rb') as f:
+                data = f.read()
+            # Jobs are uploads, limited like the documents converted while the client waits.
+            converted = convert_document(data, kbo_number, tenant=tenant, max_bytes=upload_max_plain_bytes())
+        except Exception as e:
+            self.fail(job_id, attempt, '%s: %s' % (type(e).__name__, e))
+        else:
+            self.complete(job_id, attempt, converted)
+        return True
+
+
+def work(db_path=None, stop=None):
+    """
+    Process jobs until stopped.
+    :param db_path: Path of the database.
+    :param stop: Optional threading/multiprocessing Event to stop the loop.
+    """
+    queue = JobQueue(db_path)
+    expired = 0
+    while stop is None or not stop.is_set():
+        if not queue.run_one():
+            # Remove expired jobs while idle, every worker does so now and then.
+            if time.time() - expired > EXPIRE_INTERVAL_SECONDS:
+                queue.expire()
+                expired = time.time()
+            time.sleep(POLL_SECONDS)
+
+
+def start_worker_threads(db_path=None, workers=1):
+    """
+    Start background worker threads inside the current process.
+    :param db_path: Path of the database.
+    :param workers: Number of threads.
+    :return: The event that stops the threads when set.
+    """
+    stop = threading.Event()
+    for _ in range(workers):
+        threading.Thread(target=work, args=(db_path, stop), daemon=True).start()
+    return stop
+
+
+def main(argv=None):
+    """
+    Run a pool of worker processes on the job queue.
+    :param argv: The arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description='Run conversion job workers.')
+    parser.add_argument('--db', default=None, help='path of the job database')
+    parser.add_argument('-j', '--workers', type=int, default=int(os.environ.get('JOB_WORKERS', 0)) or os.cpu_count())
+    args = parser.parse_args(argv)
+    # Create the database before the workers race for it.
+    JobQueue(args.db)
+    # Stop all workers after their current job on SIGTERM (e.g. from the process manager), instead of leaving them
+    # running without a parent.
+    stop = multiprocessing.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    processes = [multiprocessing.Process(target=work, args=(args.db, stop)) for _ in range(args.workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        stop.set()
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+import argparse
+import csv
+import glob
+import io
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zipfile
+from collections import namedtuple
+
+DEFAULT_DB_PATH = os.path.join('kbo', 'kbo.sqlite3')
+# Seconds between two checks whether the database was replaced by a newly imported full dump.
+RELOAD_SECONDS = 5
+# Bytes of the database mapped into memory, the pages are shared by all processes through the page cache.
+MMAP_BYTES = 1 << 32
+# Suffixes of the files SQLite keeps next to a database.
+SIDECAR_SUFFIXES = ('-wal', '-shm', '-journal')
+# Rows inserted per statement batch while importing.
+BATCH_ROWS = 10000
+# Rank of a denomination per (type, language) of the open data, the lowest ranked one is the name of an enterprise.
+# Types: 001 name, 003 commercial name, 002 abbreviation. Languages: 2 Dutch, 1 French, 3 German, 4 English, 0 unknown.
+DENOMINATION_TYPES = {'001': 0, '003': 10, '002': 20}
+LANGUAGES = {'2': 0, '1': 1, '3': 2, '4': 3, '0': 4}
+
+# An enterprise of the KBO/CBE, number is the 10 digit enterprise number and status 'AC' for active enterprises.
+Enterprise = namedtuple('Enterprise', 'number name status juridical_form')
+# Database path -> KboRegistry, see get_registry.
+_registries = {}
+
+
+def enterprise_number(value):
+    """
+    Normalize an enterprise number, e.g. from a vat number.
+    :param value: The number in any notation, e.g. 'BE 0478.693.713', '478693713' or '0478693713'.
+    :return: The 10 digit enterprise number, None when it is no valid enterprise number.
+    """
+    if not value:
+        return None
+    digits = ''.join(character for character in value if character.isdigit())
+    if len(digits) == 9:
+        digits = '0' + digits
+    # The last two digits are 97 minus the first eight modulo 97.
+    if len(digits) != 10 or 97 - int(digits[:8]) % 97 != int(digits[8:]):
+        return None
+    return digits
+
+
+class KboRegistry:
+    """
+    Read-only view of a KBO database built by import_dump. Every thread has its own connection, the database is
+    mapped into memory so all worker processes share its pages instead of holding a copy each. A database replaced
+    by a new full dump (the path links to a new file) is picked up within RELOAD_SECONDS, updates applied in place
+    are seen right away.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Path of the database.
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        self._checked = 0.0
+        self._identity = self._stat()
+        self.version = self._read_version()
+
+    def _stat(self):
+        """
+        :return: Identity of the database file the path links to, changes when it is replaced.
+        """
+        stat = os.stat(self.db_path)
+        return stat.st_ino, stat.st_dev
+
+    def _connect(self):
+        """
+        Open a read-only connection mapping the database into memory.
+        :return: The connection.
+        """
+        connection = sqlite3.connect(database_file(self.db_path), check_same_thread=False)
+        connection.execute('PRAGMA query_only = 1')
+        connection.execute('PRAGMA mmap_size = %d' % MMAP_BYTES)
+        return connection
+
+    def _read_version(self):
+        """
+        :return: The extract number and snapshot date of the imported dump, e.g. '143-2024-05-01'.
+        """
+        connection = self._connect()
+        try:
+            meta = dict(connection.execute('SELECT key, value FROM meta'))
+        finally:
+            connection.close()
+        return '%s-%s' % (meta.get('ExtractNumber', '0'), meta.get('SnapshotDate', ''))
+
+    def _connection(self):
+        """
+        Get the connection of this thread, reopened when the database file was replaced or the process forked.
+        :return: The connection.
+        """
+        now = time.monotonic()
+        if now - self._checked >= RELOAD_SECONDS:
+            self._checked = now
+            identity = self._stat()
+            if identity != self._identity:
+                self._identity = identity
+                self.version = self._read_version()
+        key = (os.getpid(), self._identity)
+        if getattr(self._local, 'key', None) != key:
+            self._local.connection = self._connect()
+            self._local.key = key
+        return self._local.connection
+
+    def lookup(self, number):
+        """
+        Look up an enterprise.
+        :param number: The enterprise number in any notation, see enterprise_number.
+        :return: The Enterprise or None when it is not registered.
+        """
+        number = enterprise_number(number)
+        if number is None:
+            return None
+        row = self._connection().execute(
+            'SELECT number, (SELECT name FROM denomination WHERE denomination.number = enterprise.number'
+            ' ORDER BY rank LIMIT 1), status, juridical_form FROM enterprise WHERE number = ?', (number,)).fetchone()
+        return None if row is None else Enterprise(*row)
+
+
+def database_file(db_path):
+    """
+    Resolve the path of a KBO database to the file holding the current dump. Connections open the file itself, so
+    SQLite keeps its write-ahead log next to that file and never pairs it with the database of another dump.
+    :param db_path: Path of the database, a link to the file imported from the latest full dump.
+    :return: The path of the file.
+    """
+    return os.path.realpath(db_path)
+
+
+def remove_old_versions(db_path, keep):
+    """
+    Remove the files of full dumps imported before, with their write-ahead logs.
+    :param db_path: Path of the database.
+    :param keep: File names to keep, the current dump and the one readers may still be switching from.
+    """
+    name = os.path.basename(db_path)
+    for path in glob.glob(glob.escape(db_path) + '*'):
+        base = os.path.basename(path)
+        for suffix in SIDECAR_SUFFIXES:
+            if base.endswith(suffix):
+                base = base[:-len(suffix)]
+                break
+        else:
+            if base == name:
+                # The link itself.
+                continue
+        if base not in keep:
+            os.remove(path)
+
+
+def get_registry(db_path=None):
+    """
+    Get the KBO registry, shared by all threads of the process.
+    :param db_path: Path of the database, defaults to the KBO_DB environment variable.
+    :return: The KboRegistry, None when no database was configured or imported yet.
+    """
+    db_path = db_path or os.environ.get('KBO_DB')
+    if not db_path:
+        return None
+    registry = _registries.get(db_path)
+    if registry is None and os.path.exists(db_path):
+        registry = _registries.setdefault(db_path, KboRegistry(db_path))
+    return registry
+
+
+def open_dump(source):
+    """
+    Open a KBO open data dump.
+    :param source: A zip archive or a directory holding the csv files of the dump.
+    :return: Function name -> text file object of the csv file or None when the dump does not hold it.
+    """
+    if os.path.isdir(source):
+        def open_csv(name):
+            path = os.path.join(source, name)
+            return open(path, encoding='utf-8-sig', newline='') if os.path.exists(path) else None
+        return open_csv
+    archive = zipfile.ZipFile(source)
+    members = {os.path.basename(member): member for member in archive.namelist()}
+
+    def open_csv(name):
+        if name not in members:
+            return None
+        return io.TextIOWrapper(archive.open(members[name]), encoding='utf-8-sig', newline='')
+    return open_csv
+
+
+def read_csv(open_csv, name):
+    """
+    Read the rows of a csv file of a dump.
+    :param open_csv: Function returned by open_dump.
+    :param name: The file name, e.g. 'enterprise.csv'.
+    :return: Generator of dicts, nothing when the dump does not hold the file.
+    """
+    f = open_csv(name)
+    if f is None:
+        return
+    with f:
+        yield from csv.DictReader(f)
+
+
+def read_meta(source):
+    """
+    :param source: A zip archive or a directory holding a dump.
+    :return: Dict of the variables in meta.csv, e.g. {'ExtractType': 'full', 'ExtractNumber': '143', ...}.
+    """
+    return {row['Variable']: row['Value'] for row in read_csv(open_dump(source), 'meta.csv')}
+
+
+def create_schema(connection):
+    """
+    Create the tables of a KBO database. Both are clustered on the enterprise number, so a lookup is a single
+    B-tree search per table.
+    :param connection: The connection.
+    """
+    connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+    connection.execute('CREATE TABLE IF NOT EXISTS enterprise (number TEXT PRIMARY KEY, status TEXT,'
+                       ' juridical_form TEXT) WITHOUT ROWID')
+    connection.execute('CREATE TABLE IF NOT EXISTS denomination (number TEXT, rank INTEGER, name TEXT,'
+                       ' PRIMARY KEY (number, rank)) WITHOUT ROWID')
+
+
+def insert_rows(connection, open_csv, suffix=''):
+    """
+    Insert the enterprises and denominations of a dump.
+    :param connection: The connection.
+    :param open_csv: Function returned by open_dump.
+    :param suffix: '' for the files of a full dump, '_insert' for those of an update dump.
+    :return: The number of inserted enterprises.
+    """
+    enterprises = ((enterprise_number(row['EnterpriseNumber']), row['Status'], row['JuridicalForm'])
+                   for row in read_csv(open_csv, 'enterprise%s.csv' % suffix))
+    count = insert_batches(connection, 'INSERT OR REPLACE INTO enterprise VALUES (?, ?, ?)',
+                           (row for row in enterprises if row[0] is not None))
+    # Denominations of establishment units (numbers 2 to 8) and of other types are skipped.
+    denominations = ((enterprise_number(row['EntityNumber']),
+                      DENOMINATION_TYPES[row['TypeOfDenomination']] + LANGUAGES.get(row['Language'], 9),
+                      row['Denomination'])
+                     for row in read_csv(open_csv, 'denomination%s.csv' % suffix)
+                     if row['TypeOfDenomination'] in DENOMINATION_TYPES and row['EntityNumber'][:1] in '01')
+    insert_batches(connection, 'INSERT OR REPLACE INTO denomination VALUES (?, ?, ?)',
+                   (row for row in denominations if row[0] is not None))
+    return count
+
+
+def insert_batches(connection, statement, rows):
+    """
+    Execute a statement for many rows in batches.
+    :param connection: The connection.
+    :param statement: The statement with parameters.
+    :param rows: Iterable of parameter tuples.
+    :return: The number of rows.
+    """
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_ROWS:
+            connection.executemany(statement, batch)
+            count += len(batch)
+            batch = []
+    connection.executemany(statement, batch)
+    return count + len(batch)
+
+
+def import_dump(source, db_path=None):
+    """
+    Import a KBO open data dump. A full dump is built into a new file next to the database, the database path is then
+    atomically switched to link to it, so readers keep using the old file until they reload. An update dump is applied
+    in place in one transaction, unless its extract number was applied before.
+    :param source: A zip archive or a directory holding the csv files of the dump.
+    :param db_path: Path of the database, defaults to the KBO_DB environment variable or kbo/kbo.sqlite3.
+    :return: The number of inserted enterprises, None when the dump was skipped.
+    """
+    db_path = db_path or os.environ.get('KBO_DB') or DEFAULT_DB_PATH
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    open_csv = open_dump(source)
+    meta = {row['Variable']: row['Value'] for row in read_csv(open_csv, 'meta.csv')}
+    if meta.get('ExtractType', 'full') == 'full':
+        # A new file per import: replacing the database in place would leave readers of the old one sharing its
+        # write-ahead log with the new one.
+        version_path = '%s.%s-%s' % (db_path, meta.get('ExtractNumber', '0'), uuid.uuid4().hex[:8])
+        connection = sqlite3.connect(version_path, isolation_level=None)
+        try:
+            # Nothing to recover when the import fails halfway, so skip the journal.
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('PRAGMA synchronous = OFF')
+            create_schema(connection)
+            connection.execute('BEGIN')
+            count = insert_rows(connection, open_csv)
+            connection.executemany('INSERT INTO meta VALUES (?, ?)', meta.items())
+            connection.execute('COMMIT')
+            connection.execute('PRAGMA journal_mode = WAL')
+        except BaseException:
+            connection.close()
+            os.remove(version_path)
+            raise
+        connection.close()
+        previous = os.path.basename(database_file(db_path)) if os.path.exists(db_path) else None
+        link_path = db_path + '.link'
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        os.symlink(os.path.basename(version_path), link_path)
+        os.replace(link_path, db_path)
+        remove_old_versions(db_path, {os.path.basename(version_path), previous})
+        return count
+    connection = sqlite3.connect(database_file(db_path), timeout=30, isolation_level=None)
+    try:
+        connection.execute('PRAGMA journal_mode = WAL')
+        create_schema(connection)
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            applied = connection.execute("SELECT value FROM meta WHERE key = 'ExtractNumber'").fetchone()
+            if applied is not None and int(applied[0]) >= int(meta['ExtractNumber']):
+                connection.execute('ROLLBACK')
+                return None
+            # Changed enterprises are listed in both the delete and the insert files.
+            for name, table in (('enterprise_delete.csv', 'enterprise'), ('denomination_delete.csv', 'denomination')):
+                numbers = ((enterprise_number(row['EntityNumber']),) for row in read_csv(open_csv, name))
+                insert_batches(connection, 'DELETE FROM %s WHERE number = ?' % table, numbers)
+            count = insert_rows(connection, open_csv, '_insert')
+            connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', meta.items())
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+    return count
+
+
+def sync_dumps(directory, db_path=None):
+    """
+    Import the dumps dropped in a directory that are newer than the imported one, in extract number order. Only the
+    newest full dump is imported, updates follow it.
+    :param directory: Directory holding dumps as zip archives or directories.
+    :param db_path: Path of the database, defaults to the KBO_DB environment variable or kbo/kbo.sqlite3.
+    :return: List of the imported dump paths.
+    """
+    db_path = db_path or os.environ.get('KBO_DB') or DEFAULT_DB_PATH
+    applied = 0
+    if os.path.exists(db_path):
+        connection = sqlite3.connect(database_file(db_path))
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'ExtractNumber'").fetchone()
+        finally:
+            connection.close()
+        applied = int(row[0]) if row else 0
+    dumps = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not (os.path.isdir(path) or zipfile.is_zipfile(path)):
+            continue
+        meta = read_meta(path)
+        if meta and int(meta['ExtractNumber']) > applied:
+            dumps.append((int(meta['ExtractNumber']), meta.get('ExtractType', 'full'), path))
+    dumps.sort()
+    full = [number for number, extract_type, _ in dumps if extract_type == 'full']
+    imported = []
+    for number, extract_type, path in dumps:
+        if full and number < full[-1]:
+            continue
+        import_dump(path, db_path)
+        imported.append(path)
+    return imported
+
+
+def main(argv=None):
+    """
+    Import KBO open data dumps into the database, optionally watching a directory for new ones.
+    :param argv: The arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description='Import KBO/CBE open data dumps for party enrichment.')
+    parser.add_argument('source', help='a dump (zip archive or directory) or, with --watch, a directory of dumps')
+    parser.add_argument('--db', default=None, help='path of the KBO database')
+    parser.add_argument('--watch', type=float, default=None, metavar='SECONDS',
+                        help='keep importing the new dumps dropped in the source directory at this interval')
+    args = parser.parse_args(argv)
+    if args.watch is None:
+        count = import_dump(args.source, args.db)
+        print('Skipped, already imported' if count is None else 'Imported %d enterprises' % count)
+        return
+    while True:
+        for path in sync_dumps(args.source, args.db):
+            print('Imported %s' % path)
+        time.sleep(args.watch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+import atexit
+import bisect
+import contextlib
+import fcntl
+import glob
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+import uuid
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+LINE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+# Minimum seconds between two writes of the metrics of this process to METRICS_DIR, raise it to trade freshness of
+# /metrics for less file I/O. The last values are always written at exit.
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 0))
+# File in the shared directory holding the merged values of the processes that exited.
+EXITED_FILE_NAME = 'exited.json'
+# Lock file serializing the merges into EXITED_FILE_NAME with reading the directory.
+LOCK_FILE_NAME = 'metrics.lock'
+
+
+class Registry:
+    """
+    Counters and histograms of this process, optionally shared with other (gunicorn) worker processes of the same host
+    through a directory: every process writes its own snapshot file there and rendering merges all of them. A process
+    merges its values into the file of the exited processes when it exits, the files of processes that died without
+    doing so are merged when rendering, so the directory does not grow with every restarted worker.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param directory: Optional directory shared by all processes.
+        """
+        self.directory = directory
+        # name -> (type, help, buckets)
+        self.definitions = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the values, e.g. in a forked child that must not report the values of its parent again.
+        """
+        # (name, labels) -> value for counters, [bucket counts..., sum, count] for histograms
+        self.values = {}
+        self._lock = threading.Lock()
+        # Serializes the writes of the snapshot file by the threads of this process, they share its temporary file.
+        self._flush_lock = threading.Lock()
+        self._flushed = 0.0
+        self._retired = False
+        # Unique per process, so a reused pid never overwrites the values of a process that exited.
+        self._file_name = 'metrics-%d-%s.json' % (os.getpid(), uuid.uuid4().hex[:8])
+
+    def counter(self, name, help):
+        """
+        Define a counter.
+        :param name: The metric name.
+        :param help: The help text.
+        """
+        self.definitions[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        """
+        Define a histogram.
+        :param name: The metric name.
+        :param help: The help text.
+        :param buckets: The upper bounds of the buckets, sorted.
+        """
+        self.definitions[name] = ('histogram', help, tuple(buckets))
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Increase a counter.
+        :param name: The metric name.
+        :param amount: The amount to add.
+        :param labels: The labels of the sample.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value in a histogram.
+        :param name: The metric name.
+        :param value: The observed value.
+        :param labels: The labels of the sample.
+        """
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            sample = self.values.get(key)
+            if sample is None:
+                sample = self.values[key] = [0] * (len(buckets) + 2)
+            # Only the first bucket holding the value is counted, render makes them cumulative.
+            sample[bisect.bisect_left(buckets, value)] += 1
+            sample[-2] += value
+            sample[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """
+        Time a block into a histogram.
+        :param name: The metric name.
+        :param labels: The labels of the sample.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        :return: A json-serializable copy of the values of this process.
+        """
+        with self._lock:
+            return [[name, labels, value] for (name, labels), value in self.values.items()]
+
+    def flush(self, force=False):
+        """
+        Write the values of this process to the shared directory, at most once per FLUSH_INTERVAL.
+        :param force: Write even when the last write was recent.
+        """
+        now = time.monotonic()
+        if self.directory is None or self._retired or (not force and now - self._flushed < FLUSH_INTERVAL):
+            return
+        self._flushed = now
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, self._file_name)
+        with self._flush_lock:
+            if self._retired:
+                return
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Hold the lock of the shared directory.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILE_NAME), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _retire(self, paths):
+        """
+        Merge snapshot files into the file of the exited processes and remove them, called holding the lock of the
+        shared directory, which also guards the temporary file of the merge.
+        :param paths: The paths of the snapshot files.
+        """
+        exited_path = os.path.join(self.directory, EXITED_FILE_NAME)
+        snapshots = [read_snapshot(path) for path in [exited_path] + paths]
+        with open(exited_path + '.tmp', 'w') as f:
+            json.dump([[name, labels, value] for (name, labels), value in merge_snapshots(snapshots).items()], f)
+        os.replace(exited_path + '.tmp', exited_path)
+        for path in paths:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def retire(self):
+        """
+        Merge the values of this process into the file of the exited processes and remove its own file, at exit.
+        """
+        if self.directory is None or self._retired:
+            return
+        self.flush(force=True)
+        with self._flush_lock:
+            self._retired = True
+        with self._locked():
+            self._retire([os.path.join(self.directory, self._file_name)])
+
+    def collect(self):
+        """
+        Merge the values of all processes, the files of processes that died without retiring are retired first.
+        :return: Dict (name, labels) -> value.
+        """
+        if self.directory is None:
+            return merge_snapshots([self.snapshot()])
+        self.flush(force=True)
+        with self._locked():
+            paths = glob.glob(os.path.join(self.directory, 'metrics-*.json'))
+            dead = [path for path in paths if not is_alive(int(os.path.basename(path).split('-')[1]))]
+            if dead:
+                self._retire(dead)
+            snapshots = [read_snapshot(path) for path in paths if path not in dead]
+            snapshots.append(read_snapshot(os.path.join(self.directory, EXITED_FILE_NAME)))
+        return merge_snapshots(snapshots)
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        :return: The text.
+        """
+        collected = self.collect()
+        lines = []
+        for name, (kind, help, buckets) in sorted(self.definitions.items()):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (sample_name, labels), value in sorted(collected.items()):
+                if sample_name != name:
+                    continue
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else format_value(bound)
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', le),)), cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(value[-2])))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def read_snapshot(path):
+    """
+    :param path: The path of a snapshot file.
+    :return: The snapshot, empty when the file is missing or unreadable.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def merge_snapshots(snapshots):
+    """
+    Add up the values of snapshots.
+    :param snapshots: Iterable of snapshots, lists of [name, labels, value].
+    :return: Dict (name, labels) -> value.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            key = (name, tuple(tuple(label) for label in labels))
+            if isinstance(value, list):
+                previous = merged.get(key)
+                merged[key] = value if previous is None else [a + b for a, b in zip(previous, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def is_alive(pid):
+    """
+    :param pid: A process id.
+    :return: False when no process with the id exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels):
+    """
+    :param labels: Tuple of (name, value) pairs.
+    :return: The labels in Prometheus notation.
+    """
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    """
+    :param value: A number.
+    :return: The number in Prometheus notation.
+    """
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Metrics of the conversion pipeline, shared with other worker processes when METRICS_DIR is set.
+REGISTRY = Registry(os.environ.get('METRICS_DIR') or None)
+REGISTRY.histogram('peppol_stage_seconds', 'Time spent per conversion stage (sniff, parse, transform, serialize, validate).')
+REGISTRY.histogram('peppol_rule_seconds', 'Time spent applying a conversion rule, per document.')
+REGISTRY.histogram('peppol_input_bytes', 'Size of the converted input documents.', SIZE_BUCKETS)
+REGISTRY.histogram('peppol_invoice_lines', 'Number of invoice lines of the converted documents.', LINE_BUCKETS)
+REGISTRY.counter('peppol_conversions_total', 'Number of successful conversions.')
+REGISTRY.counter('peppol_documents_total',
+                 'Number of received documents, per kind (compliant, convertible, unsupported).')
+REGISTRY.counter('peppol_conversion_errors_total', 'Number of failed conversions, per failing stage.')
+REGISTRY.counter('peppol_validation_findings_total', 'Number of failed peppol checks of validated documents.')
+REGISTRY.counter('peppol_admission_rejections_total',
+                 'Number of rejected uploads, per reason (too_large, decompressed_too_large, queue_full, timeout).')
+REGISTRY.counter('peppol_admission_queued_total', 'Number of uploads that waited for a share of the conversion budget.')
+REGISTRY.counter('peppol_admission_dequeued_total',
+                 'Number of uploads that stopped waiting, per outcome (admitted, timeout). '
+                 'Queued minus dequeued is the queue depth.')
+REGISTRY.histogram('peppol_admission_wait_seconds', 'Time uploads waited for a share of the conversion budget.')
+REGISTRY.counter('peppol_model_fallbacks_total',
+                 'Number of documents the model engine left to the rules engine, per first element (or @attribute) '
+                 'outside the model.')
+
+
+def _after_process_start(registry):
+    """
+    Retire the values of a multiprocessing child when it exits. These children skip atexit and run finalizers
+    instead, registered here because the ones registered before they started are dropped.
+    :param registry: The Registry.
+    """
+    multiprocessing.util.Finalize(registry, registry.retire, exitpriority=10)
+
+
+# Start from empty values in a forked child, it must not report the values of its parent again.
+os.register_at_fork(after_in_child=REGISTRY.reset)
+multiprocessing.util.register_after_fork(REGISTRY, _after_process_start)
+atexit.register(REGISTRY.retire)
+
+
+def rule_timer():
+    """
+    Create a callback for Transformer.transform summing the time spent per rule within one document.
+    :return: Tuple (callback, totals dict rule name -> seconds).
+    """
+    totals = {}
+
+    def observe(rule, seconds):
+        totals[rule] = totals.get(rule, 0.0) + seconds
+    return observe, totals
@@ -0,0 +1,946 @@
+import dataclasses
+import os
+from collections import namedtuple
+
+from src.backend import get_backend
+from src.convert import CAC, CBC, UNIT_CODE_ATTRIBUTES, registered
+from src.rules import NAMESPACES
+from src.serialize import ROOT_DECLARATIONS, XML_DECLARATION, escape_attribute, escape_text
+from src.stream import CHUNK_SIZE, read_plain_chunks
+
+# Conversion engines: 'rules' transforms the parsed tree in place with the rule table of the tenant (src/rules.py),
+# 'model' reads the fields peppol needs into the classes below and writes the peppol xml from them.
+ENGINES = ('rules', 'model')
+DEFAULT_ENGINE = 'rules'
+CUSTOMIZATION_ID = 'urn:cen.eu:en16931:2017#compliant#urn:fdc:peppol.eu:2017:poacc:billing:3.0'
+PROFILE_ID = 'urn:fdc:peppol.eu:2017:poacc:billing:01:1.0'
+# Tax category id and invoice line item name written by the peppol rules, whatever the input holds.
+TAX_CATEGORY_ID = 'S'
+LINE_ITEM_NAME = 'Classified taxcategory'
+COUNTRY_LIST_ID = 'ISO3166-1:Alpha2'
+# Header children holding a single text, tag -> Invoice field.
+HEADER_FIELDS = {
+    CBC + 'UBLVersionID': 'ubl_version',
+    CBC + 'ID': 'id',
+    CBC + 'IssueDate': 'issue_date',
+    CBC + 'DueDate': 'due_date',
+    CBC + 'InvoiceTypeCode': 'type_code',
+    CBC + 'TaxPointDate': 'tax_point_date',
+    CBC + 'DocumentCurrencyCode': 'currency',
+    CBC + 'TaxCurrencyCode': 'tax_currency',
+    CBC + 'AccountingCost': 'accounting_cost',
+    CBC + 'BuyerReference': 'buyer_reference',
+}
+# Amounts of the legal monetary total in peppol order, MonetaryTotal field -> tag.
+MONETARY_TOTAL_FIELDS = (
+    ('line_extension', 'LineExtensionAmount'),
+    ('tax_exclusive', 'TaxExclusiveAmount'),
+    ('tax_inclusive', 'TaxInclusiveAmount'),
+    ('allowance_total', 'AllowanceTotalAmount'),
+    ('charge_total', 'ChargeTotalAmount'),
+    ('prepaid', 'PrepaidAmount'),
+    ('payable_rounding', 'PayableRoundingAmount'),
+    ('payable', 'PayableAmount'),
+)
+# Invoice line children holding a single text, tag -> InvoiceLine field.
+LINE_FIELDS = {
+    CBC + 'ID': 'id',
+    CBC + 'Note': 'note',
+    CBC + 'InvoicedQuantity': 'quantity',
+}
+# Tax category children holding a single text, tag -> TaxCategory field.
+TAX_CATEGORY_FIELDS = {
+    CBC + 'Percent': 'percent',
+    CBC + 'TaxExemptionReasonCode': 'exemption_reason_code',
+    CBC + 'TaxExemptionReason': 'exemption_reason',
+}
+TAX_SCHEME = CAC + 'TaxScheme'
+LINE_EXTENSION_AMOUNT = CBC + 'LineExtensionAmount'
+TAX_TOTAL = CAC + 'TaxTotal'
+PRICE = CAC + 'Price'
+TAX_CATEGORY_PATH = CAC + 'TaxSubtotal/' + CAC + 'TaxCategory'
+slotted = dataclasses.dataclass(slots=True)
+
+# Shape of an element the model reads, documents holding anything else are converted by the rules engine.
+# children:   dict of child tag -> Shape, None for an element holding only text, DROPPED for an element whose content
+#             the rules replace or remove, so it is dropped by both engines.
+# attributes: the attributes the model writes itself or the rules replace, None for any attribute.
+# repeats:    whether the element may occur more than once in its parent.
+Shape = namedtuple('Shape', 'children attributes repeats', defaults=(None, (), False))
+DROPPED = {}
+TEXT = Shape()
+AMOUNT = Shape(attributes=('currencyID',))
+COUNTRY = Shape({CBC + 'IdentificationCode': Shape(attributes=('listID',))})
+ADDRESS = Shape({
+    CBC + 'StreetName': TEXT,
+    CBC + 'AdditionalStreetName': TEXT,
+    CBC + 'CityName': TEXT,
+    CBC + 'PostalZone': TEXT,
+    CBC + 'CountrySubentity': TEXT,
+    CAC + 'AddressLine': Shape({CBC + 'Line': TEXT}),
+    CAC + 'Country': COUNTRY,
+})
+PARTY_NAME = Shape({CBC + 'Name': TEXT})
+PARTY_CHILDREN = {
+    CAC + 'PartyName': PARTY_NAME,
+    CAC + 'PostalAddress': ADDRESS,
+    CAC + 'PartyTaxScheme': Shape({
+        CBC + 'RegistrationName': TEXT,
+        CBC + 'CompanyID': TEXT,
+        CAC + 'TaxScheme': Shape({CBC + 'ID': Shape(attributes=('schemeID', 'schemeAgencyID'))}),
+    }),
+    CAC + 'Contact': Shape({
+        CBC + 'Name': TEXT,
+        CBC + 'Telephone': TEXT,
+        CBC + 'ElectronicMail': Shape(attributes=('languageID',)),
+    }),
+}
+TAX_CATEGORY = Shape({
+    CBC + 'ID': Shape(attributes=None),
+    CBC + 'Percent': TEXT,
+    CBC + 'TaxExemptionReasonCode': TEXT,
+    CBC + 'TaxExemptionReason': TEXT,
+    CAC + 'TaxScheme': Shape({CBC + 'ID': Shape(attributes=None)}),
+})
+FINANCIAL_ID = Shape(attributes=('schemeID', 'schemeName'))
+# Children of the invoice root the model reads.
+INVOICE_SHAPE = {
+    CBC + 'UBLVersionID': TEXT,
+    CBC + 'CustomizationID': Shape(attributes=None),
+    CBC + 'ProfileID': Shape(attributes=None),
+    CBC + 'ID': TEXT,
+    CBC + 'IssueDate': TEXT,
+    CBC + 'DueDate': TEXT,
+    CBC + 'InvoiceTypeCode': Shape(attributes=('listID',)),
+    CBC + 'Note': Shape(repeats=True),
+    CBC + 'TaxPointDate': TEXT,
+    CBC + 'DocumentCurrencyCode': Shape(attributes=('listID',)),
+    CBC + 'TaxCurrencyCode': TEXT,
+    CBC + 'AccountingCost': TEXT,
+    CBC + 'BuyerReference': TEXT,
+    CAC + 'OrderReference': Shape({CBC + 'ID': TEXT}),
+    # The rules remove the website of the supplier and build the legal entity of the customer themselves.
+    CAC + 'AccountingSupplierParty': Shape({CAC + 'Party': Shape(dict(PARTY_CHILDREN, **{
+        CBC + 'WebsiteURI': Shape(DROPPED, None),
+        CAC + 'PartyLegalEntity': Shape({
+            CBC + 'RegistrationName': TEXT,
+            CBC + 'CompanyID': TEXT,
+            CAC + 'RegistrationAddress': Shape({CAC + 'Country': COUNTRY}),
+        }),
+    }))}),
+    CAC + 'AccountingCustomerParty': Shape({CAC + 'Party': Shape(PARTY_CHILDREN)}),
+    CAC + 'Delivery': Shape({
+        CBC + 'ActualDeliveryDate': TEXT,
+        CAC + 'DeliveryLocation': Shape({CAC + 'Address': ADDRESS}),
+        CAC + 'DeliveryParty': Shape({CAC + 'PartyName': PARTY_NAME, CAC + 'PostalAddress': ADDRESS}),
+    }),
+    CAC + 'PaymentMeans': Shape({
+        CBC + 'PaymentMeansCode': Shape(attributes=('listID',)),
+        CBC + 'PaymentID': TEXT,
+        CAC + 'PayeeFinancialAccount': Shape({
+            CBC + 'ID': FINANCIAL_ID,
+            CBC + 'Name': TEXT,
+            CAC + 'FinancialInstitutionBranch': Shape({
+                CBC + 'ID': TEXT,
+                CAC + 'FinancialInstitution': Shape({CBC + 'ID': FINANCIAL_ID}),
+            }),
+        }),
+    }, repeats=True),
+    CAC + 'TaxTotal': Shape({
+        CBC + 'TaxAmount': AMOUNT,
+        CAC + 'TaxSubtotal': Shape({
+            CBC + 'TaxableAmount': AMOUNT,
+            CBC + 'TaxAmount': AMOUNT,
+            CBC + 'Percent': TEXT,
+            CAC + 'TaxCategory': TAX_CATEGORY,
+        }, repeats=True),
+    }, repeats=True),
+    CAC + 'LegalMonetaryTotal': Shape({CBC + tag: AMOUNT for _, tag in MONETARY_TOTAL_FIELDS}),
+    # The rules replace the item and keep only the tax category of the tax total of a line.
+    CAC + 'InvoiceLine': Shape({
+        CBC + 'ID': TEXT,
+        CBC + 'Note': TEXT,
+        CBC + 'InvoicedQuantity': Shape(attributes=tuple(UNIT_CODE_ATTRIBUTES)),
+        CBC + 'LineExtensionAmount': AMOUNT,
+        CAC + 'TaxTotal': Shape({
+            CBC + 'TaxAmount': Shape(DROPPED, None),
+            CAC + 'TaxSubtotal': Shape({
+                CBC + 'TaxableAmount': Shape(DROPPED, None),
+                CBC + 'TaxAmount': Shape(DROPPED, None),
+                CBC + 'Percent': Shape(DROPPED, None),
+                CAC + 'TaxCategory': TAX_CATEGORY,
+            }, repeats=True),
+        }),
+        CAC + 'Item': Shape(DROPPED, None),
+        CAC + 'Price': Shape({
+            CBC + 'PriceAmount': AMOUNT,
+            CBC + 'BaseQuantity': Shape(attributes=('unitCode',)),
+        }),
+    }, repeats=True),
+}
+
+
+class Unmodelled(ValueError):
+    """
+    The document holds an element or attribute the model does not read, the rules engine has to convert it.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: The local name of the element, or '@' and the name of the attribute.
+        """
+        super().__init__('%s is not part of the invoice model' % name)
+        self.name = name
+
+
+@slotted
+class Amount:
+    value: str
+    currency: str = None
+
+
+@slotted
+class Address:
+    street: str = None
+    additional_street: str = None
+    city: str = None
+    postal_zone: str = None
+    subentity: str = None
+    line: str = None
+    country: str = None
+
+
+@slotted
+class PartyTaxScheme:
+    registration_name: str = None
+    company_id: str = None
+    tax_scheme: str = None
+
+
+@slotted
+class LegalEntity:
+    registration_name: str = None
+    company_id: str = None
+    country: str = None
+
+
+@slotted
+class Contact:
+    name: str = None
+    telephone: str = None
+    electronic_mail: str = None
+    language: str = None
+
+
+@slotted
+class Party:
+    endpoint_id: str = None
+    endpoint_scheme: str = None
+    name: str = None
+    address: Address = None
+    tax_scheme: PartyTaxScheme = None
+    legal_entity: LegalEntity = None
+    contact: Contact = None
+
+
+@slotted
+class Delivery:
+    date: str = None
+    location: Address = None
+    party_name: str = None
+    party_address: Address = None
+
+
+@slotted
+class PaymentMeans:
+    code: str = None
+    payment_id: str = None
+    account_id: str = None
+    account_name: str = None
+    branch_id: str = None
+    bic: str = None
+
+
+@slotted
+class TaxCategory:
+    percent: str = None
+    exemption_reason_code: str = None
+    exemption_reason: str = None
+    tax_scheme: str = None
+
+
+@slotted
+class TaxSubtotal:
+    taxable_amount: Amount = None
+    tax_amount: Amount = None
+    category: TaxCategory = None
+
+
+@slotted
+class TaxTotal:
+    tax_amount: Amount = None
+    subtotals: list = dataclasses.field(default_factory=list)
+
+
+@slotted
+class MonetaryTotal:
+    line_extension: Amount = None
+    tax_exclusive: Amount = None
+    tax_inclusive: Amount = None
+    allowance_total: Amount = None
+    charge_total: Amount = None
+    prepaid: Amount = None
+    payable_rounding: Amount = None
+    payable: Amount = None
+
+
+@slotted
+class InvoiceLine:
+    id: str = None
+    note: str = None
+    quantity: str = None
+    line_extension_amount: Amount = None
+    category: TaxCategory = None
+    price_amount: Amount = None
+    base_quantity: str = None
+    base_quantity_unit: str = None
+
+
+@slotted
+class Invoice:
+    ubl_version: str = None
+    id: str = None
+    issue_date: str = None
+    due_date: str = None
+    type_code: str = None
+    notes: list = dataclasses.field(default_factory=list)
+    tax_point_date: str = None
+    currency: str = None
+    tax_currency: str = None
+    accounting_cost: str = None
+    buyer_reference: str = None
+    order_reference: str = None
+    supplier: Party = None
+    customer: Party = None
+    delivery: Delivery = None
+    payment_means: list = dataclasses.field(default_factory=list)
+    tax_totals: list = dataclasses.field(default_factory=list)
+    monetary_total: MonetaryTotal = None
+    lines: list = dataclasses.field(default_factory=list)
+
+
+def get_engine(name=None, profile=None):
+    """
+    Get the conversion engine to use.
+    :param name: 'rules', 'model' or None for the CONVERT_ENGINE environment variable, falling back to rules.
+    :param profile: The TenantProfile to convert with, profiles that switch off rules or add their own can only be
+                    applied by the rules engine, see supports.
+    :return: 'rules' or 'model'.
+    """
+    name = name or os.environ.get('CONVERT_ENGINE') or DEFAULT_ENGINE
+    if name not in ENGINES:
+        raise ValueError('Conversion engine %r is not available, choose from %s' % (name, ', '.join(ENGINES)))
+    if name == 'model' and profile is not None and not supports(profile):
+        return 'rules'
+    return name
+
+
+def supports(profile):
+    """
+    Check whether the model engine gives the same conversion as the rule set of a profile.
+    :param profile: The TenantProfile.
+    :return: True when the profile only changes settings, not the rules.
+    """
+    return not profile.settings['rules'] and not profile.settings['extra_rules']
+
+
+def model_params(profile, kbo_number=None):
+    """
+    Get the values the model engine fills in.
+    :param profile: The TenantProfile to convert with.
+    :param kbo_number: The kbo number of the customer, None for the one of the profile.
+    :return: Dict with kbo_number, supplier_number, language and endpoint_scheme.
+    """
+    settings = profile.settings
+    return {'kbo_number': kbo_number or profile.kbo_number, 'supplier_number': settings['supplier_number'],
+            'language': settings['language'], 'endpoint_scheme': settings['endpoint_scheme']}
+
+
+def local_name(tag):
+    """
+    :param tag: A tag or attribute name in {uri}name notation.
+    :return: The name without namespace.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def check_shape(element, shape):
+    """
+    Check that the model reads everything an element holds.
+    :param element: The element.
+    :param shape: Its Shape.
+    :raise Unmodelled: When the element has a child or attribute outside the shape, or repeats a child that occurs
+                       once in the model.
+    """
+    if shape.attributes is not None:
+        for name in element.attrib:
+            if name not in shape.attributes:
+                raise Unmodelled('@' + local_name(name))
+    children = shape.children
+    if children is DROPPED:
+        return
+    seen = set()
+    for child in element:
+        tag = child.tag
+        if not isinstance(tag, str):
+            continue
+        child_shape = children.get(tag) if children is not None else None
+        if child_shape is None or (tag in seen and not child_shape.repeats):
+            raise Unmodelled(local_name(tag))
+        seen.add(tag)
+        if len(child) or child.attrib:
+            check_shape(child, child_shape)
+
+
+def text_of(element, path):
+    """
+    :param element: The element, may be None.
+    :param path: ElementPath of the child.
+    :return: The text of the child, '' when it is empty and None when there is no such child.
+    """
+    child = element.find(path) if element is not None else None
+    return None if child is None else child.text or ''
+
+
+def amount_of(element, path):
+    """
+    :param element: The element.
+    :param path: ElementPath of the amount child.
+    :return: The Amount or None when there is no such child.
+    """
+    child = element.find(path)
+    return None if child is None else Amount(child.text or '', child.get('currencyID'))
+
+
+def extract_address(element):
+    """
+    :param element: A PostalAddress, Address or RegistrationAddress element, may be None.
+    :return: The Address or None.
+    """
+    if element is None:
+        return None
+    return Address(text_of(element, CBC + 'StreetName'), text_of(element, CBC + 'AdditionalStreetName'),
+                   text_of(element, CBC + 'CityName'), text_of(element, CBC + 'PostalZone'),
+                   text_of(element, CBC + 'CountrySubentity'), text_of(element, CAC + 'AddressLine/' + CBC + 'Line'),
+                   text_of(element, CAC + 'Country/' + CBC + 'IdentificationCode'))
+
+
+def extract_party(element, params, customer):
+    """
+    Read the party of the supplier or customer and fill in its endpoint id and, for the customer, its legal entity the
+    way the peppol rules do.
+    :param element: The AccountingSupplierParty or AccountingCustomerParty element.
+    :param params: The values of model_params.
+    :param customer: True for the customer.
+    :return: The Party.
+    """
+    element = element.find(CAC + 'Party')
+    if element is None:
+        return Party()
+    party = Party(endpoint_scheme=params['endpoint_scheme'], name=text_of(element, CAC + 'PartyName/' + CBC + 'Name'),
+                  address=extract_address(element.find(CAC + 'PostalAddress')))
+    tax_scheme = element.find(CAC + 'PartyTaxScheme')
+    if tax_scheme is not None:
+        party.tax_scheme = PartyTaxScheme(text_of(tax_scheme, CBC + 'RegistrationName'),
+                                          text_of(tax_scheme, CBC + 'CompanyID'),
+                                          text_of(tax_scheme, CAC + 'TaxScheme/' + CBC + 'ID'))
+    contact = element.find(CAC + 'Contact')
+    if contact is not None:
+        mail = text_of(contact, CBC + 'ElectronicMail')
+        party.contact = Contact(text_of(contact, CBC + 'Name'), text_of(contact, CBC + 'Telephone'), mail,
+                                params['language'] if mail is not None else None)
+    if customer:
+        kbo_number = params['kbo_number']
+        party.endpoint_id = kbo_number
+        # The legal entity of the customer is built from its tax scheme, or from the kbo number.
+        if party.tax_scheme is not None:
+            party.legal_entity = LegalEntity(party.tax_scheme.registration_name, party.tax_scheme.company_id)
+        else:
+            party.legal_entity = LegalEntity(registered('name', kbo_number, party.name), kbo_number)
+        return party
+    # Take the endpoint id from the vat number of the supplier when the KBO registry knows it.
+    company_id = party.tax_scheme.company_id if party.tax_scheme is not None else None
+    party.endpoint_id = registered('number', company_id, params['supplier_number'])
+    legal_entity = element.find(CAC + 'PartyLegalEntity')
+    if legal_entity is not None:
+        party.legal_entity = LegalEntity(
+            text_of(legal_entity, CBC + 'RegistrationName'), text_of(legal_entity, CBC + 'CompanyID'),
+            text_of(legal_entity, CAC + 'RegistrationAddress/' + CAC + 'Country/' + CBC + 'IdentificationCode'))
+    return party
+
+
+def extract_delivery(element):
+    """
+    :param element: The Delivery element.
+    :return: The Delivery.
+    """
+    party = element.find(CAC + 'DeliveryParty')
+    return Delivery(text_of(element, CBC + 'ActualDeliveryDate'),
+                    extract_address(element.find(CAC + 'DeliveryLocation/' + CAC + 'Address')),
+                    text_of(party, CAC + 'PartyName/' + CBC + 'Name'),
+                    extract_address(party.find(CAC + 'PostalAddress')) if party is not None else None)
+
+
+def extract_payment_means(element):
+    """
+    :param element: A PaymentMeans element.
+    :return: The PaymentMeans.
+    """
+    account = element.find(CAC + 'PayeeFinancialAccount')
+    branch = account.find(CAC + 'FinancialInstitutionBranch') if account is not None else None
+    return PaymentMeans(text_of(element, CBC + 'PaymentMeansCode'), text_of(element, CBC + 'PaymentID'),
+                        text_of(account, CBC + 'ID'), text_of(account, CBC + 'Name'), text_of(branch, CBC + 'ID'),
+                        text_of(branch, CAC + 'FinancialInstitution/' + CBC + 'ID'))
+
+
+def extract_tax_category(element):
+    """
+    Read a tax category in a single pass over its children.
+    :param element: A TaxCategory or ClassifiedTaxCategory element, may be None.
+    :return: The TaxCategory or None, its id is TAX_CATEGORY_ID.
+    """
+    if element is None:
+        return None
+    category = TaxCategory()
+    for child in element:
+        field = TAX_CATEGORY_FIELDS.get(child.tag)
+        if field is not None:
+            setattr(category, field, child.text or '')
+        elif child.tag == TAX_SCHEME:
+            category.tax_scheme = text_of(child, CBC + 'ID')
+    return category
+
+
+def extract_tax_total(element):
+    """
+    :param element: A TaxTotal element of the invoice.
+    :return: The TaxTotal, the percent of its subtotals is dropped.
+    """
+    tax_total = TaxTotal(amount_of(element, CBC + 'TaxAmount'))
+    for subtotal in element.iterfind(CAC + 'TaxSubtotal'):
+        tax_total.subtotals.append(TaxSubtotal(amount_of(subtotal, CBC + 'TaxableAmount'),
+                                               amount_of(subtotal, CBC + 'TaxAmount'),
+                                               extract_tax_category(subtotal.find(CAC + 'TaxCategory'))))
+    return tax_total
+
+
+def extract_monetary_total(element):
+    """
+    :param element: The LegalMonetaryTotal element.
+    :return: The MonetaryTotal.
+    """
+    total = MonetaryTotal()
+    for field, tag in MONETARY_TOTAL_FIELDS:
+        setattr(total, field, amount_of(element, CBC + tag))
+    return total
+
+
+def extract_line(element):
+    """
+    Read an invoice line in a single pass over its children.
+    :param element: An InvoiceLine element.
+    :return: The InvoiceLine, its tax category is taken from its tax total like the rules do.
+    """
+    line = InvoiceLine()
+    tax_total = None
+    for child in element:
+        tag = child.tag
+        field = LINE_FIELDS.get(tag)
+        if field is not None:
+            setattr(line, field, child.text or '')
+        elif tag == LINE_EXTENSION_AMOUNT:
+            line.line_extension_amount = Amount(child.text or '', child.get('currencyID'))
+        elif tag == TAX_TOTAL:
+            tax_total = child
+        elif tag == PRICE:
+            line.price_amount = amount_of(child, CBC + 'PriceAmount')
+            base_quantity = child.find(CBC + 'BaseQuantity')
+            if base_quantity is not None:
+                line.base_quantity = base_quantity.text or ''
+                line.base_quantity_unit = base_quantity.get('unitCode')
+    line.category = extract_tax_category(tax_total.find(TAX_CATEGORY_PATH) if tax_total is not None else None)
+    return line
+
+
+def extract_child(invoice, element, params):
+    """
+    Read a child of the invoice root into the model.
+    :param invoice: The Invoice being read, updated in place.
+    :param element: The child element.
+    :param params: The values of model_params.
+    :raise Unmodelled: When the model does not read everything the child holds.
+    """
+    tag = element.tag
+    if not isinstance(tag, str):
+        return
+    shape = INVOICE_SHAPE.get(tag)
+    if shape is None:
+        raise Unmodelled(local_name(tag))
+    check_shape(element, shape)
+    field = HEADER_FIELDS.get(tag)
+    if field is not None:
+        if getattr(invoice, field) is not None:
+            raise Unmodelled(local_name(tag))
+        setattr(invoice, field, element.text or '')
+    elif tag == CAC + 'InvoiceLine':
+        invoice.lines.append(extract_line(element))
+    elif tag == CBC + 'Note':
+        invoice.notes.append(element.text or '')
+    elif tag == CAC + 'PaymentMeans':
+        invoice.payment_means.append(extract_payment_means(element))
+    elif tag == CAC + 'TaxTotal':
+        invoice.tax_totals.append(extract_tax_total(element))
+    elif tag in SINGLE_CHILDREN:
+        field, extract = SINGLE_CHILDREN[tag]
+        if getattr(invoice, field) is not None:
+            raise Unmodelled(local_name(tag))
+        setattr(invoice, field, extract(element, params))
+
+
+# Children of the invoice root read into a single Invoice field, tag -> (field, function (element, params) -> value).
+SINGLE_CHILDREN = {
+    CAC + 'AccountingSupplierParty': ('supplier', lambda element, params: extract_party(element, params, False)),
+    CAC + 'AccountingCustomerParty': ('customer', lambda element, params: extract_party(element, params, True)),
+    CAC + 'Delivery': ('delivery', lambda element, params: extract_delivery(element)),
+    CAC + 'LegalMonetaryTotal': ('monetary_total', lambda element, params: extract_monetary_total(element)),
+    CAC + 'OrderReference': ('order_reference', lambda element, params: text_of(element, CBC + 'ID')),
+}
+
+
+def extract_invoice(root, params):
+    """
+    Read a parsed invoice into the model.
+    :param root: The Invoice root element.
+    :param params: The values of model_params.
+    :return: The Invoice.
+    """
+    invoice = Invoice()
+    for child in root:
+        extract_child(invoice, child, params)
+    return invoice
+
+
+def parse_invoice(source, params, chunk_size=CHUNK_SIZE, backend=None, max_bytes=None):
+    """
+    Parse an invoice xml into the model in one pass: every child of the root is read into the model and freed as soon
+    as it closes, so the parsed tree never holds more than one of them, e.g. one invoice line.
+    :param source: The invoice xml in bytes, a file path or a binary file object, may be compressed
+                   (src/decompress.py).
+    :param params: The values of model_params.
+    :param chunk_size: The number of bytes fed to the parser at a time.
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :param max_bytes: Largest accepted decompressed document, see src/decompress.py.
+    :return: The Invoice.
+    """
+    backend = backend or get_backend()
+    parser = backend.pull_parser()
+    invoice = Invoice()
+    root = None
+    depth = 0
+    for chunk in read_plain_chunks(source, chunk_size, max_bytes):
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = element
+                continue
+            depth -= 1
+            if depth == 1:
+                extract_child(invoice, element, params)
+                root.remove(element)
+    parser.close()
+    return invoice
+
+
+def write_leaf(append, name, text, attributes=()):
+    """
+    Write an element holding only text, nothing when the text is None.
+    :param append: Function collecting the strings.
+    :param name: The prefixed tag.
+    :param text: The text.
+    :param attributes: Tuple of (name, value) pairs, pairs with value None are left out.
+    """
+    if text is None:
+        return
+    start = name
+    for key, value in attributes:
+        if value is not None:
+            start += ' %s="%s"' % (key, escape_attribute(value))
+    append('<%s>%s</%s>' % (start, escape_text(text), name))
+
+
+def write_amount(append, name, amount):
+    """
+    :param append: Function collecting the strings.
+    :param name: The prefixed tag.
+    :param amount: The Amount or None.
+    """
+    if amount is not None:
+        write_leaf(append, name, amount.value, (('currencyID', amount.currency),))
+
+
+def write_country(append, code):
+    """
+    :param append: Function collecting the strings.
+    :param code: The country code or None.
+    """
+    if code is not None:
+        append('<cac:Country>')
+        write_leaf(append, 'cbc:IdentificationCode', code, (('listID', COUNTRY_LIST_ID),))
+        append('</cac:Country>')
+
+
+def write_address(append, name, address):
+    """
+    :param append: Function collecting the strings.
+    :param name: The prefixed tag, e.g. 'cac:PostalAddress'.
+    :param address: The Address or None.
+    """
+    if address is None:
+        return
+    append('<%s>' % name)
+    write_leaf(append, 'cbc:StreetName', address.street)
+    write_leaf(append, 'cbc:AdditionalStreetName', address.additional_street)
+    write_leaf(append, 'cbc:CityName', address.city)
+    write_leaf(append, 'cbc:PostalZone', address.postal_zone)
+    write_leaf(append, 'cbc:CountrySubentity', address.subentity)
+    if address.line is not None:
+        append('<cac:AddressLine>')
+        write_leaf(append, 'cbc:Line', address.line)
+        append('</cac:AddressLine>')
+    write_country(append, address.country)
+    append('</%s>' % name)
+
+
+def write_party(append, name, party):
+    """
+    :param append: Function collecting the strings.
+    :param name: 'cac:AccountingSupplierParty' or 'cac:AccountingCustomerParty'.
+    :param party: The Party or None.
+    """
+    if party is None:
+        return
+    append('<%s><cac:Party>' % name)
+    write_leaf(append, 'cbc:EndpointID', party.endpoint_id, (('schemeID', party.endpoint_scheme),))
+    if party.name is not None:
+        append('<cac:PartyName>')
+        write_leaf(append, 'cbc:Name', party.name)
+        append('</cac:PartyName>')
+    write_address(append, 'cac:PostalAddress', party.address)
+    tax_scheme = party.tax_scheme
+    if tax_scheme is not None:
+        append('<cac:PartyTaxScheme>')
+        write_leaf(append, 'cbc:RegistrationName', tax_scheme.registration_name)
+        write_leaf(append, 'cbc:CompanyID', tax_scheme.company_id)
+        write_tax_scheme(append, tax_scheme.tax_scheme)
+        append('</cac:PartyTaxScheme>')
+    legal_entity = party.legal_entity
+    if legal_entity is not None:
+        append('<cac:PartyLegalEntity>')
+        write_leaf(append, 'cbc:RegistrationName', legal_entity.registration_name)
+        write_leaf(append, 'cbc:CompanyID', legal_entity.company_id)
+        if legal_entity.country is not None:
+            append('<cac:RegistrationAddress>')
+            write_country(append, legal_entity.country)
+            append('</cac:RegistrationAddress>')
+        append('</cac:PartyLegalEntity>')
+    contact = party.contact
+    if contact is not None:
+        append('<cac:Contact>')
+        write_leaf(append, 'cbc:Name', contact.name)
+        write_leaf(append, 'cbc:Telephone', contact.telephone)
+        write_leaf(append, 'cbc:ElectronicMail', contact.electronic_mail, (('languageID', contact.language),))
+        append('</cac:Contact>')
+    append('</cac:Party></%s>' % name)
+
+
+def write_delivery(append, delivery):
+    """
+    :param append: Function collecting the strings.
+    :param delivery: The Delivery or None.
+    """
+    if delivery is None:
+        return
+    append('<cac:Delivery>')
+    write_leaf(append, 'cbc:ActualDeliveryDate', delivery.date)
+    if delivery.location is not None:
+        append('<cac:DeliveryLocation>')
+        write_address(append, 'cac:Address', delivery.location)
+        append('</cac:DeliveryLocation>')
+    if delivery.party_name is not None or delivery.party_address is not None:
+        append('<cac:DeliveryParty>')
+        if delivery.party_name is not None:
+            append('<cac:PartyName>')
+            write_leaf(append, 'cbc:Name', delivery.party_name)
+            append('</cac:PartyName>')
+        write_address(append, 'cac:PostalAddress', delivery.party_address)
+        append('</cac:DeliveryParty>')
+    append('</cac:Delivery>')
+
+
+def write_payment_means(append, payment_means):
+    """
+    :param append: Function collecting the strings.
+    :param payment_means: The PaymentMeans.
+    """
+    append('<cac:PaymentMeans>')
+    write_leaf(append, 'cbc:PaymentMeansCode', payment_means.code, (('listID', 'UNCL4461'),))
+    write_leaf(append, 'cbc:PaymentID', payment_means.payment_id)
+    if payment_means.account_id is not None:
+        append('<cac:PayeeFinancialAccount>')
+        write_leaf(append, 'cbc:ID', payment_means.account_id, (('schemeID', 'IBAN'),))
+        write_leaf(append, 'cbc:Name', payment_means.account_name)
+        if payment_means.branch_id is not None or payment_means.bic is not None:
+            append('<cac:FinancialInstitutionBranch>')
+            write_leaf(append, 'cbc:ID', payment_means.branch_id)
+            if payment_means.bic is not None:
+                append('<cac:FinancialInstitution>')
+                write_leaf(append, 'cbc:ID', payment_means.bic, (('schemeID', 'BIC'),))
+                append('</cac:FinancialInstitution>')
+            append('</cac:FinancialInstitutionBranch>')
+        append('</cac:PayeeFinancialAccount>')
+    append('</cac:PaymentMeans>')
+
+
+def write_tax_scheme(append, tax_scheme):
+    """
+    :param append: Function collecting the strings.
+    :param tax_scheme: The tax scheme id, e.g. 'VAT', or None.
+    """
+    if tax_scheme is not None:
+        append('<cac:TaxScheme>')
+        write_leaf(append, 'cbc:ID', tax_scheme)
+        append('</cac:TaxScheme>')
+
+
+def write_tax_category(append, name, category):
+    """
+    :param append: Function collecting the strings.
+    :param name: 'cac:TaxCategory' or 'cac:ClassifiedTaxCategory'.
+    :param category: The TaxCategory or None.
+    """
+    append('<%s>' % name)
+    if category is not None:
+        write_leaf(append, 'cbc:ID', TAX_CATEGORY_ID, (('schemeID', 'UNCL5305'),))
+        write_leaf(append, 'cbc:Percent', category.percent)
+        write_leaf(append, 'cbc:TaxExemptionReasonCode', category.exemption_reason_code)
+        write_leaf(append, 'cbc:TaxExemptionReason', category.exemption_reason)
+        write_tax_scheme(append, category.tax_scheme)
+    append('</%s>' % name)
+
+
+def write_tax_total(append, tax_total):
+    """
+    :param append: Function collecting the strings.
+    :param tax_total: The TaxTotal.
+    """
+    append('<cac:TaxTotal>')
+    write_amount(append, 'cbc:TaxAmount', tax_total.tax_amount)
+    for subtotal in tax_total.subtotals:
+        append('<cac:TaxSubtotal>')
+        write_amount(append, 'cbc:TaxableAmount', subtotal.taxable_amount)
+        write_amount(append, 'cbc:TaxAmount', subtotal.tax_amount)
+        if subtotal.category is not None:
+            write_tax_category(append, 'cac:TaxCategory', subtotal.category)
+        append('</cac:TaxSubtotal>')
+    append('</cac:TaxTotal>')
+
+
+def write_monetary_total(append, total):
+    """
+    :param append: Function collecting the strings.
+    :param total: The MonetaryTotal or None.
+    """
+    if total is None:
+        return
+    append('<cac:LegalMonetaryTotal>')
+    for field, tag in MONETARY_TOTAL_FIELDS:
+        write_amount(append, 'cbc:' + tag, getattr(total, field))
+    append('</cac:LegalMonetaryTotal>')
+
+
+def write_line(append, line):
+    """
+    :param append: Function collecting the strings.
+    :param line: The InvoiceLine.
+    """
+    append('<cac:InvoiceLine>')
+    write_leaf(append, 'cbc:ID', line.id)
+    write_leaf(append, 'cbc:Note', line.note)
+    write_leaf(append, 'cbc:InvoicedQuantity', line.quantity, tuple(UNIT_CODE_ATTRIBUTES.items()))
+    write_amount(append, 'cbc:LineExtensionAmount', line.line_extension_amount)
+    append('<cac:Item>')
+    write_leaf(append, 'cbc:Name', LINE_ITEM_NAME)
+    write_tax_category(append, 'cac:ClassifiedTaxCategory', line.category)
+    append('</cac:Item>')
+    if line.price_amount is not None or line.base_quantity is not None:
+        append('<cac:Price>')
+        write_amount(append, 'cbc:PriceAmount', line.price_amount)
+        write_leaf(append, 'cbc:BaseQuantity', line.base_quantity, (('unitCode', line.base_quantity_unit),))
+        append('</cac:Price>')
+    append('</cac:InvoiceLine>')
+
+
+def emit_invoice(invoice, xml_declaration=True):
+    """
+    Write the peppol BIS 3.0 xml of an invoice model, every element in the order of the UBL schema whatever the order
+    of the input was.
+    :param invoice: The Invoice.
+    :param xml_declaration: Start with an xml declaration.
+    :return: The utf-8 encoded xml.
+    """
+    parts = [XML_DECLARATION] if xml_declaration else []
+    append = parts.append
+    # Every aggregate child of the root starts a line of output, their own children follow without whitespace.
+    append('<Invoice xmlns="%s"%s>' % (NAMESPACES['inv'], ROOT_DECLARATIONS))
+    write_leaf(append, 'cbc:UBLVersionID', invoice.ubl_version)
+    write_leaf(append, 'cbc:CustomizationID', CUSTOMIZATION_ID)
+    write_leaf(append, 'cbc:ProfileID', PROFILE_ID)
+    write_leaf(append, 'cbc:ID', invoice.id)
+    write_leaf(append, 'cbc:IssueDate', invoice.issue_date)
+    write_leaf(append, 'cbc:DueDate', invoice.due_date)
+    write_leaf(append, 'cbc:InvoiceTypeCode', invoice.type_code, (('listID', 'UNCL1001'),))
+    for note in invoice.notes:
+        write_leaf(append, 'cbc:Note', note)
+    write_leaf(append, 'cbc:TaxPointDate', invoice.tax_point_date)
+    write_leaf(append, 'cbc:DocumentCurrencyCode', invoice.currency, (('listID', 'ISO4217'),))
+    write_leaf(append, 'cbc:TaxCurrencyCode', invoice.tax_currency)
+    write_leaf(append, 'cbc:AccountingCost', invoice.accounting_cost)
+    write_leaf(append, 'cbc:BuyerReference', invoice.buyer_reference)
+    if invoice.order_reference is not None:
+        append('\n<cac:OrderReference>')
+        write_leaf(append, 'cbc:ID', invoice.order_reference)
+        append('</cac:OrderReference>')
+    for name, party in (('cac:AccountingSupplierParty', invoice.supplier),
+                        ('cac:AccountingCustomerParty', invoice.customer)):
+        if party is not None:
+            append('\n')
+            write_party(append, name, party)
+    if invoice.delivery is not None:
+        append('\n')
+        write_delivery(append, invoice.delivery)
+    for payment_means in invoice.payment_means:
+        append('\n')
+        write_payment_means(append, payment_means)
+    for tax_total in invoice.tax_totals:
+        append('\n')
+        write_tax_total(append, tax_total)
+    if invoice.monetary_total is not None:
+        append('\n')
+        write_monetary_total(append, invoice.monetary_total)
+    for line in invoice.lines:
+        append('\n')
+        write_line(append, line)
+    append('\n</Invoice>')
+    return ''.join(parts).encode('utf-8')
@@ -0,0 +1,132 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import tracemalloc
+import uuid
+
+DEFAULT_PROFILE_DIR = 'profiles'
+# Frames kept per allocation traceback.
+TRACEBACK_FRAMES = 16
+# Allocation sites and functions listed in the reports.
+TOP_ENTRIES = 30
+# Deepest stack written to the collapsed stacks.
+MAX_DEPTH = 64
+# tracemalloc traces the whole process, so profiled conversions run one at a time.
+_lock = threading.Lock()
+
+
+def profile_id(value=None):
+    """
+    Get a safe id to name the reports of a profiled run.
+    :param value: A requested id, e.g. a request id header or an output file name.
+    :return: The value with everything but letters, digits, '.', '_' and '-' replaced, a random id when empty.
+    """
+    value = re.sub(r'[^A-Za-z0-9._-]', '_', value or '').strip('.')[:128]
+    return value or uuid.uuid4().hex
+
+
+def profile_call(key, directory, function, *args, **kwargs):
+    """
+    Run a function under cProfile and tracemalloc and save the reports:
+    <key>.pstats (load with pstats or snakeviz), <key>.collapsed (collapsed stacks for flamegraph.pl or speedscope)
+    and <key>.txt (the slowest functions and the top allocation sites).
+    :param key: Id of the run, see profile_id.
+    :param directory: Directory to save the reports in, defaults to the PROFILE_DIR environment variable or profiles.
+    :param function: The function to profile.
+    :param args: Positional arguments of the function.
+    :param kwargs: Keyword arguments of the function.
+    :return: The result of the function.
+    """
+    directory = directory or os.environ.get('PROFILE_DIR') or DEFAULT_PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, profile_id(key))
+    profiler = cProfile.Profile()
+    with _lock:
+        # Keep tracing when someone else started it, e.g. the benchmark.
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(TRACEBACK_FRAMES)
+        tracemalloc.reset_peak()
+        try:
+            profiler.enable()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                profiler.disable()
+            snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            if started:
+                tracemalloc.stop()
+    profiler.dump_stats(base + '.pstats')
+    stats = pstats.Stats(profiler)
+    with open(base + '.collapsed', 'w') as f:
+        for stack, microseconds in collapsed_stacks(stats):
+            f.write('%s %d\n' % (';'.join(stack), microseconds))
+    with open(base + '.txt', 'w') as f:
+        f.write(format_report(stats, snapshot, peak))
+    return result
+
+
+def function_name(function):
+    """
+    :param function: A pstats function key (file name, line number, function name).
+    :return: A readable name, e.g. 'rules.py:358(transform)'.
+    """
+    file_name, line, name = function
+    if file_name == '~':
+        # Builtins.
+        return name
+    return '%s:%d(%s)' % (os.path.basename(file_name), line, name)
+
+
+def collapsed_stacks(stats):
+    """
+    Turn a profile into collapsed stacks. cProfile only records caller and callee pairs, so the time of a function is
+    split over the stacks it was called from in proportion to the time of every call edge.
+    :param stats: The pstats.Stats.
+    :return: Generator of (list of function names from the root, self time in microseconds).
+    """
+    callees = {}
+    roots = []
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            roots.append(function)
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((function, edge[3]))
+
+    def walk(function, seconds, stack):
+        total_time, cumulative_time = stats.stats[function][2], stats.stats[function][3]
+        share = seconds / cumulative_time if cumulative_time else 0.0
+        stack = stack + [function_name(function)]
+        self_time = total_time * share
+        if self_time >= 1e-6:
+            yield stack, int(self_time * 1e6)
+        if len(stack) >= MAX_DEPTH:
+            return
+        for callee, edge_time in callees.get(function, ()):
+            # Recursion is counted once, at its outermost call.
+            if function_name(callee) not in stack:
+                yield from walk(callee, edge_time * share, stack)
+    for root in roots:
+        yield from walk(root, stats.stats[root][3], [])
+
+
+def format_report(stats, snapshot, peak):
+    """
+    Format the slowest functions and the top allocation sites of a profiled run.
+    :param stats: The pstats.Stats.
+    :param snapshot: The tracemalloc snapshot taken at the end of the run.
+    :param peak: The peak traced memory in bytes.
+    :return: The report as text.
+    """
+    output = io.StringIO()
+    stats.stream = output
+    stats.sort_stats('cumulative').print_stats(TOP_ENTRIES)
+    output.write('Peak traced memory: %.1f KiB\n\nTop allocation sites still allocated at the end:\n' % (peak / 1024))
+    for statistic in snapshot.statistics('lineno')[:TOP_ENTRIES]:
+        output.write('  %s\n' % statistic)
+    return output.getvalue()
@@ -0,0 +1,491 @@
+import copy
+import functools
+import hashlib
+import time
+from collections import namedtuple
+
+from src.backend import lxml_etree
+
+NAMESPACES = {
+    'inv': 'urn:oasis:names:specification:ubl:schema:xsd:Invoice-2',
+    'cac': 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2',
+    'cbc': 'urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2',
+}
+
+# A rule applies `action` to every element whose path ends with `path`.
+# path:   '/'-separated prefixed tags, matched against the end of the path from the root, e.g. 'cac:Party/cac:Contact'.
+# action: one of the tuples below, relative paths in actions are '/'-separated prefixed child tags.
+#   ('set', {attribute: value})         set attributes
+#   ('text', value)                     set the text
+#   ('clear',)                          remove all attributes
+#   ('unset', (attribute, ...))         remove attributes when present
+#   ('remove', path)                    remove all children at the relative path
+#   ('insert', position, Element(...))  insert a new child built from the template, list.insert semantics
+#   ('move', source, target)            move the children of the source element to the target element
+# when/unless: optional relative path that must (not) exist for the rule to apply.
+Rule = namedtuple('Rule', 'name path action when unless', defaults=(None, None))
+# Template of an element to insert, text may be a string, Param, TextOf or Lookup, children may be Element or Copy.
+Element = namedtuple('Element', 'tag attrib text children', defaults=(None, None, ()))
+# Value taken from the parameters passed to the transformer.
+Param = namedtuple('Param', 'name')
+# Text of the element at the relative path.
+TextOf = namedtuple('TextOf', 'path')
+# Field of the Enterprise registered under number in the KBO registry passed as the 'registry' parameter (see
+# src/kbo.py), or default when there is no registry or it does not know the number. number and default may be a
+# string, Param or TextOf.
+Lookup = namedtuple('Lookup', 'field number default', defaults=(None,))
+# Deep copy of the element at the relative path.
+Copy = namedtuple('Copy', 'path')
+
+# The Peppol BIS Billing 3.0 ids of a converted invoice.
+CUSTOMIZATION_ID = 'urn:cen.eu:en16931:2017#compliant#urn:fdc:peppol.eu:2017:poacc:billing:3.0'
+PROFILE_ID = 'urn:fdc:peppol.eu:2017:poacc:billing:01:1.0'
+
+# The peppol rules take endpoint_scheme, supplier_number and language from the tenant profile (see src/tenants.py),
+# which binds them into the rule table before compiling it, and kbo_number and registry per conversion.
+
+PEPPOL_RULES = (
+    # Header.
+    # Replace the ids an invoice already carries, add them otherwise.
+    Rule('customization-id-text', 'inv:Invoice/cbc:CustomizationID', ('text', CUSTOMIZATION_ID)),
+    Rule('customization-id', 'inv:Invoice', ('insert', 1, Element('cbc:CustomizationID', text=CUSTOMIZATION_ID)),
+         unless='cbc:CustomizationID'),
+    Rule('profile-id-text', 'inv:Invoice/cbc:ProfileID', ('text', PROFILE_ID)),
+    Rule('profile-id', 'inv:Invoice', ('insert', 2, Element('cbc:ProfileID', text=PROFILE_ID)), unless='cbc:ProfileID'),
+    Rule('invoice-type-code-list-id', 'inv:Invoice/cbc:InvoiceTypeCode', ('set', {'listID': 'UNCL1001'})),
+    Rule('document-currency-code-list-id', 'inv:Invoice/cbc:DocumentCurrencyCode', ('set', {'listID': 'ISO4217'})),
+    # Tax total.
+    Rule('tax-subtotal-remove-percent', 'inv:Invoice/cac:TaxTotal/cac:TaxSubtotal', ('remove', 'cbc:Percent')),
+    Rule('tax-category-id-clear', 'cac:TaxTotal/cac:TaxSubtotal/cac:TaxCategory/cbc:ID', ('clear',)),
+    Rule('tax-category-id-scheme', 'cac:TaxTotal/cac:TaxSubtotal/cac:TaxCategory/cbc:ID',
+         ('set', {'schemeID': 'UNCL5305'})),
+    Rule('tax-category-id-text', 'cac:TaxTotal/cac:TaxSubtotal/cac:TaxCategory/cbc:ID', ('text', 'S')),
+    Rule('tax-category-tax-scheme-id-clear', 'cac:TaxTotal/cac:TaxSubtotal/cac:TaxCategory/cac:TaxScheme/cbc:ID',
+         ('clear',)),
+    # Parties.
+    Rule('supplier-endpoint-id', 'cac:AccountingSupplierParty/cac:Party', ('insert', 0, Element(
+        'cbc:EndpointID', {'schemeID': Param('endpoint_scheme')},
+        Lookup('number', TextOf('cac:PartyTaxScheme/cbc:CompanyID'), Param('supplier_number'))))),
+    Rule('supplier-remove-website-uri', 'cac:AccountingSupplierParty/cac:Party', ('remove', 'cbc:WebsiteURI')),
+    Rule('customer-endpoint-id', 'cac:AccountingCustomerParty/cac:Party', ('insert', 0, Element(
+        'cbc:EndpointID', {'schemeID': Param('endpoint_scheme')}, Param('kbo_number')))),
+    Rule('customer-party-legal-entity-from-tax-scheme', 'cac:AccountingCustomerParty/cac:Party', ('insert', -1, Element(
+        'cac:PartyLegalEntity', children=(Copy('cac:PartyTaxScheme/cbc:RegistrationName'),
+                                          Copy('cac:PartyTaxScheme/cbc:CompanyID')))),
+         when='cac:PartyTaxScheme'),
+    Rule('customer-party-legal-entity-from-party-name', 'cac:AccountingCustomerParty/cac:Party', ('insert', -1, Element(
+        'cac:PartyLegalEntity', children=(Element('cbc:RegistrationName', text=Lookup(
+            'name', Param('kbo_number'), TextOf('cac:PartyName/cbc:Name'))),
+                                          Element('cbc:CompanyID', text=Param('kbo_number'))))),
+         unless='cac:PartyTaxScheme'),
+    Rule('party-country-list-id', 'cac:Party/cac:PostalAddress/cac:Country/cbc:IdentificationCode',
+         ('set', {'listID': 'ISO3166-1:Alpha2'})),
+    Rule('party-tax-scheme-id-unset', 'cac:Party/cac:PartyTaxScheme/cac:TaxScheme/cbc:ID',
+         ('unset', ('schemeID', 'schemeAgencyID'))),
+    Rule('supplier-legal-entity-country-list-id',
+         'cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cac:RegistrationAddress/cac:Country'
+         '/cbc:IdentificationCode', ('set', {'listID': 'ISO3166-1:Alpha2'})),
+    Rule('party-electronic-mail-language-id', 'cac:Party/cac:Contact/cbc:ElectronicMail',
+         ('set', {'languageID': Param('language')})),
+    # Delivery.
+    Rule('delivery-location-country-list-id',
+         'cac:Delivery/cac:DeliveryLocation/cac:Address/cac:Country/cbc:IdentificationCode',
+         ('set', {'listID': 'ISO3166-1:Alpha2'})),
+    Rule('delivery-party-country-list-id',
+         'cac:Delivery/cac:DeliveryParty/cac:PostalAddress/cac:Country/cbc:IdentificationCode',
+         ('set', {'listID': 'ISO3166-1:Alpha2'})),
+    # Payment means.
+    Rule('payment-means-code-list-id', 'cac:PaymentMeans/cbc:PaymentMeansCode', ('set', {'listID': 'UNCL4461'})),
+    Rule('payee-account-id-unset', 'cac:PaymentMeans/cac:PayeeFinancialAccount/cbc:ID', ('unset', ('schemeName',))),
+    Rule('payee-account-id-scheme', 'cac:PaymentMeans/cac:PayeeFinancialAccount/cbc:ID', ('set', {'schemeID': 'IBAN'})),
+    Rule('financial-institution-id-unset',
+         'cac:PayeeFinancialAccount/cac:FinancialInstitutionBranch/cac:FinancialInstitution/cbc:ID',
+         ('unset', ('schemeName',))),
+    Rule('financial-institution-id-scheme',
+         'cac:PayeeFinancialAccount/cac:FinancialInstitutionBranch/cac:FinancialInstitution/cbc:ID',
+         ('set', {'schemeID': 'BIC'})),
+    # Invoice lines.
+    Rule('line-quantity-unit-code', 'cac:InvoiceLine/cbc:InvoicedQuantity',
+         ('set', {'unitCode': 'C62', 'unitCodeListID': 'UNECERec20'})),
+    Rule('line-remove-item', 'cac:InvoiceLine', ('remove', 'cac:Item')),
+    Rule('line-item', 'cac:InvoiceLine', ('insert', 3, Element(
+        'cac:Item', children=(Element('cbc:Name', text='Classified taxcategory'),
+                              Element('cac:ClassifiedTaxCategory'))))),
+    Rule('line-classified-tax-category', 'cac:InvoiceLine',
+         ('move', 'cac:TaxTotal/cac:TaxSubtotal/cac:TaxCategory', 'cac:Item/cac:ClassifiedTaxCategory')),
+    Rule('line-remove-tax-total', 'cac:InvoiceLine', ('remove', 'cac:TaxTotal')),
+)
+
+
+def qualify(prefixed):
+    """
+    Turn a prefixed tag into ElementTree's {uri}tag notation.
+    :param prefixed: The tag, e.g. 'cac:Party'.
+    :return: The qualified tag.
+    """
+    prefix, tag = prefixed.split(':')
+    return '{%s}%s' % (NAMESPACES[prefix], tag)
+
+
+def qualify_path(path):
+    """
+    Turn a '/'-separated path of prefixed tags into a tuple of qualified tags.
+    :param path: The path, e.g. 'cac:Party/cac:Contact'.
+    :return: Tuple of qualified tags.
+    """
+    return tuple(qualify(step) for step in path.split('/'))
+
+
+def find_path(element, steps):
+    """
+    Follow a path of direct children.
+    :param element: The element to start from.
+    :param steps: Tuple of qualified tags.
+    :return: The first element at the end of the path or None.
+    """
+    for step in steps:
+        element = element.find(step)
+        if element is None:
+            return None
+    return element
+
+
+def resolve(value, element, params):
+    """
+    Resolve a compiled template value.
+    :param value: A string, or a tuple ('param', name), ('text_of', steps) or ('lookup', field, number, default).
+    :param element: The element the rule applies to.
+    :param params: The parameters passed to the transformer.
+    :return: The string value or None.
+    """
+    if isinstance(value, tuple):
+        if value[0] == 'param':
+            return params[value[1]]
+        if value[0] == 'lookup':
+            registry = params.get('registry')
+            if registry is not None:
+                enterprise = registry.lookup(resolve(value[2], element, params))
+                if enterprise is not None and getattr(enterprise, value[1]):
+                    return getattr(enterprise, value[1])
+            return resolve(value[3], element, params)
+        found = find_path(element, value[1])
+        return None if found is None else found.text
+    return value
+
+
+def bind_value(value, values):
+    """
+    Replace the parameters of a template value that have a fixed value.
+    :param value: A string, Param, TextOf or Lookup.
+    :param values: Dict of parameter name -> value.
+    :return: The value with the bound parameters replaced.
+    """
+    if isinstance(value, Param):
+        return values.get(value.name, value)
+    if isinstance(value, Lookup):
+        return Lookup(value.field, bind_value(value.number, values), bind_value(value.default, values))
+    return value
+
+
+def bind_template(template, values):
+    """
+    Replace the parameters of an Element or Copy template that have a fixed value.
+    :param template: The Element or Copy template.
+    :param values: Dict of parameter name -> value.
+    :return: The template with the bound parameters replaced.
+    """
+    if isinstance(template, Copy):
+        return template
+    attrib = template.attrib
+    if attrib is not None:
+        attrib = {name: bind_value(value, values) for name, value in attrib.items()}
+    return Element(template.tag, attrib, bind_value(template.text, values),
+                   tuple(bind_template(child, values) for child in template.children))
+
+
+def bind_rules(rules, values):
+    """
+    Replace the parameters of a rule table that have a fixed value, e.g. the settings of a tenant. Templates left
+    without parameters are built once and copied, see compile_template.
+    :param rules: Iterable of Rule.
+    :param values: Dict of parameter name -> value.
+    :return: Tuple of Rule.
+    """
+    bound = []
+    for rule in rules:
+        action = rule.action
+        if action[0] == 'set':
+            action = ('set', {name: bind_value(value, values) for name, value in action[1].items()})
+        elif action[0] == 'text':
+            action = ('text', bind_value(action[1], values))
+        elif action[0] == 'insert':
+            action = ('insert', action[1], bind_template(action[2], values))
+        bound.append(rule._replace(action=action))
+    return tuple(bound)
+
+
+def compile_value(value):
+    """
+    Compile a template value.
+    :param value: A string, Param, TextOf or Lookup.
+    :return: A string or a tuple understood by resolve.
+    """
+    if isinstance(value, Param):
+        return 'param', value.name
+    if isinstance(value, Lookup):
+        return 'lookup', value.field, compile_value(value.number), compile_value(value.default)
+    if isinstance(value, TextOf):
+        return 'text_of', qualify_path(value.path)
+    return value
+
+
+def compile_template(template):
+    """
+    Compile an Element or Copy template into a function building the element.
+    :param template: The Element or Copy template.
+    :return: Function (element, params) -> new element or None.
+    """
+    if isinstance(template, Copy):
+        steps = qualify_path(template.path)
+
+        def build_copy(element, params):
+            found = find_path(element, steps)
+            return None if found is None else copy.deepcopy(found)
+        return build_copy
+    tag = qualify(template.tag)
+    attrib = {name: compile_value(value) for name, value in (template.attrib or {}).items()}
+    text = compile_value(template.text)
+    children = [compile_template(child) for child in template.children]
+
+    def build_element(element, params):
+        # Built by the element's own factory so the new element belongs to the same XML backend.
+        new = element.makeelement(tag, {name: resolve(value, element, params) for name, value in attrib.items()})
+        new.text = resolve(text, element, params)
+        for child in children:
+            built = child(element, params)
+            if built is not None:
+                new.append(built)
+        return new
+    if not is_static(template):
+        return build_element
+    # Nothing depends on the element or the parameters: build the element once per XML backend and copy it.
+    prebuilt = {}
+
+    def build_prebuilt(element, params):
+        skeleton = prebuilt.get(type(element))
+        if skeleton is None:
+            skeleton = prebuilt[type(element)] = build_element(element, params)
+        return copy.deepcopy(skeleton)
+    return build_prebuilt
+
+
+def is_static(template):
+    """
+    Check whether a template builds the same element every time.
+    :param template: The Element or Copy template.
+    :return: True when it holds no Param, TextOf, Lookup or Copy.
+    """
+    if isinstance(template, Copy):
+        return False
+    values = [template.text] + list((template.attrib or {}).values())
+    return (not any(isinstance(value, (Param, TextOf, Lookup)) for value in values)
+            and all(is_static(child) for child in template.children))
+
+
+def compile_action(action):
+    """
+    Compile an action tuple into a function applying it.
+    :param action: The action tuple.
+    :return: Function (element, params) -> None.
+    """
+    kind = action[0]
+    if kind == 'set':
+        attributes = [(name, compile_value(value)) for name, value in action[1].items()]
+
+        def apply(element, params):
+            for name, value in attributes:
+                element.set(name, resolve(value, element, params))
+    elif kind == 'text':
+        text = compile_value(action[1])
+
+        def apply(element, params):
+            element.text = resolve(text, element, params)
+    elif kind == 'clear':
+        def apply(element, params):
+            element.attrib.clear()
+    elif kind == 'unset':
+        names = tuple(action[1])
+
+        def apply(element, params):
+            for name in names:
+                element.attrib.pop(name, None)
+    elif kind == 'remove':
+        steps = qualify_path(action[1])
+        parent_steps, tag = steps[:-1], steps[-1]
+
+        def apply(element, params):
+            parent = find_path(element, parent_steps)
+            if parent is not None:
+                for child in parent.findall(tag):
+                    parent.remove(child)
+    elif kind == 'insert':
+        position = action[1]
+        build = compile_template(action[2])
+
+        def apply(element, params):
+            element.insert(position, build(element, params))
+    elif kind == 'move':
+        source_steps = qualify_path(action[1])
+        target_steps = qualify_path(action[2])
+
+        def apply(element, params):
+            source = find_path(element, source_steps)
+            target = find_path(element, target_steps)
+            if source is not None and target is not None:
+                for child in list(source):
+                    source.remove(child)
+                    target.append(child)
+    else:
+        raise ValueError('Unknown rule action: %r' % (kind,))
+    return apply
+
+
+class Transformer:
+    """
+    Rule set compiled into a tag-dispatch table, applied to a document in a single depth-first walk.
+    Rules are applied to an element after its children were visited, in the order of the rule table, so elements
+    inserted or moved by a rule are never visited again.
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: Iterable of Rule.
+        """
+        self.rules = tuple(rules)
+        # Identifies the rule set, e.g. in cache keys of converted documents.
+        self.version = hashlib.sha1(repr(self.rules).encode('utf-8')).hexdigest()[:16]
+        compiled = []
+        for rule in self.rules:
+            steps = qualify_path(rule.path)
+            when = qualify_path(rule.when) if rule.when else None
+            unless = qualify_path(rule.unless) if rule.unless else None
+            compiled.append((steps[-1], (tuple(reversed(steps[:-1])), when, unless, compile_action(rule.action),
+                                         rule.name)))
+        # (qualified tag, parent tag) -> list of (reversed ancestor tags to match, when, unless, apply, rule name), in
+        # table order. Rules without ancestor steps are listed under every parent and under (tag, None), so most
+        # elements are ruled out by a single lookup.
+        self.dispatch = {}
+        for tag, candidate in compiled:
+            parent = candidate[0][0] if candidate[0] else None
+            self.dispatch[tag, parent] = [other for other_tag, other in compiled
+                                          if other_tag == tag and (not other[0] or other[0][0] == parent)]
+        self.tags = tuple({tag for tag, _ in compiled})
+
+    def candidates(self, tag, parent):
+        """
+        :param tag: The tag of an element.
+        :param parent: The tag of its parent or None.
+        :return: The compiled rules that may apply to the element or None.
+        """
+        return self.dispatch.get((tag, parent)) or self.dispatch.get((tag, None))
+
+    def matches(self, ancestors, element, candidate):
+        """
+        Check whether a compiled rule applies to an element.
+        :param ancestors: List of the tags of the ancestors of the element, from the root down.
+        :param element: The element.
+        :param candidate: The compiled rule.
+        :return: True when the rule applies.
+        """
+        steps, when, unless = candidate[:3]
+        if len(steps) > len(ancestors):
+            return False
+        for depth, step in enumerate(steps, 1):
+            if ancestors[-depth] != step:
+                return False
+        if when is not None and find_path(element, when) is None:
+            return False
+        if unless is not None and find_path(element, unless) is not None:
+            return False
+        return True
+
+    def apply(self, ancestors, element, candidates, params, observe):
+        """
+        Apply the matching rules to an element.
+        :param ancestors: List of the tags of the ancestors of the element, from the root down.
+        :param element: The element.
+        :param candidates: The compiled rules that may apply.
+        :param params: Dict of the parameters used by the rules.
+        :param observe: Optional callback (rule name, seconds) called after every rule application.
+        """
+        for candidate in candidates:
+            if not self.matches(ancestors, element, candidate):
+                continue
+            if observe is None:
+                candidate[3](element, params)
+            else:
+                start = time.perf_counter()
+                candidate[3](element, params)
+                observe(candidate[4], time.perf_counter() - start)
+
+    def transform(self, root, params=None, context=(), observe=None):
+        """
+        Apply all rules to a document in place.
+        :param root: The root element to transform.
+        :param params: Dict of the parameters used by the rules, e.g. {'kbo_number': ..., 'registry': ...}.
+        :param context: Tags of the ancestors of root, when transforming a detached part of a document.
+        :param observe: Optional callback (rule name, seconds) called after every rule application.
+        :return: The root element.
+        """
+        params = params or {}
+        if lxml_etree is not None and isinstance(root, lxml_etree._Element):
+            return self.transform_lxml(root, params, context, observe)
+        ancestors = list(context)
+        # Stack of (element, children iterator), rules apply when an element is left.
+        stack = [(root, iter(list(root)))]
+        while stack:
+            element, children = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                ancestors.append(element.tag)
+                stack.append((child, iter(list(child))))
+                continue
+            stack.pop()
+            candidates = self.candidates(element.tag, ancestors[-1] if ancestors else None)
+            if candidates:
+                self.apply(ancestors, element, candidates, params, observe)
+            if stack:
+                ancestors.pop()
+        return root
+
+    def transform_lxml(self, root, params, context, observe):
+        """
+        Apply all rules to an lxml document in place, see transform. lxml walks the document in C and only hands out
+        the elements some rule dispatches on, their ancestors are looked up through the parent links.
+        """
+        for _, element in lxml_etree.iterwalk(root, events=('end',), tag=self.tags):
+            if element is root:
+                parent = context[-1] if context else None
+            else:
+                parent = element.getparent().tag
+            candidates = self.candidates(element.tag, parent)
+            if not candidates:
+                continue
+            ancestors = []
+            node = element
+            while node is not root:
+                node = node.getparent()
+                ancestors.append(node.tag)
+            ancestors.reverse()
+            self.apply(list(context) + ancestors, element, candidates, params, observe)
+        return root
+
+
+@functools.lru_cache(maxsize=None)
+def compile_rules(rules=PEPPOL_RULES):
+    """
+    Compile a rule table, cached so every request shares the compiled rule set.
+    :param rules: Tuple of Rule.
+    :return: The Transformer.
+    """
+    return Transformer(rules)
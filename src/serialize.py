@@ -0,0 +1,286 @@
+import copy
+import xml.etree.ElementTree as ET
+
+from src.backend import lxml_etree
+from src.rules import NAMESPACES
+
+XML_DECLARATION = "<?xml version='1.0' encoding='utf-8'?>\n"
+# Namespaces of every document: the invoice namespace as default, cac and cbc with fixed prefixes declared on the root.
+ROOT_NAMESPACES = {
+    NAMESPACES['inv']: '',
+    NAMESPACES['cac']: 'cac',
+    NAMESPACES['cbc']: 'cbc',
+}
+ROOT_NSMAP = {prefix or None: uri for uri, prefix in ROOT_NAMESPACES.items()}
+ROOT_DECLARATIONS = ''.join(' xmlns:%s="%s"' % (prefix, uri) for uri, prefix in ROOT_NAMESPACES.items() if prefix)
+# Prefixes of other namespaces found in UBL documents, declared on the elements that use them.
+KNOWN_PREFIXES = {
+    'http://www.w3.org/XML/1998/namespace': 'xml',
+    'http://www.w3.org/2001/XMLSchema-instance': 'xsi',
+    'urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2': 'ext',
+    'urn:oasis:names:specification:ubl:schema:xsd:QualifiedDataTypes-2': 'qdt',
+    'urn:oasis:names:specification:ubl:schema:xsd:UnqualifiedDataTypes-2': 'udt',
+    'urn:un:unece:uncefact:documentation:2': 'ccts',
+}
+# Write the collected strings to the output stream once this many are buffered.
+FLUSH_PARTS = 8192
+
+# tag -> (qualified name, default namespace the element needs or None when prefixed, namespace declaration).
+_tags = {}
+# attribute name -> (qualified name, namespace declaration).
+_attributes = {}
+# Prefixes given to namespaces that have no known prefix.
+_generated_prefixes = {}
+# Comment and processing instruction tags of both backends.
+_comment_tags = {ET.Comment} | ({lxml_etree.Comment} if lxml_etree is not None else set())
+_pi_tags = {ET.ProcessingInstruction} | ({lxml_etree.PI} if lxml_etree is not None else set())
+_entity_tags = {lxml_etree.Entity} if lxml_etree is not None else set()
+
+
+def is_lxml(element):
+    """
+    Check whether lxml itself can serialize an element, which is much faster.
+    :param element: An element.
+    :return: True for lxml elements without elements in no namespace, lxml would write those unqualified within the
+             default namespace.
+    """
+    return (lxml_etree is not None and isinstance(element, lxml_etree._Element)
+            and next(element.iter('{}*'), None) is None)
+
+
+def prefix_of(uri):
+    """
+    Get the prefix of a namespace that is not declared on the root.
+    :param uri: The namespace.
+    :return: The known prefix, or ns0, ns1, ... in order of appearance.
+    """
+    prefix = KNOWN_PREFIXES.get(uri) or _generated_prefixes.get(uri)
+    if prefix is None:
+        prefix = _generated_prefixes.setdefault(uri, 'ns%d' % len(_generated_prefixes))
+    return prefix
+
+
+def qualify_tag(tag):
+    """
+    Get the qualified name of a tag, computed once per tag.
+    :param tag: The tag in {uri}name notation.
+    :return: Tuple (qualified name, default namespace or None, namespace declaration).
+    """
+    cached = _tags.get(tag)
+    if cached is not None:
+        return cached
+    uri, name = tag[1:].split('}', 1) if tag[:1] == '{' else ('', tag)
+    prefix = ROOT_NAMESPACES.get(uri)
+    if uri == '' or prefix == '':
+        # Unprefixed, in the invoice namespace or in no namespace.
+        cached = (name, uri, '')
+    elif prefix is not None:
+        cached = ('%s:%s' % (prefix, name), None, '')
+    else:
+        prefix = prefix_of(uri)
+        declaration = '' if prefix == 'xml' else ' xmlns:%s="%s"' % (prefix, escape_attribute(uri))
+        cached = ('%s:%s' % (prefix, name), None, declaration)
+    _tags[tag] = cached
+    return cached
+
+
+def qualify_attribute(name):
+    """
+    Get the qualified name of an attribute, computed once per attribute name.
+    :param name: The attribute name, in {uri}name notation when namespaced.
+    :return: Tuple (qualified name, namespace declaration).
+    """
+    cached = _attributes.get(name)
+    if cached is not None:
+        return cached
+    if name[:1] != '{':
+        cached = (name, '')
+    else:
+        uri, local = name[1:].split('}', 1)
+        prefix = ROOT_NAMESPACES.get(uri)
+        if prefix:
+            cached = ('%s:%s' % (prefix, local), '')
+        else:
+            # Unprefixed attributes are in no namespace, so even the invoice namespace needs a prefix here.
+            prefix = prefix_of(uri)
+            declaration = '' if prefix == 'xml' else ' xmlns:%s="%s"' % (prefix, escape_attribute(uri))
+            cached = ('%s:%s' % (prefix, local), declaration)
+    _attributes[name] = cached
+    return cached
+
+
+def escape_text(text):
+    """
+    :param text: Text content.
+    :return: The text escaped for xml.
+    """
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def escape_attribute(value):
+    """
+    :param value: An attribute value.
+    :return: The value escaped for a double quoted xml attribute.
+    """
+    value = escape_text(value)
+    if '"' in value:
+        value = value.replace('"', '&quot;')
+    if '\n' in value or '\r' in value or '\t' in value:
+        value = value.replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#09;')
+    return value
+
+
+def write_element(element, append, default, declarations=''):
+    """
+    Write an element, its children and its tail.
+    :param element: The element.
+    :param append: Function collecting the strings.
+    :param default: The default namespace in scope.
+    :param declarations: Namespace declarations to add to the start tag.
+    """
+    tag = element.tag
+    if not isinstance(tag, str):
+        if tag in _comment_tags:
+            append('<!--%s-->' % (element.text or ''))
+        elif tag in _pi_tags:
+            # lxml keeps the target apart, ElementTree keeps it at the start of the text.
+            target = getattr(element, 'target', None)
+            append('<?%s?>' % ' '.join(part for part in (target, element.text) if part))
+        elif tag in _entity_tags:
+            append(element.text)
+        if element.tail:
+            append(escape_text(element.tail))
+        return
+    name, uri, declaration = qualify_tag(tag)
+    if uri is not None and uri != default:
+        # Switch the default namespace, e.g. for an element without namespace inside the invoice.
+        declarations += ' xmlns="%s"' % uri
+        default = uri
+    append('<' + name + declarations + declaration)
+    for key, value in element.attrib.items():
+        key, declaration = qualify_attribute(key)
+        append('%s %s="%s"' % (declaration, key, escape_attribute(value)))
+    text = element.text
+    if len(element):
+        append('>')
+        if text:
+            append(escape_text(text))
+        for child in element:
+            write_element(child, append, default)
+        append('</' + name + '>')
+    elif text:
+        append('>' + escape_text(text) + '</' + name + '>')
+    else:
+        append('/>')
+    if element.tail:
+        append(escape_text(element.tail))
+
+
+def lxml_tostring(element, xml_declaration=True):
+    """
+    Serialize an lxml document with the root prefixes in C. lxml keeps the prefixes of the parsed document, so when
+    they differ the children of a copy are moved under a root declaring the root prefixes, which makes lxml relink
+    their namespaces to those declarations.
+    :param element: The lxml root element.
+    :param xml_declaration: Start with an xml declaration.
+    :return: The utf-8 encoded xml.
+    """
+    if element.nsmap != ROOT_NSMAP:
+        element = copy.deepcopy(element)
+        root = element.makeelement(element.tag, element.attrib, nsmap=ROOT_NSMAP)
+        root.text = element.text
+        root.extend(list(element))
+        element = root
+    return lxml_etree.tostring(element, encoding='utf-8', xml_declaration=xml_declaration)
+
+
+def serialize(element, xml_declaration=True):
+    """
+    Serialize a document with the invoice namespace as default and the cac and cbc prefixes.
+    :param element: The root element.
+    :param xml_declaration: Start with an xml declaration.
+    :return: The utf-8 encoded xml.
+    """
+    if is_lxml(element):
+        return lxml_tostring(element, xml_declaration)
+    parts = [XML_DECLARATION] if xml_declaration else []
+    write_element(element, parts.append, '', ROOT_DECLARATIONS)
+    return ''.join(parts).encode('utf-8')
+
+
+def serialize_fragment(element):
+    """
+    Serialize an element that is written inside a root serialized by split_root, so without namespace declarations.
+    :param element: The element.
+    :return: The utf-8 encoded xml.
+    """
+    parts = []
+    write_element(element, parts.append, NAMESPACES['inv'])
+    return ''.join(parts).encode('utf-8')
+
+
+def split_root(element):
+    """
+    Serialize a root element and split it into everything before the closing root tag and the closing root tag.
+    :param element: The root element.
+    :return: Tuple (head, closing tag) in bytes.
+    """
+    parts = []
+    tail, element.tail = element.tail, None
+    try:
+        write_element(element, parts.append, '', ROOT_DECLARATIONS)
+    finally:
+        element.tail = tail
+    head = ''.join(parts)
+    closing = '</%s>' % qualify_tag(element.tag)[0]
+    # An empty root is opened up so children can follow.
+    head = head[:-2] + '>' if head.endswith('/>') else head[:-len(closing)]
+    return head.encode('utf-8'), closing.encode('utf-8')
+
+
+def write(element, stream, xml_declaration=True):
+    """
+    Serialize a document to a binary stream, writing it in parts instead of building the whole document in memory.
+    :param element: The root element.
+    :param stream: A file path or a binary file object.
+    :param xml_declaration: Start with an xml declaration.
+    :return: The number of bytes written.
+    """
+    if isinstance(stream, (str, bytes)) or hasattr(stream, '__fspath__'):
+        with open(stream, 'wb') as f:
+            return write(element, f, xml_declaration)
+    if is_lxml(element):
+        data = lxml_tostring(element, xml_declaration)
+        stream.write(data)
+        return len(data)
+    parts = [XML_DECLARATION] if xml_declaration else []
+    written = 0
+
+    def append(part):
+        nonlocal written
+        parts.append(part)
+        if len(parts) >= FLUSH_PARTS:
+            data = ''.join(parts).encode('utf-8')
+            stream.write(data)
+            written += len(data)
+            parts.clear()
+    write_element(element, append, '', ROOT_DECLARATIONS)
+    data = ''.join(parts).encode('utf-8')
+    stream.write(data)
+    return written + len(data)
+
+
+def canonicalize(element):
+    """
+    Serialize a document in canonical form (C14N 2.0), e.g. to hash it. The result does not depend on the XML backend,
+    the prefixes or the attribute order of the document.
+    :param element: The root element.
+    :return: The utf-8 encoded canonical xml.
+    """
+    return ET.canonicalize(serialize(element, xml_declaration=False).decode('utf-8')).encode('utf-8')
@@ -0,0 +1,68 @@
+import re
+
+from src.backend import get_backend
+from src.rules import NAMESPACES, qualify
+from src.validate import CUSTOMIZATION_ID, PROFILE_ID_PATTERN
+
+# Bytes of a document read at most to classify it, the header of an invoice comes first.
+SNIFF_BYTES = 64 * 1024
+# Bytes fed to the parser at a time, most documents are classified after the first piece.
+SNIFF_CHUNK = 2048
+COMPLIANT = 'compliant'
+CONVERTIBLE = 'convertible'
+INVOICE = '{%s}Invoice' % NAMESPACES['inv']
+CUSTOMIZATION_ID_TAG = qualify('cbc:CustomizationID')
+PROFILE_ID_TAG = qualify('cbc:ProfileID')
+# Children of the invoice that may come before the ProfileID, in UBL order. The header is complete at any other one.
+HEADER_TAGS = frozenset(('{urn:oasis:names:specification:ubl:schema:xsd:CommonExtensionComponents-2}UBLExtensions',
+                         qualify('cbc:UBLVersionID'), CUSTOMIZATION_ID_TAG, PROFILE_ID_TAG))
+_profile_id = re.compile(PROFILE_ID_PATTERN)
+
+
+class UnsupportedDocument(ValueError):
+    """
+    The document is no UBL invoice, e.g. a credit note.
+    """
+
+
+def sniff_document(data, backend=None):
+    """
+    Classify a document from its first bytes with an incremental parser, without building its tree.
+    :param data: The document in bytes, only the first SNIFF_BYTES are read.
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :return: COMPLIANT when it already carries the peppol billing 3.0 CustomizationID and ProfileID, CONVERTIBLE for
+             other invoices and when the header does not fit in SNIFF_BYTES. Syntax errors are left to the full parse.
+    :raise UnsupportedDocument: When the root is no UBL invoice.
+    """
+    parser = (backend or get_backend()).pull_parser()
+    header = {}
+    depth = 0
+    try:
+        for start in range(0, min(len(data), SNIFF_BYTES), SNIFF_CHUNK):
+            parser.feed(data[start:start + SNIFF_CHUNK])
+            for event, element in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    if depth == 1 and element.tag != INVOICE:
+                        raise UnsupportedDocument('%s documents are not supported, only UBL invoices' % (
+                            element.tag.rpartition('}')[2],))
+                    if depth == 2 and element.tag not in HEADER_TAGS:
+                        return classify(header)
+                    continue
+                if depth == 2 and element.tag in HEADER_TAGS:
+                    header[element.tag] = (element.text or '').strip()
+                depth -= 1
+    except SyntaxError:
+        return CONVERTIBLE
+    return classify(header)
+
+
+def classify(header):
+    """
+    :param header: Dict tag -> text of the header children of an invoice.
+    :return: COMPLIANT or CONVERTIBLE.
+    """
+    if (header.get(CUSTOMIZATION_ID_TAG) == CUSTOMIZATION_ID
+            and _profile_id.fullmatch(header.get(PROFILE_ID_TAG, ''))):
+        return COMPLIANT
+    return CONVERTIBLE
@@ -0,0 +1,130 @@
+from src.backend import get_backend
+from src.convert import CAC, rule_params
+from src.decompress import open_plain
+from src.tenants import get_profile
+from src.serialize import XML_DECLARATION, serialize_fragment, split_root
+CHUNK_SIZE = 64 * 1024
+
+
+def read_chunks(source, chunk_size=CHUNK_SIZE):
+    """
+    Read a file in chunks.
+    :param source: A file path or a binary file object.
+    :param chunk_size: The number of bytes per chunk.
+    :return: Generator of byte chunks.
+    """
+    if isinstance(source, (str, bytes)) or hasattr(source, '__fspath__'):
+        with open(source, 'rb') as f:
+            yield from read_chunks(f, chunk_size)
+        return
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def read_plain_chunks(source, chunk_size=CHUNK_SIZE, max_bytes=None):
+    """
+    Read the plain xml of a file that may be compressed in chunks, decompressing it as it is read.
+    :param source: A file path or a binary file object.
+    :param chunk_size: The number of decompressed bytes per chunk.
+    :param max_bytes: Largest accepted decompressed document, see src/decompress.py.
+    :return: Generator of byte chunks.
+    """
+    with open_plain(source, max_bytes) as plain:
+        yield from read_chunks(plain, chunk_size)
+
+
+def iter_convert_stream(source, kbo_number, chunk_size=CHUNK_SIZE, backend=None, tenant=None):
+    """
+    Convert an invoice xml to peppol while streaming, keeping at most one invoice line in memory.
+    The header (everything before the first invoice line) is converted and emitted as soon as the first
+    invoice line starts, after that every invoice line is converted, emitted and freed when it closes.
+    Both go through the same compiled rule set as create_invoice_elementtree.
+    :param source: A file path or a binary file object with the invoice xml, may be compressed (src/decompress.py).
+    :param kbo_number: The kbo number of the customer, None for the one of the tenant profile.
+    :param chunk_size: The number of bytes read from the source at a time.
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :param tenant: The tenant whose profile (src/tenants.py) to convert with, None for the default profile.
+    :return: Generator of utf-8 encoded byte chunks of the converted xml.
+    """
+    backend = backend or get_backend()
+    # The whole document is converted with the profile as it was when it started.
+    profile = get_profile(tenant)
+    kbo_number = kbo_number or profile.kbo_number
+    parser = backend.pull_parser()
+    invoice = None
+    closing_tag = None
+    depth = 0
+    for chunk in read_plain_chunks(source, chunk_size):
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    invoice = element
+                elif depth == 2 and closing_tag is None and element.tag == CAC + 'InvoiceLine':
+                    # The header is complete once the first invoice line starts. The line itself is still being
+                    # parsed, so the header is converted in a copy of the root holding only the children before it.
+                    head, closing_tag = emit_header(invoice, kbo_number, backend, until=element, profile=profile)
+                    yield XML_DECLARATION.encode('utf-8') + head
+                continue
+            depth -= 1
+            if depth == 0:
+                if closing_tag is None:
+                    head, closing_tag = emit_header(invoice, kbo_number, backend, profile=profile)
+                    yield XML_DECLARATION.encode('utf-8') + head
+                yield closing_tag
+            elif depth == 1 and closing_tag is not None:
+                if element.tag == CAC + 'InvoiceLine':
+                    profile.transformer.transform(element, rule_params(kbo_number), context=(invoice.tag,))
+                chunk = serialize_fragment(element)
+                # Free the element, the parser does not need it anymore.
+                invoice.remove(element)
+                yield chunk
+    parser.close()
+
+
+def emit_header(invoice, kbo_number, backend=None, until=None, profile=None):
+    """
+    Move the header children of the invoice into a copy of the root, convert it and serialize it.
+    :param invoice: The invoice elementtree being parsed.
+    :param kbo_number: The kbo number of the customer.
+    :param backend: The XML backend of the invoice, defaults to get_backend().
+    :param until: The child where the header ends, e.g. the first invoice line, None for all children.
+    :param profile: The TenantProfile to convert with, defaults to the default profile.
+    :return: Tuple (head, closing tag) in bytes.
+    """
+    backend = backend or get_backend()
+    profile = profile or get_profile()
+    header = backend.shallow_copy(invoice)
+    for child in list(invoice):
+        if child is until:
+            break
+        # Removed first, lxml would move the child on append but ElementTree would keep it in both.
+        invoice.remove(child)
+        header.append(child)
+    profile.transformer.transform(header, rule_params(kbo_number))
+    return split_root(header)
+
+
+def convert_stream(source, destination, kbo_number, chunk_size=CHUNK_SIZE, backend=None, tenant=None):
+    """
+    Convert an invoice xml file to a peppol xml file while streaming.
+    :param source: A file path or a binary file object with the invoice xml.
+    :param destination: A file path or a binary file object to write the converted xml to.
+    :param kbo_number: The kbo number of the customer, None for the one of the tenant profile.
+    :param chunk_size: The number of bytes read from the source at a time.
+    :param backend: The XML backend to parse with, defaults to get_backend().
+    :param tenant: The tenant whose profile (src/tenants.py) to convert with, None for the default profile.
+    :return: The number of bytes written.
+    """
+    if isinstance(destination, (str, bytes)) or hasattr(destination, '__fspath__'):
+        with open(destination, 'wb') as f:
+            return convert_stream(source, f, kbo_number, chunk_size, backend, tenant)
+    written = 0
+    for chunk in iter_convert_stream(source, kbo_number, chunk_size, backend, tenant):
+        destination.write(chunk)
+        written += len(chunk)
+    return written
@@ -0,0 +1,218 @@
+import json
+import os
+import re
+import threading
+import time
+
+from src.rules import PEPPOL_RULES, Copy, Element, Lookup, Param, Rule, TextOf, Transformer, bind_rules
+
+DEFAULT_TENANT_DIR = 'tenants'
+# Profile used when a conversion names no tenant, tenants/default.json when it exists.
+DEFAULT_TENANT = 'default'
+# Seconds between two checks whether the file of a profile changed.
+RELOAD_SECONDS = 5
+# Settings of a profile, a profile file only holds the ones it changes.
+# kbo_number:      kbo number of the customer when the caller gives none.
+# supplier_number: endpoint id of the supplier when the KBO registry does not know its vat number.
+# language:        languageID of the electronic mail addresses.
+# endpoint_scheme: schemeID of the endpoint ids, 0208 for Belgian enterprise numbers.
+# params:          values of extra parameters used by the extra rules.
+# rules:           rule name -> false to disable the rule, e.g. to keep the WebsiteURI of the supplier.
+# extra_rules:     rules added after the peppol rules, or before the rule named by their 'before', see rule_from_json.
+DEFAULT_SETTINGS = {
+    'kbo_number': '0478693713',
+    'supplier_number': '0478693713',
+    'language': 'NL',
+    'endpoint_scheme': '0208',
+    'params': {},
+    'rules': {},
+    'extra_rules': [],
+}
+# Settings bound into the rule table when a profile is compiled.
+BOUND_SETTINGS = ('supplier_number', 'language', 'endpoint_scheme')
+_tenant_name = re.compile(r'[A-Za-z0-9_-]{1,64}')
+# (directory, tenant) -> TenantProfile, see get_profile.
+_profiles = {}
+_lock = threading.Lock()
+
+
+class UnknownTenant(ValueError):
+    """
+    There is no profile for the tenant.
+    """
+
+
+class TenantProfile:
+    """
+    Settings of a tenant compiled into a ready-to-run Transformer, built once per profile file and shared by all
+    threads of the process.
+    """
+
+    def __init__(self, name, settings, path=None, identity=None):
+        """
+        :param name: The name of the tenant.
+        :param settings: Dict of the settings that differ from DEFAULT_SETTINGS.
+        :param path: Path of the profile file, None for the built-in default profile.
+        :param identity: Identity of the profile file when it was read, see file_identity.
+        :raise ValueError: When a setting, rule name or extra rule is invalid.
+        """
+        unknown = set(settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise ValueError('Unknown profile settings: %s' % ', '.join(sorted(unknown)))
+        settings = dict(DEFAULT_SETTINGS, **settings)
+        self.name = name
+        # All settings, including the defaults, e.g. for the model engine (src/model.py).
+        self.settings = settings
+        self.path = path
+        self.identity = identity
+        self.checked = time.monotonic()
+        self.kbo_number = settings['kbo_number']
+        rules = list(PEPPOL_RULES)
+        for spec in settings['extra_rules']:
+            rule = rule_from_json(spec)
+            if spec.get('before') is None:
+                rules.append(rule)
+                continue
+            # Rules apply to an element in table order, e.g. before the rule that removes what this one reads.
+            positions = [position for position, other in enumerate(rules) if other.name == spec['before']]
+            if not positions:
+                raise ValueError('Unknown rule: %s' % spec['before'])
+            rules.insert(positions[0], rule)
+        names = {rule.name for rule in rules}
+        unknown = set(settings['rules']) - names
+        if unknown:
+            raise ValueError('Unknown rules: %s' % ', '.join(sorted(unknown)))
+        rules = tuple(rule for rule in rules if settings['rules'].get(rule.name, True))
+        values = dict(settings['params'], **{setting: settings[setting] for setting in BOUND_SETTINGS})
+        self.rules = bind_rules(rules, values)
+        self.transformer = Transformer(self.rules)
+        # Identifies the rule set of the profile, e.g. in cache keys of converted documents.
+        self.version = self.transformer.version
+
+
+def json_value(value):
+    """
+    Read a template value of an extra rule.
+    :param value: A string, {'param': name}, {'text_of': path} or {'lookup': field, 'number': value, 'default': value}.
+    :return: The string, Param, TextOf or Lookup.
+    """
+    if not isinstance(value, dict):
+        return value
+    if 'param' in value:
+        return Param(value['param'])
+    if 'text_of' in value:
+        return TextOf(value['text_of'])
+    if 'lookup' in value:
+        return Lookup(value['lookup'], json_value(value['number']), json_value(value.get('default')))
+    raise ValueError('Unknown value: %r' % (value,))
+
+
+def json_template(template):
+    """
+    Read an element template of an extra rule.
+    :param template: {'copy': path} or {'tag': tag, 'attrib': {name: value}, 'text': value, 'children': [template]}.
+    :return: The Copy or Element.
+    """
+    if 'copy' in template:
+        return Copy(template['copy'])
+    attrib = template.get('attrib')
+    if attrib is not None:
+        attrib = {name: json_value(value) for name, value in attrib.items()}
+    return Element(template['tag'], attrib, json_value(template.get('text')),
+                   tuple(json_template(child) for child in template.get('children', ())))
+
+
+def rule_from_json(spec):
+    """
+    Read an extra rule of a profile, e.g.
+    {"name": "note", "path": "inv:Invoice", "action": ["insert", 4, {"tag": "cbc:Note", "text": "Thanks"}]}.
+    The action is a list in the notation of the Rule actions of src/rules.py, with json_template for the template of
+    an insert and json_value for the values of a set or text.
+    :param spec: Dict with name, path, action and optionally when, unless and before (see TenantProfile).
+    :return: The Rule.
+    """
+    try:
+        action = list(spec['action'])
+        if action[0] == 'set':
+            action[1] = {name: json_value(value) for name, value in action[1].items()}
+        elif action[0] == 'text':
+            action[1] = json_value(action[1])
+        elif action[0] == 'unset':
+            action[1] = tuple(action[1])
+        elif action[0] == 'insert':
+            action[2] = json_template(action[2])
+        return Rule(spec['name'], spec['path'], tuple(action), spec.get('when'), spec.get('unless'))
+    except (KeyError, IndexError, TypeError, AttributeError) as error:
+        raise ValueError('Invalid rule %r: %s' % (spec, error))
+
+
+def file_identity(path):
+    """
+    :param path: Path of a profile file.
+    :return: Identity of the file, changes when it is edited or replaced, None when it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def load_profile(name, path):
+    """
+    Read and compile a profile file.
+    :param name: The name of the tenant.
+    :param path: Path of the json profile file.
+    :return: The TenantProfile, the built-in default profile when the default tenant has no file.
+    :raise UnknownTenant: When there is no profile file for the tenant.
+    :raise ValueError: When the profile is invalid.
+    """
+    identity = file_identity(path)
+    if identity is None:
+        if name == DEFAULT_TENANT:
+            return TenantProfile(name, {})
+        raise UnknownTenant('Unknown tenant: %s' % name)
+    with open(path, encoding='utf-8') as f:
+        try:
+            settings = json.load(f)
+        except ValueError as error:
+            raise ValueError('Invalid profile %s: %s' % (path, error))
+    try:
+        if not isinstance(settings, dict):
+            raise ValueError('a profile is a json object')
+        return TenantProfile(name, settings, path, identity)
+    except (ValueError, KeyError, TypeError, AttributeError) as error:
+        raise ValueError('Invalid profile %s: %s' % (path, error))
+
+
+def get_profile(tenant=None, directory=None):
+    """
+    Get the compiled profile of a tenant, shared by all threads of the process. A profile file that changed is
+    compiled again within RELOAD_SECONDS.
+    :param tenant: The name of the tenant, defaults to DEFAULT_TENANT.
+    :param directory: Directory of the <tenant>.json profiles, defaults to the TENANT_DIR environment variable or
+                      tenants.
+    :return: The TenantProfile.
+    :raise UnknownTenant: When there is no profile for the tenant.
+    """
+    tenant = tenant or DEFAULT_TENANT
+    if not _tenant_name.fullmatch(tenant):
+        raise UnknownTenant('Unknown tenant: %s' % tenant)
+    directory = directory or os.environ.get('TENANT_DIR') or DEFAULT_TENANT_DIR
+    key = (directory, tenant)
+    profile = _profiles.get(key)
+    now = time.monotonic()
+    if profile is not None and now - profile.checked < RELOAD_SECONDS:
+        return profile
+    with _lock:
+        profile = _profiles.get(key)
+        if profile is not None and now - profile.checked < RELOAD_SECONDS:
+            return profile
+        path = os.path.join(directory, tenant + '.json')
+        if profile is not None and file_identity(path) == profile.identity:
+            profile.checked = now
+            return profile
+        # Dropped first, so a profile that became invalid or was deleted is not served anymore.
+        _profiles.pop(key, None)
+        profile = _profiles[key] = load_profile(tenant, path)
+    return profile
@@ -0,0 +1,224 @@
+import functools
+import re
+from collections import namedtuple
+
+from src.backend import backend_of
+from src.rules import qualify
+
+# A check tests every element at `path` of a converted invoice.
+# path: '/'-separated prefixed tags below the root, start with './/' to match at any depth, e.g. './/cac:Country'.
+# test: one of the tuples below.
+#   ('present',)                   at least one element must exist at the path
+#   ('text', values)               the text must be one of the values
+#   ('pattern', regex)             the whole text must match the regular expression
+#   ('attribute', name, values)    the attribute must be one of the values
+#   ('iban',)                      the text must be an IBAN with a valid checksum
+#   ('child', path)                the element must have a descendant at the relative path
+# flag: 'fatal' when the access point rejects the document, 'warning' otherwise.
+Check = namedtuple('Check', 'id path test message flag', defaults=('fatal',))
+# A failed check, path is the path of the check, value the offending text or attribute value (None when missing).
+Finding = namedtuple('Finding', 'id flag path message value')
+
+CUSTOMIZATION_ID = 'urn:cen.eu:en16931:2017#compliant#urn:fdc:peppol.eu:2017:poacc:billing:3.0'
+PROFILE_ID_PATTERN = r'urn:fdc:peppol\.eu:2017:poacc:billing:\d\d:1\.0'
+# Invoice type codes of UNCL1001 allowed in a Peppol invoice.
+UNCL1001 = frozenset(
+    '71 80 82 84 102 218 219 325 326 380 383 384 385 386 387 388 389 390 393 394 395 456 457 527 553 575 623 633 751 '
+    '780 875 876 877 935'.split())
+# Tax category codes of UNCL5305 allowed in Peppol.
+UNCL5305 = frozenset('AE L M E S Z G O K B'.split())
+# Electronic address schemes (EAS) of endpoint ids.
+EAS = frozenset(
+    '0002 0007 0009 0037 0060 0088 0096 0097 0106 0130 0135 0142 0147 0151 0154 0158 0170 0177 0183 0184 0188 0190 '
+    '0191 0192 0193 0194 0195 0196 0198 0199 0200 0201 0202 0203 0204 0205 0208 0209 0210 0211 0212 0213 0215 0216 '
+    '0217 0218 0221 0225 0230 0235 0240 9901 9910 9913 9914 9915 9918 9919 9920 9922 9923 9924 9925 9926 9927 9928 '
+    '9929 9930 9931 9932 9933 9934 9935 9936 9937 9938 9939 9940 9941 9942 9943 9944 9945 9946 9947 9948 9949 9950 '
+    '9951 9952 9953 9957 9959 AN AQ AS AU EM'.split())
+ISO4217 = frozenset(
+    'AED AFN ALL AMD ANG AOA ARS AUD AWG AZN BAM BBD BDT BGN BHD BIF BMD BND BOB BOV BRL BSD BTN BWP BYN BZD CAD CDF '
+    'CHE CHF CHW CLF CLP CNY COP COU CRC CUC CUP CVE CZK DJF DKK DOP DZD EGP ERN ETB EUR FJD FKP GBP GEL GHS GIP GMD '
+    'GNF GTQ GYD HKD HNL HTG HUF IDR ILS INR IQD IRR ISK JMD JOD JPY KES KGS KHR KMF KPW KRW KWD KYD KZT LAK LBP LKR '
+    'LRD LSL LYD MAD MDL MGA MKD MMK MNT MOP MRU MUR MVR MWK MXN MXV MYR MZN NAD NGN NIO NOK NPR NZD OMR PAB PEN PGK '
+    'PHP PKR PLN PYG QAR RON RSD RUB RWF SAR SBD SCR SDG SEK SGD SHP SLE SLL SOS SRD SSP STN SVC SYP SZL THB TJS TMT '
+    'TND TOP TRY TTD TWD TZS UAH UGX USD USN UYI UYU UYW UZS VED VES VND VUV WST XAF XAG XAU XBA XBB XBC XBD XCD XDR '
+    'XOF XPD XPF XPT XSU XTS XUA XXX YER ZAR ZMW ZWL'.split())
+# ISO 3166-1 alpha-2 country codes, plus 1A (Kosovo) and XI (Northern Ireland) accepted by Peppol.
+ISO3166 = frozenset(
+    'AD AE AF AG AI AL AM AO AQ AR AS AT AU AW AX AZ BA BB BD BE BF BG BH BI BJ BL BM BN BO BQ BR BS BT BV BW BY BZ '
+    'CA CC CD CF CG CH CI CK CL CM CN CO CR CU CV CW CX CY CZ DE DJ DK DM DO DZ EC EE EG EH ER ES ET FI FJ FK FM FO '
+    'FR GA GB GD GE GF GG GH GI GL GM GN GP GQ GR GS GT GU GW GY HK HM HN HR HT HU ID IE IL IM IN IO IQ IR IS IT JE '
+    'JM JO JP KE KG KH KI KM KN KP KR KW KY KZ LA LB LC LI LK LR LS LT LU LV LY MA MC MD ME MF MG MH MK ML MM MN MO '
+    'MP MQ MR MS MT MU MV MW MX MY MZ NA NC NE NF NG NI NL NO NP NR NU NZ OM PA PE PF PG PH PK PL PM PN PR PS PT PW '
+    'PY QA RE RO RS RU RW SA SB SC SD SE SG SH SI SJ SK SL SM SN SO SR SS ST SV SX SY SZ TC TD TF TG TH TJ TK TL TM '
+    'TN TO TR TT TV TW TZ UA UG UM US UY UZ VA VC VE VG VI VN VU WF WS YE YT ZA ZM ZW 1A XI'.split())
+
+PEPPOL_CHECKS = (
+    # Header.
+    Check('PEPPOL-EN16931-R004', 'cbc:CustomizationID', ('present',), 'Specification identifier MUST be provided.'),
+    Check('PEPPOL-EN16931-R004', 'cbc:CustomizationID', ('text', (CUSTOMIZATION_ID,)),
+          'Specification identifier MUST have the value %s.' % CUSTOMIZATION_ID),
+    Check('PEPPOL-EN16931-R001', 'cbc:ProfileID', ('present',), 'Business process MUST be provided.'),
+    Check('PEPPOL-EN16931-R007', 'cbc:ProfileID', ('pattern', PROFILE_ID_PATTERN),
+          'Business process MUST be in the format urn:fdc:peppol.eu:2017:poacc:billing:NN:1.0.'),
+    Check('BR-CL-01', 'cbc:InvoiceTypeCode', ('text', UNCL1001),
+          'The document type code MUST be coded by the invoice related code lists of UNCL 1001.'),
+    Check('CONV-LIST-01', 'cbc:InvoiceTypeCode', ('attribute', 'listID', ('UNCL1001',)),
+          'The invoice type code must be marked with listID UNCL1001.', 'warning'),
+    Check('BR-CL-04', 'cbc:DocumentCurrencyCode', ('text', ISO4217),
+          'Invoice currency code MUST be coded using ISO code list 4217 alpha-3.'),
+    Check('CONV-LIST-02', 'cbc:DocumentCurrencyCode', ('attribute', 'listID', ('ISO4217',)),
+          'The document currency code must be marked with listID ISO4217.', 'warning'),
+    # Parties.
+    Check('PEPPOL-EN16931-R020', 'cac:AccountingSupplierParty/cac:Party/cbc:EndpointID', ('present',),
+          'Seller electronic address MUST be provided.'),
+    Check('PEPPOL-EN16931-R010', 'cac:AccountingCustomerParty/cac:Party/cbc:EndpointID', ('present',),
+          'Buyer electronic address MUST be provided.'),
+    Check('PEPPOL-EN16931-CL008', './/cac:Party/cbc:EndpointID', ('attribute', 'schemeID', EAS),
+          'Electronic address identifier scheme MUST be from the list of Electronic Address Identifiers.'),
+    Check('BR-06', 'cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName', ('present',),
+          'An Invoice shall contain the Seller name.'),
+    Check('BR-07', 'cac:AccountingCustomerParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName', ('present',),
+          'An Invoice shall contain the Buyer name.'),
+    Check('BR-CL-14', './/cac:Country/cbc:IdentificationCode', ('text', ISO3166),
+          'Country codes in an invoice MUST be coded using ISO code list 3166-1.'),
+    Check('CONV-LIST-03', './/cac:Country/cbc:IdentificationCode', ('attribute', 'listID', ('ISO3166-1:Alpha2',)),
+          'Country codes must be marked with listID ISO3166-1:Alpha2.', 'warning'),
+    # Tax categories.
+    Check('BR-CL-17', './/cac:TaxSubtotal/cac:TaxCategory/cbc:ID', ('text', UNCL5305),
+          'Invoice tax categories MUST be coded using UNCL5305 code list.'),
+    Check('CONV-LIST-04', './/cac:TaxSubtotal/cac:TaxCategory/cbc:ID', ('attribute', 'schemeID', ('UNCL5305',)),
+          'Tax category codes must be marked with schemeID UNCL5305.', 'warning'),
+    Check('BR-CL-18', './/cac:ClassifiedTaxCategory/cbc:ID', ('text', UNCL5305),
+          'Invoice tax categories MUST be coded using UNCL5305 code list.'),
+    Check('BR-CO-04', 'cac:InvoiceLine', ('child', 'cac:Item/cac:ClassifiedTaxCategory/cbc:ID'),
+          'Each Invoice line SHALL be categorized with an Invoiced item VAT category code.'),
+    # Payment means.
+    Check('CONV-PAY-01', 'cac:PaymentMeans/cac:PayeeFinancialAccount/cbc:ID', ('attribute', 'schemeID', ('IBAN',)),
+          'The payment account must be marked with schemeID IBAN.'),
+    Check('CONV-PAY-02', 'cac:PaymentMeans/cac:PayeeFinancialAccount/cbc:ID', ('iban',),
+          'The payment account must be an IBAN with a valid checksum.'),
+    Check('CONV-PAY-03', 'cac:PaymentMeans/cac:PayeeFinancialAccount/cac:FinancialInstitutionBranch'
+          '/cac:FinancialInstitution/cbc:ID', ('attribute', 'schemeID', ('BIC',)),
+          'The financial institution must be marked with schemeID BIC.'),
+    Check('CONV-PAY-04', 'cac:PaymentMeans/cac:PayeeFinancialAccount/cac:FinancialInstitutionBranch'
+          '/cac:FinancialInstitution/cbc:ID', ('pattern', r'[A-Z]{6}[A-Z2-9][A-NP-Z0-9]([A-Z0-9]{3})?'),
+          'The financial institution must be a BIC.'),
+)
+
+
+def qualify_element_path(path):
+    """
+    Turn a '/'-separated path of prefixed tags into an ElementPath with qualified tags.
+    :param path: The path, e.g. './/cac:Country/cbc:IdentificationCode'.
+    :return: The ElementPath, e.g. './/{urn:...}Country/{urn:...}IdentificationCode'.
+    """
+    return '/'.join(qualify(step) if ':' in step else step for step in path.split('/'))
+
+
+def valid_iban(value):
+    """
+    Check the mod 97 checksum of an IBAN.
+    :param value: The IBAN, spaces are ignored.
+    :return: True when valid.
+    """
+    iban = (value or '').replace(' ', '').upper()
+    if not re.fullmatch(r'[A-Z]{2}\d{2}[A-Z0-9]{10,30}', iban):
+        return False
+    # Move the country code and check digits to the end and read letters as numbers, A = 10 ... Z = 35.
+    return int(''.join(str(int(char, 36)) for char in iban[4:] + iban[:4])) % 97 == 1
+
+
+def compile_test(test):
+    """
+    Compile a test tuple into a function checking one element.
+    :param test: The test tuple, except ('present',) which is checked on the whole path.
+    :return: Function element -> offending value, or True when the element passes.
+    """
+    kind = test[0]
+    if kind == 'text':
+        values = frozenset(test[1])
+
+        def check(element):
+            text = (element.text or '').strip()
+            return True if text in values else text
+    elif kind == 'pattern':
+        pattern = re.compile(test[1])
+
+        def check(element):
+            text = (element.text or '').strip()
+            return True if pattern.fullmatch(text) else text
+    elif kind == 'attribute':
+        name, values = test[1], frozenset(test[2])
+
+        def check(element):
+            value = element.get(name)
+            return True if value in values else value
+    elif kind == 'iban':
+        def check(element):
+            return True if valid_iban(element.text) else element.text
+    elif kind == 'child':
+        path = qualify_element_path(test[1])
+
+        def check(element):
+            return True if element.find(path) is not None else None
+    else:
+        raise ValueError('Unknown check test: %r' % (kind,))
+    return check
+
+
+class Validator:
+    """
+    Check table compiled into ElementPath lookups, applied to a converted invoice tree.
+    Checks on the same path share a single lookup.
+    """
+
+    def __init__(self, checks):
+        """
+        :param checks: Iterable of Check.
+        """
+        self.checks = tuple(checks)
+        # ElementPath -> list of (check, compiled test or None for ('present',)), in table order.
+        self.paths = {}
+        for check in self.checks:
+            test = None if check.test[0] == 'present' else compile_test(check.test)
+            self.paths.setdefault(qualify_element_path(check.path), []).append((check, test))
+
+    def validate(self, invoice):
+        """
+        Validate a converted invoice.
+        :param invoice: The root element of the converted invoice.
+        :return: List of Finding, empty when the invoice passed all checks.
+        """
+        # Compiled lookups of the backend of the tree, e.g. XPath on lxml.
+        findall = backend_of(invoice).findall
+        findings = []
+        for path, checks in self.paths.items():
+            elements = findall(invoice, path)
+            for check, test in checks:
+                if test is None:
+                    if not elements:
+                        findings.append(Finding(check.id, check.flag, check.path, check.message, None))
+                    continue
+                for element in elements:
+                    result = test(element)
+                    if result is not True:
+                        findings.append(Finding(check.id, check.flag, check.path, check.message, result))
+        return findings
+
+
+@functools.lru_cache(maxsize=None)
+def compile_checks(checks=PEPPOL_CHECKS):
+    """
+    Compile a check table, cached so every request shares the compiled checks.
+    :param checks: Tuple of Check.
+    :return: The Validator.
+    """
+    return Validator(checks)
+
+
+def is_valid(findings):
+    """
+    :param findings: List of Finding.
+    :return: True when none of the findings is fatal.
+    """
+    return not any(finding.flag == 'fatal' for finding in findings)
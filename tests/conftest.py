@@ -0,0 +1,26 @@
+import pytest
+
+from src.backend import BACKENDS, get_backend
+
+# Environment variables that change how documents are converted.
+SETTINGS = ('CONVERT_ENGINE', 'KBO_DB', 'MAX_PLAIN_BYTES', 'METRICS_DIR', 'TENANT_DIR', 'XML_BACKEND')
+
+
+@pytest.fixture(autouse=True)
+def default_settings(monkeypatch):
+    """
+    Convert with the default profile, without a KBO registry, whatever the environment of the test run.
+    """
+    for name in SETTINGS:
+        monkeypatch.delenv(name, raising=False)
+
+
+@pytest.fixture(params=['stdlib', 'lxml'])
+def backend(request):
+    """
+    Every XML backend, lxml is skipped when it is not installed.
+    """
+    if request.param not in BACKENDS:
+        pytest.skip('%s is not installed' % request.param)
+    return get_backend(request.param)
+
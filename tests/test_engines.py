@@ -0,0 +1,50 @@
+import io
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from src.batch import convert_document
+from src.stream import convert_stream
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+# Invoices of tests/fixtures, each with the converted <name>.expected.xml.
+INVOICES = ('invoice-full', 'invoice-minimal', 'invoice-note')
+KBO_NUMBER = '0123456789'
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def canonical(data):
+    """
+    Canonical form of a converted document. The model engine indents differently, so whitespace between elements is
+    stripped.
+    """
+    return ET.canonicalize(data.decode('utf-8'), strip_text=True)
+
+
+def convert_streamed(data, backend):
+    converted = io.BytesIO()
+    convert_stream(io.BytesIO(data), converted, KBO_NUMBER, backend=backend)
+    return converted.getvalue()
+
+
+@pytest.mark.parametrize('name', INVOICES)
+def test_engines_match_expected_output(name, backend):
+    data = read_fixture(name + '.xml')
+    expected = canonical(read_fixture(name + '.expected.xml'))
+    assert canonical(convert_document(data, KBO_NUMBER, backend, engine='rules')) == expected
+    assert canonical(convert_document(data, KBO_NUMBER, backend, engine='model')) == expected
+    assert canonical(convert_streamed(data, backend)) == expected
+
+
+@pytest.mark.parametrize('name', INVOICES)
+def test_rules_output_is_exact(name, backend):
+    # Only the model engine writes its own whitespace, the rules engines keep the one of the document.
+    data = read_fixture(name + '.xml')
+    expected = ET.canonicalize(read_fixture(name + '.expected.xml').decode('utf-8'))
+    assert ET.canonicalize(convert_document(data, KBO_NUMBER, backend, engine='rules').decode('utf-8')) == expected
+    assert ET.canonicalize(convert_streamed(data, backend).decode('utf-8')) == expected
@@ -0,0 +1,57 @@
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from src.batch import convert_document, convert_model
+from src.metrics import REGISTRY
+from src.model import Unmodelled
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+KBO_NUMBER = '0123456789'
+# Documents outside of the model: (name counted in peppol_model_fallbacks_total, text to replace, replacement).
+OUTSIDE_MODEL = {
+    'unknown-element': ('Department', b'<cbc:CityName>', b'<cbc:Department>Sales</cbc:Department><cbc:CityName>'),
+    'unknown-attribute': ('@schemeID', b'<cbc:CompanyID>', b'<cbc:CompanyID schemeID="BE:VAT">'),
+}
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def canonical(data):
+    return ET.canonicalize(data.decode('utf-8'), strip_text=True)
+
+
+def fallbacks():
+    """
+    :return: Dict of the element label -> value of peppol_model_fallbacks_total in this process.
+    """
+    return {dict(labels)['element']: value for name, labels, value in REGISTRY.snapshot()
+            if name == 'peppol_model_fallbacks_total'}
+
+
+def test_fixture_is_modelled(backend):
+    before = fallbacks()
+    convert_document(read_fixture('invoice-full.xml'), KBO_NUMBER, backend, engine='model')
+    assert fallbacks() == before
+
+
+@pytest.mark.parametrize('case', sorted(OUTSIDE_MODEL))
+def test_document_outside_the_model_is_converted_by_the_rules(case, backend):
+    element, old, new = OUTSIDE_MODEL[case]
+    data = read_fixture('invoice-full.xml').replace(old, new, 1)
+    with pytest.raises(Unmodelled) as raised:
+        convert_model(data, KBO_NUMBER, backend)
+    assert raised.value.name == element
+    rules = convert_document(data, KBO_NUMBER, backend, engine='rules')
+    before = fallbacks()
+    converted = convert_document(data, KBO_NUMBER, backend, engine='model')
+    after = fallbacks()
+    assert canonical(converted) == canonical(rules)
+    # Nothing is dropped.
+    assert element.lstrip('@').encode('utf-8') in converted
+    assert after.get(element, 0) - before.get(element, 0) == 1
+    assert sum(after.values()) - sum(before.values()) == 1
@@ -0,0 +1,112 @@
+from src.kbo import Enterprise
+from src.rules import (Copy, Element, Lookup, Param, Rule, TextOf, Transformer, bind_rules, compile_template,
+                       compile_value, is_static, qualify)
+
+PARTY = ('<cac:Party xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"'
+         ' xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">'
+         '<cac:PartyName><cbc:Name>Acme</cbc:Name></cac:PartyName>'
+         '<cac:PartyLegalEntity><cbc:CompanyID>BE0123456789</cbc:CompanyID></cac:PartyLegalEntity>'
+         '</cac:Party>').encode('utf-8')
+
+
+class Registry:
+    """
+    KBO registry knowing a single enterprise.
+    """
+
+    def __init__(self, enterprise):
+        self.enterprise = enterprise
+        self.numbers = []
+
+    def lookup(self, number):
+        self.numbers.append(number)
+        return self.enterprise if number == self.enterprise.number else None
+
+
+def test_compile_value():
+    assert compile_value('text') == 'text'
+    assert compile_value(Param('kbo_number')) == ('param', 'kbo_number')
+    assert compile_value(TextOf('cac:PartyName/cbc:Name')) == ('text_of', (qualify('cac:PartyName'),
+                                                                           qualify('cbc:Name')))
+    assert compile_value(Lookup('name', Param('kbo_number'), 'unknown')) == ('lookup', 'name', ('param', 'kbo_number'),
+                                                                              'unknown')
+
+
+def test_element_with_static_text_and_attributes(backend):
+    build = compile_template(Element('cbc:EndpointID', {'schemeID': '0208'}, '0123456789'))
+    built = build(backend.fromstring(PARTY), {})
+    assert built.tag == qualify('cbc:EndpointID')
+    assert dict(built.attrib) == {'schemeID': '0208'}
+    assert built.text == '0123456789'
+
+
+def test_static_element_is_copied(backend):
+    template = Element('cac:PartyIdentification', children=(Element('cbc:ID', text='42'),))
+    assert is_static(template)
+    build = compile_template(template)
+    party = backend.fromstring(PARTY)
+    first, second = build(party, {}), build(party, {})
+    assert first is not second
+    first[0].text = 'changed'
+    assert second[0].text == '42'
+    assert build(party, {})[0].text == '42'
+
+
+def test_element_with_param_and_text_of(backend):
+    template = Element('cac:Contact', {'id': Param('kbo_number')}, children=(
+        Element('cbc:Name', text=TextOf('cac:PartyName/cbc:Name')),
+        Element('cbc:Telephone', text=TextOf('cac:Missing/cbc:Telephone')),
+    ))
+    assert not is_static(template)
+    built = compile_template(template)(backend.fromstring(PARTY), {'kbo_number': '0123456789'})
+    assert built.get('id') == '0123456789'
+    assert built[0].text == 'Acme'
+    assert built[1].text is None
+
+
+def test_lookup(backend):
+    template = Element('cbc:RegistrationName', text=Lookup('name', TextOf('cac:PartyLegalEntity/cbc:CompanyID'),
+                                                          TextOf('cac:PartyName/cbc:Name')))
+    assert not is_static(template)
+    build = compile_template(template)
+    party = backend.fromstring(PARTY)
+    registry = Registry(Enterprise('BE0123456789', 'Acme Registered', 'AC', '014'))
+    assert build(party, {'registry': registry}).text == 'Acme Registered'
+    assert registry.numbers == ['BE0123456789']
+    # Falls back to the default without a registry or when the registry does not know the number.
+    assert build(party, {'registry': None}).text == 'Acme'
+    assert build(party, {'registry': Registry(Enterprise('BE0999999999', 'Other', 'AC', '014'))}).text == 'Acme'
+
+
+def test_copy(backend):
+    assert not is_static(Copy('cac:PartyName'))
+    build = compile_template(Element('cac:PartyTaxScheme', children=(Copy('cac:PartyName'), Copy('cac:Missing'))))
+    party = backend.fromstring(PARTY)
+    built = build(party, {})
+    assert [child.tag for child in built] == [qualify('cac:PartyName')]
+    assert built[0] is not party[0]
+    assert built[0][0].text == 'Acme'
+
+
+def test_bind_rules_makes_templates_static():
+    rules = (Rule('endpoint', 'cac:Party', ('insert', 0, Element('cbc:EndpointID', {'schemeID': Param('scheme')},
+                                                                 Param('number')))),
+             Rule('note', 'cac:Party/cbc:Note', ('text', Param('language'))))
+    bound = bind_rules(rules, {'scheme': '0208', 'language': 'nl'})
+    assert bound[0].action[2] == Element('cbc:EndpointID', {'schemeID': '0208'}, Param('number'))
+    assert not is_static(bound[0].action[2])
+    assert bound[1].action == ('text', 'nl')
+    assert is_static(bind_rules(rules, {'scheme': '0208', 'number': '1'})[0].action[2])
+
+
+def test_transformer_applies_rules_once_in_table_order(backend):
+    rules = (Rule('name', 'cac:PartyName/cbc:Name', ('text', Param('name'))),
+             Rule('endpoint', 'cac:Party', ('insert', 0, Element('cbc:EndpointID', text='0123456789'))),
+             Rule('legal-entity', 'cac:Party', ('remove', 'cac:PartyLegalEntity'),
+                  when='cac:PartyLegalEntity/cbc:CompanyID'),
+             # Not applied: the inserted element is not visited again.
+             Rule('endpoint-scheme', 'cac:Party/cbc:EndpointID', ('set', {'schemeID': '0208'})))
+    party = Transformer(rules).transform(backend.fromstring(PARTY), {'name': 'Acme NV'})
+    assert [child.tag for child in party] == [qualify('cbc:EndpointID'), qualify('cac:PartyName')]
+    assert party[0].get('schemeID') is None
+    assert party[1][0].text == 'Acme NV'